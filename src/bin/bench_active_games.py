@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+import argparse
+import gc
+import tracemalloc
+from functools import partial
+
+from langchain.llms.fake import FakeListLLM
+
+from twentyqs.brain import AnswerBot
+from twentyqs.cache import IdleCache
+
+
+"""
+Measure the memory used per active game (i.e. per cached `AnswerBot`), and
+the total for many open games with the `GameController.active_games` bound.
+"""
+
+
+def _measure(n: int, make) -> int:
+    gc.collect()
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    kept = [make(i) for i in range(n)]
+    gc.collect()
+    after, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del kept
+    return after - before
+
+
+def _kb(n: float) -> str:
+    return f"{n / 1024:,.1f} KiB"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--games", type=int, default=200)
+    parser.add_argument("--tabs", type=int, default=5000)
+    parser.add_argument("--max-active-games", type=int, default=1000)
+    parser.add_argument(
+        "--history", type=int, default=500, help="Subjects already seen by the user"
+    )
+    args = parser.parse_args()
+
+    factory = partial(AnswerBot, llm=FakeListLLM(responses=["1. Something"]))
+    history = [f"Subject number {i}" for i in range(args.history)]
+
+    def resumed(i: int) -> AnswerBot:
+        answerer = factory()
+        answerer.resume(f"Subject {i}")
+        return answerer
+
+    def with_history(i: int) -> AnswerBot:
+        answerer = resumed(i)
+        answerer.history = list(history)
+        return answerer
+
+    per_game = _measure(args.games, resumed) / args.games
+    per_game_history = _measure(args.games, with_history) / args.games
+    print(f"per active game:                  {_kb(per_game)}")
+    print(f"...if subject history were kept:  {_kb(per_game_history)}")
+
+    def fill(_: int) -> IdleCache:
+        cache: IdleCache[int, AnswerBot] = IdleCache(args.max_active_games)
+        for i in range(args.tabs):
+            cache.put(i, resumed(i))
+        return cache
+
+    total = _measure(1, fill)
+    print(
+        f"{args.tabs} open tabs, max {args.max_active_games} active: "
+        f"{_kb(total)} (unbounded: ~{_kb(per_game * args.tabs)})"
+    )
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+import argparse
+import os
+import subprocess
+import sys
+from dataclasses import dataclass
+
+
+"""
+Check the cold-start import time of a module (by default the server app)
+against a budget, using `python -X importtime`. Exits non-zero if over budget,
+or if any of the `--forbid` modules (which should only be imported on first
+use) were imported.
+
+The best of `--repeat` runs is taken, the first run may include compiling
+the .pyc files.
+"""
+
+DEFAULT_FORBIDDEN = {
+    "server.app": ["datasets", "alembic"],
+    "bin.run": ["gradio", "langchain", "datasets", "alembic"],
+}
+
+
+@dataclass(frozen=True)
+class ImportTime:
+    module: str
+    self_us: int
+    cumulative_us: int
+    depth: int
+
+
+def parse_importtime(stderr: str) -> list[ImportTime]:
+    """
+    Parse lines like: `import time:       self [us] |   cumulative | name`
+    """
+    times = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        self_us, cumulative_us, name = line[len("import time:") :].split("|")
+        if not self_us.strip().isdigit():
+            continue  # the header
+        times.append(
+            ImportTime(
+                module=name.strip(),
+                self_us=int(self_us),
+                cumulative_us=int(cumulative_us),
+                # (nested imports are indented by two spaces per level)
+                depth=(len(name) - len(name.lstrip()) - 1) // 2,
+            )
+        )
+    return times
+
+
+def measure(module: str) -> list[ImportTime]:
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        env=os.environ | {"PYTHONPATH": os.pathsep.join(sys.path)},
+    )
+    if result.returncode != 0:
+        # (just the traceback, without the import times)
+        for line in result.stderr.splitlines():
+            if not line.startswith("import time:"):
+                print(line, file=sys.stderr)
+        sys.exit(result.returncode)
+    return parse_importtime(result.stderr)
+
+
+def _ms(us: int) -> str:
+    return f"{us / 1000:>8,.1f} ms"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--module", type=str, default="server.app")
+    parser.add_argument("--budget-ms", type=float, default=5000)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--top", type=int, default=15)
+    parser.add_argument(
+        "--forbid",
+        action="append",
+        default=None,
+        help="Module which must not be imported (default depends on --module)",
+    )
+    args = parser.parse_args()
+    forbidden = (
+        args.forbid
+        if args.forbid is not None
+        else DEFAULT_FORBIDDEN.get(args.module, [])
+    )
+
+    runs = [measure(args.module) for _ in range(args.repeat)]
+    times = min(runs, key=lambda run: run[-1].cumulative_us)
+    total = next(t for t in reversed(times) if t.module == args.module)
+
+    print(f"Slowest top-level imports of {args.module}:")
+    top_level = [t for t in times if t.depth == 1]
+    for t in sorted(top_level, key=lambda t: t.cumulative_us, reverse=True)[: args.top]:
+        print(f"  {_ms(t.cumulative_us)}  {t.module}")
+    print(f"Total: {_ms(total.cumulative_us)} (budget: {args.budget_ms:,.0f} ms)")
+
+    failed = False
+    imported = {t.module for t in times}
+    for name in forbidden:
+        if name in imported:
+            print(f"{name} should not be imported at startup", file=sys.stderr)
+            failed = True
+    if total.cumulative_us / 1000 > args.budget_ms:
+        print("Import time is over budget", file=sys.stderr)
+        failed = True
+    if failed:
+        sys.exit(1)
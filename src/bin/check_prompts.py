@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+import argparse
+import sys
+
+from twentyqs.prompt_cache import MAX_STATIC_TAIL, check_prefixes
+from twentyqs.repository import Repository
+
+
+"""
+Check that all the static text in each chain's prompt is a leading prefix, so
+that prefix-based prompt caching can reuse it across games and users (exits
+non-zero if not).
+
+With `--db-path` also reports how many prompt tokens were actually served from
+the provider's cache, for the games played so far.
+"""
+
+
+def _pct(num: int, den: int) -> str:
+    return "n/a" if not den else f"{num / den:.1%}"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--db-path", type=str, default=None)
+    args = parser.parse_args()
+
+    reports = check_prefixes()
+    for report in reports:
+        print(
+            f"{report.route:<14} static: {report.static_chars:>5} chars, "
+            f"cacheable prefix: {report.prefix_chars:>5} "
+            f"({_pct(report.prefix_chars, report.static_chars)}) "
+            f"{'OK' if report.ok else 'FAIL'}"
+        )
+
+    if args.db_path:
+        repo = Repository(db_path=args.db_path)
+        print()
+        for route, (prompt_tokens, cached) in repo.get_prompt_token_usage().items():
+            print(
+                f"{route:<14} prompt tokens: {prompt_tokens:>8}, "
+                f"cached: {cached:>8} ({_pct(cached, prompt_tokens)}), "
+                f"uncached: {prompt_tokens - cached:>8}"
+            )
+
+    failed = [report.route for report in reports if not report.ok]
+    if failed:
+        print(
+            f"\nStatic text after the first variable exceeds {MAX_STATIC_TAIL} "
+            f"chars in: {', '.join(failed)}",
+            file=sys.stderr,
+        )
+        sys.exit(1)
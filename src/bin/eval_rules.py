@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+import argparse
+import sys
+
+from twentyqs.repository import Repository
+from twentyqs.rules import classify_question, evaluate_rules
+
+
+"""
+Check the local yes/no question rules (`twentyqs.rules`) against some known
+cases (exits non-zero if any are misclassified), then measure their precision
+against the verdicts the LLM gave for all the questions in the db.
+"""
+
+# (question, is_valid), or `None` where it should be left to the LLM
+CASES: list[tuple[str, bool | None]] = [
+    ("Is it bigger than a car?", True),
+    ("Does it have legs?", True),
+    ("Is it?", None),
+    ("What colour is it?", False),
+    ("How many legs does it have?", False),
+    ("Who invented it?", False),
+    ("Is it big or small?", None),
+    # a leading subordinate clause
+    ("When you eat it, is it sweet?", True),
+    ("If you dropped it, would it break?", True),
+    ("Where it lives, is it cold?", True),
+    ("When you eat it is it sweet?", None),
+    # a follow-up to a question
+    ("How big is it — bigger than a car?", None),
+    ("How big is it - bigger than a car?", None),
+    ("What is it, is it an animal?", None),
+    # compound questions
+    ("Is it big and does it fly?", None),
+    ("Is it an animal, is it a mammal?", None),
+    ("Is it big? Is it red?", None),
+    ("Is it black and white?", True),
+    ("Is it a t-shirt?", True),
+]
+
+
+def check_cases() -> list[str]:
+    failures = []
+    for question, expected in CASES:
+        result = classify_question(question)
+        actual = None if result is None else result[0]
+        if actual is not expected:
+            failures.append(f"{question!r}: expected {expected}, got {actual}")
+    return failures
+
+
+def _pct(val: float | None) -> str:
+    return "n/a" if val is None else f"{val:.1%}"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--db-path", type=str, default="twentyqs.db")
+    args = parser.parse_args()
+
+    failures = check_cases()
+    print(f"cases:            {len(CASES) - len(failures)}/{len(CASES)} ok")
+    for failure in failures:
+        print(f"  {failure}", file=sys.stderr)
+
+    repo = Repository(db_path=args.db_path)
+    result = evaluate_rules(repo.get_validation_history())
+
+    print(f"questions:        {result.total}")
+    print(f"coverage:         {_pct(result.coverage)}")
+    print(
+        f"accepted:         {result.accepted} "
+        f"(precision: {_pct(result.accept_precision)})"
+    )
+    print(
+        f"rejected:         {result.rejected} "
+        f"(precision: {_pct(result.reject_precision)})"
+    )
+
+    if failures:
+        sys.exit(1)
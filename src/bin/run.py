@@ -2,7 +2,7 @@
 import argparse
 import logging
 
-from twentyqs.runner import run
+from twentyqs.types import Route
 
 
 """
@@ -25,8 +25,49 @@ if __name__ == "__main__":
     parser.add_argument("--clear-db", action="store_true")
     parser.add_argument("--log-level", type=str, default="INFO")
     parser.add_argument("--max-questions", type=int, default=20)
+    parser.add_argument("--stream-answers", action="store_true")
+    parser.add_argument("--rule-based-validation", action="store_true")
+    parser.add_argument("--prewarm-questions", type=int, default=0)
+    parser.add_argument(
+        "--turn-budget",
+        type=float,
+        default=None,
+        help='Seconds allowed for LLM calls per turn, before answering "I don\'t know"',
+    )
+    parser.add_argument("--hedge-requests", action="store_true")
+    parser.add_argument(
+        "--batch-window-ms",
+        type=float,
+        default=0,
+        help="Collect prompts from concurrent games for this long and send as one request",
+    )
+    parser.add_argument(
+        "--queue-concurrency",
+        type=int,
+        default=None,
+        help="Enable the Gradio queue with this many workers",
+    )
+    parser.add_argument("--queue-max-size", type=int, default=64)
+    parser.add_argument(
+        "--turn-concurrency",
+        type=int,
+        default=None,
+        help='Max concurrent turns, before replying "server busy"',
+    )
+    for route in Route:
+        parser.add_argument(
+            f"--{route.replace('_', '-')}-model",
+            type=str,
+            default=None,
+            help=f"Model for the {route} chain (defaults to --model)",
+        )
     args = parser.parse_args()
 
+    # (these pull in gradio and langchain, so `--help` is quicker without them)
+    from twentyqs.resilience import ResilienceConfig
+    from twentyqs.runner import run
+    from twentyqs.ui import QueueConfig
+
     run(
         username=args.username,
         openai_model=args.model,
@@ -36,4 +77,23 @@ if __name__ == "__main__":
         verbose_langchain=args.verbose_langchain,
         log_level=args.log_level,
         max_questions=args.max_questions,
+        stream_answers=args.stream_answers,
+        rule_based_validation=args.rule_based_validation,
+        prewarm_questions=args.prewarm_questions,
+        resilience=(
+            ResilienceConfig(turn_budget=args.turn_budget, hedge=args.hedge_requests)
+            if args.turn_budget
+            else None
+        ),
+        route_models={route: getattr(args, f"{route}_model") for route in Route},
+        batch_window=args.batch_window_ms / 1000,
+        queue=(
+            QueueConfig(
+                concurrency_count=args.queue_concurrency,
+                max_size=args.queue_max_size,
+                turn_concurrency=args.turn_concurrency,
+            )
+            if args.queue_concurrency
+            else None
+        ),
     )
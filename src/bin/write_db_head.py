@@ -0,0 +1,34 @@
+#!/usr/bin/env python3
+import argparse
+import sys
+from pathlib import Path
+
+from alembic.config import Config
+from alembic.script import ScriptDirectory
+
+from server.startup import HEAD_FILE
+
+
+"""
+Write the alembic head revision to `migrations/HEAD`, so that the server can
+tell at startup whether the db is already migrated without importing alembic.
+
+Run at build time (see the Dockerfile), and again after adding a migration if
+you have a `migrations/HEAD` file locally. Exits non-zero if there are
+multiple heads.
+"""
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--alembic-config", type=str, default="alembic.ini")
+    parser.add_argument("--output", type=Path, default=HEAD_FILE)
+    args = parser.parse_args()
+
+    heads = ScriptDirectory.from_config(Config(args.alembic_config)).get_heads()
+    if len(heads) != 1:
+        print(f"Expected a single head revision, got: {heads}", file=sys.stderr)
+        sys.exit(1)
+
+    args.output.write_text(f"{heads[0]}\n")
+    print(f"{args.output}: {heads[0]}")
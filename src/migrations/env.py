@@ -23,6 +23,15 @@ from twentyqs.repository import GameSession, Turn, User, TurnLog  # noqa
 
 target_metadata = SQLModel.metadata
 
+
+def include_name(name, type_, parent_names) -> bool:
+    # (the full-text index and its shadow tables aren't models, they're created
+    # by hand, see `twentyqs.repository.TURN_SEARCH_DDL`)
+    if type_ == "table":
+        return not (name or "").startswith("turn_search")
+    return True
+
+
 # other values from the config, defined by the needs of env.py,
 # can be acquired:
 # my_important_option = config.get_main_option("my_important_option")
@@ -49,6 +58,7 @@ def run_migrations_offline() -> None:
     context.configure(
         url=url,
         target_metadata=target_metadata,
+        include_name=include_name,
         literal_binds=True,
         dialect_opts={"paramstyle": "named"},
     )
@@ -95,7 +105,11 @@ def run_migrations_online() -> None:
         conn.exec_driver_sql("BEGIN")
 
     with connectable.connect() as connection:
-        context.configure(connection=connection, target_metadata=target_metadata)
+        context.configure(
+            connection=connection,
+            target_metadata=target_metadata,
+            include_name=include_name,
+        )
 
         with context.begin_transaction():
             context.run_migrations()
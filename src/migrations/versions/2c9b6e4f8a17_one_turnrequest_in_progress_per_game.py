@@ -0,0 +1,42 @@
+"""one turnrequest in progress per game
+
+Revision ID: 2c9b6e4f8a17
+Revises: 7f3d9e21c6b0
+Create Date: 2026-10-19 18:41:09.532716
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "2c9b6e4f8a17"
+down_revision = "7f3d9e21c6b0"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # (all but the latest request in progress of a game have been abandoned)
+    op.execute(
+        """
+        DELETE FROM turnrequest
+        WHERE outcome IS NULL
+        AND id NOT IN (
+            SELECT max(id) FROM turnrequest
+            WHERE outcome IS NULL
+            GROUP BY gamesession_id
+        )
+        """
+    )
+    op.create_index(
+        "turnrequest_in_progress",
+        "turnrequest",
+        ["gamesession_id"],
+        unique=True,
+        sqlite_where=sa.text("outcome IS NULL"),
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("turnrequest_in_progress", table_name="turnrequest")
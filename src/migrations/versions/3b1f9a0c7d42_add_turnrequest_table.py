@@ -0,0 +1,41 @@
+"""add turnrequest table
+
+Revision ID: 3b1f9a0c7d42
+Revises: ccb8d5e9d843
+Create Date: 2026-10-19 09:12:41.204518
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "3b1f9a0c7d42"
+down_revision = "ccb8d5e9d843"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "turnrequest",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("gamesession_id", sa.Integer(), nullable=False),
+        sa.Column("request_key", sa.String(), nullable=False),
+        sa.Column("question_hash", sa.String(), nullable=False),
+        sa.Column("created_at", sa.DateTime(), nullable=False),
+        sa.Column("turn_id", sa.Integer(), nullable=True),
+        sa.Column("outcome", sa.JSON(none_as_null=True), nullable=True),
+        sa.ForeignKeyConstraint(["gamesession_id"], ["gamesession.id"]),
+        sa.ForeignKeyConstraint(["turn_id"], ["turn.id"]),
+        sa.PrimaryKeyConstraint("id"),
+        sa.UniqueConstraint(
+            "gamesession_id", "request_key", name="turnrequest_gamesession_id_key"
+        ),
+    )
+    op.create_index("ix_turnrequest_gamesession_id", "turnrequest", ["gamesession_id"])
+
+
+def downgrade() -> None:
+    op.drop_index(op.f("ix_turnrequest_gamesession_id"), table_name="turnrequest")
+    op.drop_table("turnrequest")
@@ -0,0 +1,82 @@
+"""add turn_search full-text index
+
+Revision ID: 7f3d9e21c6b0
+Revises: a4c81f3e7b25
+Create Date: 2026-10-19 16:02:47.118305
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = "7f3d9e21c6b0"
+down_revision = "a4c81f3e7b25"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # (the existing turns are indexed by the `turn_search` backfill)
+    op.execute(
+        """
+        CREATE VIRTUAL TABLE turn_search
+        USING fts5(question, subject, reason, tokenize = 'porter unicode61')
+        """
+    )
+    op.execute(
+        """
+        CREATE TRIGGER turn_search_turn_insert AFTER INSERT ON turn
+        BEGIN
+            INSERT INTO turn_search (rowid, question, subject)
+            SELECT new.id, new.question, subject FROM gamesession
+            WHERE id = new.gamesession_id;
+        END
+        """
+    )
+    op.execute(
+        """
+        CREATE TRIGGER turn_search_turn_update AFTER UPDATE OF question ON turn
+        BEGIN
+            UPDATE turn_search SET question = new.question WHERE rowid = new.id;
+        END
+        """
+    )
+    op.execute(
+        """
+        CREATE TRIGGER turn_search_turn_delete AFTER DELETE ON turn
+        BEGIN
+            DELETE FROM turn_search WHERE rowid = old.id;
+        END
+        """
+    )
+    op.execute(
+        """
+        CREATE TRIGGER turn_search_gamesession_update
+        AFTER UPDATE OF subject ON gamesession
+        BEGIN
+            UPDATE turn_search SET subject = new.subject
+            WHERE rowid IN (SELECT id FROM turn WHERE gamesession_id = new.id);
+        END
+        """
+    )
+    op.execute(
+        """
+        CREATE TRIGGER turn_search_turnlog_insert AFTER INSERT ON turnlog
+        WHEN new.key = 'VALIDATE_QUESTION'
+        BEGIN
+            UPDATE turn_search SET reason = json_extract(new.value, '$.reason')
+            WHERE rowid = new.turn_id;
+        END
+        """
+    )
+
+
+def downgrade() -> None:
+    op.execute("DROP TRIGGER turn_search_turnlog_insert")
+    op.execute("DROP TRIGGER turn_search_gamesession_update")
+    op.execute("DROP TRIGGER turn_search_turn_delete")
+    op.execute("DROP TRIGGER turn_search_turn_update")
+    op.execute("DROP TRIGGER turn_search_turn_insert")
+    op.execute("DROP TABLE turn_search")
+    # (so that it's indexed again on the next upgrade)
+    op.execute("DELETE FROM backfillprogress WHERE name = 'turn_search'")
@@ -0,0 +1,47 @@
+"""add stagelatency and watermark tables
+
+Revision ID: 8e4c2d6f1a93
+Revises: 3b1f9a0c7d42
+Create Date: 2026-10-19 11:36:05.881270
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "8e4c2d6f1a93"
+down_revision = "3b1f9a0c7d42"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "stagelatency",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("day", sa.Date(), nullable=False),
+        sa.Column("stage", sa.String(), nullable=False),
+        sa.Column("model", sa.String(), nullable=False),
+        sa.Column("count", sa.Integer(), nullable=False),
+        sa.Column("total_ms", sa.Float(), nullable=False),
+        sa.Column("max_ms", sa.Float(), nullable=False),
+        sa.Column("histogram", sa.JSON(), nullable=True),
+        sa.PrimaryKeyConstraint("id"),
+        sa.UniqueConstraint(
+            "day", "stage", "model", name="stagelatency_day_stage_model"
+        ),
+    )
+    op.create_index(op.f("ix_stagelatency_day"), "stagelatency", ["day"], unique=False)
+    op.create_table(
+        "watermark",
+        sa.Column("name", sa.String(), nullable=False),
+        sa.Column("last_id", sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint("name"),
+    )
+
+
+def downgrade() -> None:
+    op.drop_table("watermark")
+    op.drop_index(op.f("ix_stagelatency_day"), table_name="stagelatency")
+    op.drop_table("stagelatency")
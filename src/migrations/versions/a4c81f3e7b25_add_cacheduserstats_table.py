@@ -0,0 +1,34 @@
+"""add cacheduserstats table
+
+Revision ID: a4c81f3e7b25
+Revises: 5d2e7b9c4a18
+Create Date: 2026-10-19 15:21:09.442871
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "a4c81f3e7b25"
+down_revision = "5d2e7b9c4a18"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "cacheduserstats",
+        sa.Column("stats", sa.JSON(), nullable=True),
+        sa.Column("user_id", sa.Integer(), nullable=False),
+        sa.Column("computed_at", sa.DateTime(), nullable=False),
+        sa.ForeignKeyConstraint(
+            ["user_id"],
+            ["user.id"],
+        ),
+        sa.PrimaryKeyConstraint("user_id"),
+    )
+
+
+def downgrade() -> None:
+    op.drop_table("cacheduserstats")
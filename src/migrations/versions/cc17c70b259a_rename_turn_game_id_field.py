@@ -17,13 +17,13 @@ depends_on = None
 
 def upgrade() -> None:
     op.drop_index("turn_game_id", "turn")
-    with op.batch_alter_table("turn") as batch_op:
-        batch_op.alter_column("game_id", new_column_name="gamesession_id")
+    # (SQLite >= 3.25 can rename in place, rather than `batch_alter_table`
+    # copying the whole table)
+    op.execute("ALTER TABLE turn RENAME COLUMN game_id TO gamesession_id")
     op.create_index("turn_gamesession_id", "turn", ["gamesession_id"])
 
 
 def downgrade() -> None:
     op.drop_index("turn_gamesession_id", "turn")
-    with op.batch_alter_table("turn") as batch_op:
-        batch_op.alter_column("gamesession_id", new_column_name="game_id")
+    op.execute("ALTER TABLE turn RENAME COLUMN gamesession_id TO game_id")
     op.create_index("turn_game_id", "turn", ["game_id"])
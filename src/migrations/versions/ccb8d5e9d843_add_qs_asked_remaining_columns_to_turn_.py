@@ -19,23 +19,9 @@ depends_on = None
 def upgrade() -> None:
     op.add_column("turn", sa.Column("questions_asked", sa.Integer(), nullable=True))
     op.add_column("turn", sa.Column("questions_remaining", sa.Integer(), nullable=True))
-    op.execute(
-        """
-        UPDATE turn
-        SET
-            questions_asked = log.questions_asked,
-            questions_remaining = log.questions_remaining
-        FROM (
-            SELECT
-                turn_id,
-                json_extract("value", '$.questions_asked') AS questions_asked,
-                json_extract("value", '$.questions_remaining') AS questions_remaining
-            FROM turnlog
-            WHERE key = 'BEGIN_TURN'
-        ) AS log
-        WHERE turn.id = log.turn_id
-        """
-    )
+    # the values are copied from the BEGIN_TURN logs by the `turn_questions_asked`
+    # backfill, in batches in the background (see `twentyqs.backfill`) rather
+    # than one big UPDATE holding the db lock at boot
 
 
 def downgrade() -> None:
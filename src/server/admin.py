@@ -1,9 +1,10 @@
 import hashlib
-from pathlib import Path
-from typing import Type
+from dataclasses import dataclass
+from datetime import date, timedelta
+from functools import partial
+from typing import Any, Type
 
-from datasets import Dataset
-from markupsafe import Markup
+from markupsafe import Markup, escape
 from pygments import highlight
 from pygments.lexers.data import JsonLexer
 from pygments.formatters import HtmlFormatter
@@ -13,14 +14,32 @@ from sqladmin import (
     ModelView as _ModelView,
     expose,
 )
-from sqladmin.authentication import login_required
+from sqlalchemy import func, select
+from sqlalchemy.orm import RelationshipProperty, joinedload
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.sql import ClauseElement
+from sqladmin.authentication import AuthenticationBackend, login_required
+from sqladmin.helpers import get_column_python_type
+from starlette.exceptions import HTTPException
 from starlette.requests import Request
-from starlette.responses import FileResponse, Response, RedirectResponse
-
-from twentyqs.repository import GameSession, Turn, TurnLog, User
+from starlette.responses import Response, RedirectResponse
+
+from twentyqs import analytics, backfill
+from twentyqs.archive import TurnLogArchive
+from twentyqs.repository import (
+    HIGHLIGHT_END,
+    HIGHLIGHT_START,
+    GameSession,
+    Turn,
+    TurnLog,
+    User,
+)
 from twentyqs.serde import serialize
+from twentyqs.singleflight import llm_calls
 from .config import settings
+from .jobs import jobs, run_sync
 from .repository import Repository
+from .snapshot import SnapshotStore, snapshot_response
 
 
 json_lexer = JsonLexer()
@@ -37,6 +56,16 @@ def json_detail_formatter(model, attribute):
     return json_formatter(val)
 
 
+def highlight_formatter(val: str | None):
+    if val is None:
+        return ""
+    return Markup(
+        str(escape(val))
+        .replace(HIGHLIGHT_START, "<mark>")
+        .replace(HIGHLIGHT_END, "</mark>")
+    )
+
+
 def obj_formatter(obj):
     return f"{obj.__class__.__name__}(id={obj.id})"
 
@@ -49,9 +78,9 @@ def obj_list_detail_formatter(model, attribute):
 class Admin(_Admin):
     db: Repository
 
-    def __init__(self, *args, **kwargs) -> None:
+    def __init__(self, *args, archive: TurnLogArchive | None = None, **kwargs) -> None:
         super().__init__(*args, **kwargs)
-        self.db = Repository(engine=self.engine)
+        self.db = Repository(engine=self.engine, archive=archive)
 
     def add_model_view(self, view: Type["ModelView"]) -> None:  # type: ignore[override]
         view.db = self.db
@@ -59,11 +88,77 @@ class Admin(_Admin):
 
     def add_base_view(self, view: Type["BaseView"]) -> None:  # type: ignore[override]
         view.db = self.db
+        # (so that `login_required` works on the views' exposed methods too)
+        view.authentication_backend = self.authentication_backend
         return super().add_base_view(view)
 
+    @login_required
+    async def list(self, request: Request) -> Response:
+        model_view = self._find_model_view(request.path_params["identity"])
+        if not isinstance(model_view, KeysetModelView):
+            return await super().list(request)
+        await self._list(request)
+        page = await model_view.keyset_list(request)
+        return self.templates.TemplateResponse(
+            model_view.list_template,
+            {
+                "request": request,
+                "model_view": model_view,
+                "page": page,
+            },
+        )
+
+    @login_required
+    async def details(self, request: Request) -> Response:
+        await self._details(request)
+        model_view: ModelView = self._find_model_view(  # type: ignore[assignment]
+            request.path_params["identity"]
+        )
+        model = await model_view.get_object_for_details(request.path_params["pk"])
+        if not model:
+            raise HTTPException(status_code=404)
+        return self.templates.TemplateResponse(
+            model_view.details_template,
+            {
+                "request": request,
+                "model_view": model_view,
+                "model": model,
+                "title": model_view.name,
+                "more_urls": self._more_urls(request, model_view, model),
+                **await model_view.details_context(model),
+            },
+        )
+
+    def _more_urls(
+        self, request: Request, model_view: "ModelView", model: Any
+    ) -> dict[str, str]:
+        """
+        Links to the rest of each to-many relation cut short on the details
+        page: the related model's list, filtered by the foreign key (if it has
+        a list which can be).
+        """
+        urls = {}
+        for relation in model_view._details_relation_attrs:
+            prop = relation.property
+            if not model_view.has_more(model, prop):
+                continue
+            ((local, remote),) = prop.local_remote_pairs
+            for view in self.views:
+                if (
+                    isinstance(view, KeysetModelView)
+                    and view.model is prop.mapper.class_
+                    and remote.key in view.keyset_filters
+                ):
+                    url = request.url_for(
+                        "admin:list", identity=view.identity
+                    ).include_query_params(**{remote.key: getattr(model, local.key)})
+                    urls[prop.key] = str(url)
+                    break
+        return urls
+
     @login_required
     async def index(self, request: Request) -> Response:
-        stats = self.db.get_server_stats()
+        stats = await run_sync(self.db.get_server_stats)
         return self.templates.TemplateResponse(
             "index.html",
             {
@@ -71,12 +166,16 @@ class Admin(_Admin):
                 "title": "20 Questions Bot Admin",
                 "pygments_css": PYGMENTS_CSS,
                 "server_stats": json_formatter(stats.json(indent=2)),
+                "coalescing_stats": json_formatter(
+                    serialize(llm_calls.get_stats(), indent=2)
+                ),
             },
         )
 
 
 class BaseView(_BaseView):
     db: Repository
+    authentication_backend: AuthenticationBackend | None
 
 
 class ModelView(_ModelView):
@@ -84,6 +183,172 @@ class ModelView(_ModelView):
     pygments_css = PYGMENTS_CSS
     details_template = "details_with_pygments.html"
 
+    # rows shown of each to-many relation on the details page
+    detail_relation_limit = settings.admin_detail_relation_limit
+
+    async def _run_query(self, stmt: ClauseElement) -> Any:
+        # (on the admin pool rather than anyio's default one, see `jobs`)
+        return await run_sync(self._run_query_sync, stmt)
+
+    async def get_object_for_details(self, value: Any) -> Any:
+        """
+        Unlike sqladmin's, only the to-one relations are joined: the to-many
+        ones (e.g. all of a user's games) are loaded with a query each, capped
+        at `detail_relation_limit` rows (+1, to tell if there are more).
+        """
+        pk_value = get_column_python_type(self.pk_column)(value)
+        stmt = select(self.model).where(self.pk_column == pk_value)
+        for relation in self._details_relation_attrs:
+            if not relation.property.uselist:
+                stmt = stmt.options(joinedload(relation))
+        obj = await self._get_object_by_pk(stmt)
+        if obj is not None:
+            await run_sync(self._load_capped_relations, obj)
+        return obj
+
+    def _load_capped_relations(self, obj: Any) -> None:
+        with self.sessionmaker(expire_on_commit=False) as session:
+            for relation in self._details_relation_attrs:
+                prop = relation.property
+                if not prop.uselist:
+                    continue
+                target = prop.mapper
+                stmt = select(target.class_)
+                for local, remote in prop.local_remote_pairs:
+                    stmt = stmt.where(remote == getattr(obj, local.key))
+                # (newest first)
+                stmt = stmt.order_by(*(pk.desc() for pk in target.primary_key))
+                rows = session.execute(
+                    stmt.limit(self.detail_relation_limit + 1)
+                ).scalars()
+                set_committed_value(obj, prop.key, list(rows))
+
+    def has_more(self, obj: Any, prop: Any) -> bool:
+        """
+        Whether a to-many relation has more rows than shown on the details page.
+        """
+        return (
+            isinstance(prop, RelationshipProperty)
+            and bool(prop.uselist)
+            and len(getattr(obj, prop.key)) > self.detail_relation_limit
+        )
+
+    def get_detail_value(self, obj: Any, prop: Any) -> tuple[Any, Any]:
+        value, formatted_value = super().get_detail_value(obj, prop)  # type: ignore
+        if self.has_more(obj, prop):
+            limit = self.detail_relation_limit
+            value, formatted_value = value[:limit], formatted_value[:limit]
+        return value, formatted_value
+
+    async def details_context(self, obj: Any) -> dict[str, Any]:
+        """
+        Extra context for `details_template`.
+        """
+        return {}
+
+
+@dataclass
+class KeysetPage:
+    rows: list[Any]
+    page_size: int
+    # (approximate, `None` when searching or filtering)
+    count: int | None
+    # of `keyset_filters`, by column name
+    filters: dict[str, Any]
+    first_url: str
+    newer_url: str | None
+    older_url: str | None
+
+
+class KeysetModelView(ModelView):
+    """
+    List view for big tables: pages by primary key (`?after=`/`?before=` the
+    last/first id seen) rather than OFFSET, so deep pages don't scan all the
+    rows before them, and shows the approximate row count from the id range
+    instead of a `COUNT(*)`.
+
+    Only sortable by the primary key (newest first by default), and only
+    filterable by the (indexed) foreign keys in `keyset_filters`, e.g.
+    `?turn_id=` for the logs of a turn.
+    """
+
+    list_template = "keyset_list.html"
+    keyset_filters: list[str] = []
+    # shown above the list
+    list_note: str | None = None
+
+    async def estimate_count(self) -> int:
+        # (max/min of the primary key are just a walk down the b-tree, the
+        # estimate is only off by the number of deleted rows)
+        pk = self.pk_column
+        rows = await self._run_query(select(func.max(pk) - func.min(pk) + 1))
+        return rows[0] or 0
+
+    async def keyset_list(self, request: Request) -> KeysetPage:
+        """
+        Raises a 400 for malformed paging or filter params.
+        """
+        params = request.query_params
+        try:
+            page_size = min(
+                int(params.get("pageSize", 0)) or self.page_size,
+                max(self.page_size_options),
+            )
+            after = int(params["after"]) if "after" in params else None
+            before = int(params["before"]) if "before" in params else None
+            filters = {
+                name: get_column_python_type(getattr(self.model, name))(params[name])
+                for name in self.keyset_filters
+                if name in params
+            }
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=f"Invalid parameter: {e}")
+        descending = params.get("sort", "desc") == "desc"
+        search = params.get("search")
+        pk = self.pk_column
+
+        stmt = self.list_query
+        for relation in self._list_relation_attrs:
+            stmt = stmt.options(joinedload(relation))
+        if search:
+            stmt = self.search_query(stmt=stmt, term=search)
+        for name, value in filters.items():
+            stmt = stmt.where(getattr(self.model, name) == value)
+        # (going back to `before`, we query in the opposite order then reverse)
+        backwards = before is not None and after is None
+        if after is not None:
+            stmt = stmt.where(pk < after if descending else pk > after)
+        elif before is not None:
+            stmt = stmt.where(pk > before if descending else pk < before)
+        stmt = stmt.order_by(pk.desc() if descending != backwards else pk.asc()).limit(
+            page_size + 1
+        )
+
+        rows = list(await self._run_query(stmt))
+        more = len(rows) > page_size
+        rows = rows[:page_size]
+        if backwards:
+            rows.reverse()
+
+        url = request.url.remove_query_params(["after", "before"])
+        first_id = self.get_prop_value(rows[0], pk) if rows else None
+        last_id = self.get_prop_value(rows[-1], pk) if rows else None
+        has_newer = (more if backwards else after is not None) and rows
+        has_older = (before is not None if backwards else more) and rows
+        return KeysetPage(
+            rows=rows,
+            page_size=page_size,
+            count=None if search or filters else await self.estimate_count(),
+            filters=filters,
+            first_url=str(url),
+            newer_url=(
+                str(url.include_query_params(before=first_id)) if has_newer else None
+            ),
+            older_url=(
+                str(url.include_query_params(after=last_id)) if has_older else None
+            ),
+        )
+
 
 class UserAdmin(ModelView, model=User):
     column_list = [
@@ -100,12 +365,16 @@ class UserAdmin(ModelView, model=User):
     ]
     details_template = "user_details.html"
 
-    def user_stats(self, user):
-        stats = self.db.get_user_stats(user.username)
+    async def user_stats(self, user):
+        # (precomputed, see `Repository.get_user_stats`)
+        stats = await run_sync(self.db.get_user_stats, user.username)
         return json_formatter(stats.json(indent=2))
 
+    async def details_context(self, obj: Any) -> dict[str, Any]:
+        return {"user_stats": await self.user_stats(obj)}
+
 
-class GameSessionAdmin(ModelView, model=GameSession):
+class GameSessionAdmin(KeysetModelView, model=GameSession):
     can_create = False
     can_edit = False
     column_type_formatters = ModelView.column_type_formatters | {
@@ -118,13 +387,14 @@ class GameSessionAdmin(ModelView, model=GameSession):
         "finished_at",
         "user_won",
     ]
+    keyset_filters = ["user_id"]
     column_formatters_detail = {
         "turns": obj_list_detail_formatter,
         "llm_stats": json_detail_formatter,
     }
 
 
-class TurnAdmin(ModelView, model=Turn):
+class TurnAdmin(KeysetModelView, model=Turn):
     can_create = False
     can_edit = False
     column_list = [
@@ -134,6 +404,7 @@ class TurnAdmin(ModelView, model=Turn):
         "questions_remaining",
         "question",
     ]
+    keyset_filters = ["gamesession_id"]
     column_details_exclude_list = [
         "gamesession_id",
     ]
@@ -145,7 +416,7 @@ class TurnAdmin(ModelView, model=Turn):
     }
 
 
-class TurnLogAdmin(ModelView, model=TurnLog):
+class TurnLogAdmin(KeysetModelView, model=TurnLog):
     can_create = False
     can_edit = False
     column_list = [
@@ -154,6 +425,14 @@ class TurnLogAdmin(ModelView, model=TurnLog):
         "timestamp",
         "key",
     ]
+    keyset_filters = ["turn_id"]
+    list_note = (
+        f"Logs of turns older than {settings.turnlog_retention_days} days are"
+        " moved to the archive files, so aren't listed here (the game reviews and"
+        " the HF dataset still include them)."
+        if settings.turnlog_retention_days is not None
+        else None
+    )
     column_details_exclude_list = [
         "turn_id",
     ]
@@ -166,16 +445,156 @@ class TurnLogAdmin(ModelView, model=TurnLog):
 
 
 class DbFileView(BaseView):
+    """
+    (without the archived turn logs, see `snapshot`)
+    """
+
     name = "Download db file"
     icon = "fa-database"
 
+    snapshots = SnapshotStore(
+        db_path=settings.db_path,
+        directory=settings.snapshot_dir,
+        max_age=settings.snapshot_max_age,
+    )
+
     @expose("/db/download", methods=["GET"])
-    def download(self, request):
-        path = Path(settings.db_path)
-        return FileResponse(
-            path=path,
-            media_type="application/octet-stream",
-            filename=path.name,
+    @login_required
+    async def download(self, request):
+        # (taking the snapshot can be slow for a large db)
+        snapshot = await run_sync(self.snapshots.latest)
+        return RedirectResponse(
+            url=request.url_for("admin:db-snapshot", name=snapshot.name),
+            status_code=303,
+        )
+
+    @expose("/db/snapshots/{name}", identity="db-snapshot", methods=["GET"])
+    @login_required
+    async def snapshot(self, request):
+        snapshot = self.snapshots.get(request.path_params["name"])
+        if snapshot is None:
+            return Response("Snapshot not found (may have been replaced)", 404)
+        return snapshot_response(request, snapshot)
+
+
+class StageLatencyView(BaseView):
+    name = "Stage latency"
+    icon = "fa-stopwatch"
+    max_days = 365
+
+    @expose("/analytics/latency", identity="stage-latency", methods=["GET"])
+    @login_required
+    async def latency(self, request):
+        try:
+            days = int(request.query_params.get("days", 14))
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid days")
+        days = min(max(days, 1), self.max_days)
+        # (only summarises the turns played since the last view)
+        await run_sync(analytics.refresh_stage_latency, self.db)
+        summaries = await run_sync(
+            self.db.get_stage_latency, since=date.today() - timedelta(days=days)
+        )
+        rows = [
+            {
+                "day": row.day,
+                "stage": row.stage,
+                "model": row.model,
+                "count": row.count,
+                "mean": analytics.mean_ms(row),
+                "p50": analytics.percentile_ms(row, 0.5),
+                "p90": analytics.percentile_ms(row, 0.9),
+                "p99": analytics.percentile_ms(row, 0.99),
+                "max": row.max_ms,
+            }
+            for row in summaries
+        ]
+        return self.templates.TemplateResponse(
+            "stage_latency.html",
+            {
+                "request": request,
+                "rows": rows,
+                "days": days,
+            },
+        )
+
+
+class SearchView(BaseView):
+    name = "Search turns"
+    icon = "fa-magnifying-glass"
+    page_size = 50
+
+    @expose("/search", identity="search", methods=["GET"])
+    @login_required
+    async def search(self, request):
+        query = request.query_params.get("q", "").strip()
+        try:
+            offset = max(int(request.query_params.get("offset", 0)), 0)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid offset")
+        results, error = [], None
+        if query:
+            try:
+                results = await run_sync(
+                    self.db.search_turns,
+                    query,
+                    limit=self.page_size + 1,
+                    offset=offset,
+                )
+            except ValueError as e:
+                error = str(e)
+        url = request.url.remove_query_params("offset")
+        return self.templates.TemplateResponse(
+            "search.html",
+            {
+                "request": request,
+                "query": query,
+                "error": error,
+                "results": results[: self.page_size],
+                "highlight": highlight_formatter,
+                "newer_url": (
+                    str(url.include_query_params(offset=offset - self.page_size))
+                    if offset > 0
+                    else None
+                ),
+                "older_url": (
+                    str(url.include_query_params(offset=offset + self.page_size))
+                    if len(results) > self.page_size
+                    else None
+                ),
+            },
+        )
+
+
+class BackfillView(BaseView):
+    name = "Backfills"
+    icon = "fa-fill-drip"
+
+    @expose("/db/backfills", identity="backfills", methods=["GET"])
+    @login_required
+    async def backfills(self, request):
+        progress = {
+            row.name: row for row in await run_sync(self.db.get_backfill_progress)
+        }
+        rows = [
+            {
+                "name": bf.name,
+                "table": bf.table,
+                "progress": progress.get(bf.name),
+                "percent": (
+                    backfill.percent_done(progress[bf.name])
+                    if bf.name in progress
+                    else None
+                ),
+            }
+            for bf in backfill.BACKFILLS
+        ]
+        return self.templates.TemplateResponse(
+            "backfills.html",
+            {
+                "request": request,
+                "rows": rows,
+            },
         )
 
 
@@ -188,7 +607,8 @@ class HfDatasetView(BaseView):
     icon = "fa-table"
 
     @expose("/db/init-push-to-hf", identity="init-push-to-hf", methods=["GET"])
-    def confirm(self, request):
+    @login_required
+    async def confirm(self, request):
         return self.templates.TemplateResponse(
             "push_to_hf.html",
             {
@@ -198,9 +618,17 @@ class HfDatasetView(BaseView):
         )
 
     @expose("/db/push-to-hf", identity="do-push-to-hf", methods=["POST"])
+    @login_required
     async def push(self, request):
         async with request.form() as form:
-            repo_id = form["repo_id"]
+            repo_id = str(form["repo_id"])
+        jobs.submit(f"Push dataset to {repo_id}", partial(self._push, repo_id))
+        return RedirectResponse(url=request.url_for("admin:jobs"), status_code=303)
+
+    def _push(self, repo_id: str) -> str:
+        # (datasets is slow to import and only needed here)
+        from datasets import Dataset
+
         turns = self.db.review_games()
         dataset = Dataset.from_list(
             [turn.dict() for turn in turns],
@@ -210,4 +638,23 @@ class HfDatasetView(BaseView):
             repo_id=repo_id,
             token=settings.hf_api_token,
         )
-        return RedirectResponse(url=request.url_for("admin:index"), status_code=303)
+        return f"{len(turns)} turns pushed"
+
+
+class JobsView(BaseView):
+    name = "Background jobs"
+    icon = "fa-list-check"
+
+    @expose("/jobs", identity="jobs", methods=["GET"])
+    @login_required
+    async def jobs(self, request):
+        recent = jobs.recent()
+        return self.templates.TemplateResponse(
+            "jobs.html",
+            {
+                "request": request,
+                "jobs": recent,
+                # (reload the page until they're all finished)
+                "refresh": any(job.active for job in recent),
+            },
+        )
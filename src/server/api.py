@@ -0,0 +1,139 @@
+"""
+Lean JSON API for programmatic clients (and load tests), alongside the Gradio UI.
+
+Authenticated like the `/play/{username}:{password}` mount, with credentials in
+the path. Mounted under `/api/{username}:{password}`:
+
+    POST /games                          -> {"game_id", "max_questions"}
+    GET  /games/{game_id}                -> game state
+    POST /games/{game_id}/questions      {"question": str, "turn_id": str?}
+                                         -> turn outcome
+    GET  /games/{game_id}/transcript     -> chat history, to resync a client
+"""
+from collections.abc import Awaitable, Callable
+from dataclasses import asdict
+from functools import wraps
+
+from pydantic import BaseModel, ValidationError, constr
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Route
+
+from twentyqs.controller import (
+    AuthError,
+    GameController,
+    GameFinished,
+    TurnInProgress,
+    outcome_to_json,
+)
+from twentyqs.repository import NotFound, User
+from twentyqs.types import GameState
+from twentyqs.ui import rebuild_transcript
+
+
+class QuestionIn(BaseModel):
+    question: constr(strip_whitespace=True, min_length=1, max_length=500)  # type: ignore
+    # if given, re-sending the question with the same turn_id is safe: the
+    # original outcome is returned rather than playing the turn again
+    turn_id: constr(min_length=1, max_length=64) | None = None  # type: ignore
+
+
+class ApiError(Exception):
+    def __init__(self, status_code: int, detail: str):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+
+
+def api_endpoint(
+    func: Callable[[Request, GameController, User], Awaitable[dict]]
+) -> Callable[[Request], Awaitable[Response]]:
+    """
+    Authenticates the player from the path and renders the result (or error)
+    as JSON. The controller is blocking, so is called in the threadpool.
+    """
+
+    @wraps(func)
+    async def endpoint(request: Request) -> Response:
+        controller: GameController = request.app.state.controller
+        try:
+            user = await run_in_threadpool(
+                controller.authenticate,
+                request.path_params["username"],
+                request.path_params["password"],
+            )
+            return JSONResponse(await func(request, controller, user))
+        except AuthError as e:
+            return JSONResponse({"error": str(e)}, status_code=401)
+        except ApiError as e:
+            return JSONResponse({"error": e.detail}, status_code=e.status_code)
+
+    return endpoint
+
+
+async def _get_own_game(
+    request: Request, controller: GameController, user: User
+) -> GameState:
+    try:
+        state = await run_in_threadpool(
+            controller.get_game, request.path_params["game_id"]
+        )
+    except NotFound:
+        raise ApiError(404, "No such game")
+    if state.username != user.username:
+        # (don't reveal other players' games exist)
+        raise ApiError(404, "No such game")
+    return state
+
+
+@api_endpoint
+async def start_game(request: Request, controller: GameController, user: User):
+    begun = await run_in_threadpool(controller.start_game, user.username)
+    return asdict(begun)
+
+
+@api_endpoint
+async def get_game(request: Request, controller: GameController, user: User):
+    state = await _get_own_game(request, controller, user)
+    return {
+        "game_id": state.game_id,
+        "questions_asked": state.questions_asked,
+        "questions_remaining": controller.max_questions - state.questions_asked,
+        "finished": state.finished,
+        # (the secret is only revealed once the game is over)
+        **({"subject": state.subject} if state.finished else {}),
+    }
+
+
+@api_endpoint
+async def ask_question(request: Request, controller: GameController, user: User):
+    try:
+        body = QuestionIn.parse_raw(await request.body())
+    except ValidationError as e:
+        raise ApiError(400, str(e))
+    state = await _get_own_game(request, controller, user)
+    try:
+        outcome = await run_in_threadpool(
+            controller.take_turn, state.game_id, body.question, body.turn_id
+        )
+    except GameFinished:
+        raise ApiError(409, "Game is finished")
+    except TurnInProgress:
+        raise ApiError(409, "Turn is still in progress")
+    return outcome_to_json(outcome)
+
+
+@api_endpoint
+async def get_transcript(request: Request, controller: GameController, user: User):
+    state = await _get_own_game(request, controller, user)
+    transcript = await run_in_threadpool(rebuild_transcript, controller, state.game_id)
+    return {"rows": transcript.full()}
+
+
+routes = [
+    Route("/games", start_game, methods=["POST"]),
+    Route("/games/{game_id:int}", get_game, methods=["GET"]),
+    Route("/games/{game_id:int}/questions", ask_question, methods=["POST"]),
+    Route("/games/{game_id:int}/transcript", get_transcript, methods=["GET"]),
+]
@@ -1,20 +1,29 @@
 import logging
 from contextlib import asynccontextmanager
+from datetime import timedelta
 from pathlib import Path
 
 import gradio as gr
-from alembic.config import Config
-from alembic import command
 from starlette.applications import Starlette
-from starlette.routing import Route
+from starlette.routing import Mount, Route
 from starlette.templating import Jinja2Templates
 
-from twentyqs.runner import get_view
+from twentyqs import llms
+from twentyqs.archive import TurnLogArchive, TurnLogArchiver
+from twentyqs.backfill import BackfillRunner
+from twentyqs.resilience import ResilienceConfig
+from twentyqs.runner import get_controller, get_view
+from twentyqs.ui import QueueConfig
 
+from . import api
 from .admin import (
     Admin,
+    BackfillView,
     DbFileView,
     HfDatasetView,
+    JobsView,
+    SearchView,
+    StageLatencyView,
     GameSessionAdmin,
     TurnAdmin,
     TurnLogAdmin,
@@ -23,54 +32,146 @@ from .admin import (
 from .auth import AdminAuth
 from .config import settings
 from .repository import Repository
+from .startup import PhaseTimer, baked_head_revision, db_is_current, upgrade_db
 
 templates = Jinja2Templates(directory=Path(__file__).parent / "templates" / "twentyqs")
 
 
 logging.basicConfig(level=logging.getLevelName(settings.log_level))
+logger = logging.getLogger(__name__)
 
 
 @asynccontextmanager
 async def lifespan(app: Starlette):
-    if settings.migrate_db:
-        # fly.io attaches volumes too late to use `deploy` command to run migrations
-        alembic_cfg = Config(settings.alembic_config)
-        alembic_cfg.attributes["configure_logger"] = False
-        command.upgrade(alembic_cfg, "head")
+    timer = PhaseTimer()
+
+    with timer.phase("migrations"):
+        # (if the db is already at the head revision baked in at build time we
+        # can skip alembic and `create_all` entirely)
+        db_current = db_is_current(settings.db_path, baked_head_revision())
+        if settings.migrate_db and not db_current:
+            # fly.io attaches volumes too late to use `deploy` command to run migrations
+            upgrade_db(settings.alembic_config)
+
+    archive = TurnLogArchive(
+        settings.turnlog_archive_dir
+        or Path(settings.db_path).parent / "turnlog-archive"
+    )
 
-    db = Repository(db_path=settings.db_path)
-    db.init_db(drop=False)
+    with timer.phase("init_db"):
+        db = Repository(
+            db_path=settings.db_path,
+            auth_cache_ttl=settings.auth_cache_ttl,
+            archive=archive,
+        )
+        db.init_db(drop=False, create_tables=not db_current)
 
-    # the game ui
-    blocks = get_view(
+    backfills = BackfillRunner(
         repository=db,
-        openai_model=settings.openai_model,
-        simple_subject_picker=settings.simple_subject_picker,
-        verbose_langchain=settings.verbose_langchain,
-        # auth_callback=db.authenticate_player if settings.require_login else None,
+        batch_size=settings.backfill_batch_size,
+        duty_cycle=settings.backfill_duty_cycle,
     )
-    blocks.show_api = False
-    gr.mount_gradio_app(app, blocks, path="/play/{username}:{password}")
-
-    # admin site
-    admin = Admin(
-        app=app,
-        engine=db.engine,
-        authentication_backend=AdminAuth(
+    if settings.backfill_enabled:
+        backfills.start()
+
+    archiver = None
+    if settings.turnlog_retention_days is not None:
+        archiver = TurnLogArchiver(
             repository=db,
-            secret_key=settings.secret_key,
-        ),
-        templates_dir=str(Path(__file__).parent / "templates" / "sqladmin"),
-    )
-    admin.add_view(UserAdmin)
-    admin.add_view(GameSessionAdmin)
-    admin.add_view(TurnAdmin)
-    admin.add_view(TurnLogAdmin)
-    admin.add_view(DbFileView)
-    admin.add_view(HfDatasetView)
+            archive=archive,
+            retention=timedelta(days=settings.turnlog_retention_days),
+            interval=settings.turnlog_archive_interval,
+        )
+        archiver.start()
+
+    with timer.phase("controller"):
+        controller = get_controller(
+            repository=db,
+            openai_model=settings.openai_model,
+            simple_subject_picker=settings.simple_subject_picker,
+            verbose_langchain=settings.verbose_langchain,
+            stream_answers=settings.stream_answers,
+            rule_based_validation=settings.rule_based_validation,
+            prewarm_questions=settings.prewarm_questions,
+            resilience=(
+                ResilienceConfig(
+                    turn_budget=settings.turn_budget,
+                    call_timeout=settings.llm_call_timeout,
+                    max_attempts=settings.llm_max_attempts,
+                    hedge=settings.hedge_requests,
+                )
+                if settings.turn_budget
+                else None
+            ),
+            route_models={
+                llms.Route.PICK_SUBJECT: settings.pick_subject_model,
+                llms.Route.VALIDATE: settings.validate_model,
+                llms.Route.ANSWER: settings.answer_model,
+                llms.Route.DECIDING: settings.deciding_model,
+            },
+            batch_window=settings.batch_window_ms / 1000,
+            max_active_games=settings.max_active_games,
+            active_game_ttl=settings.active_game_ttl,
+        )
+        # for the json api
+        app.state.controller = controller
+
+    with timer.phase("ui"):
+        # the game ui
+        blocks = get_view(
+            controller,
+            stream_answers=settings.stream_answers,
+            queue=(
+                QueueConfig(
+                    concurrency_count=settings.queue_concurrency,
+                    max_size=settings.queue_max_size,
+                    start_game_concurrency=settings.start_game_concurrency,
+                    turn_concurrency=settings.turn_concurrency,
+                    admission_timeout=settings.admission_timeout,
+                )
+                if settings.queue_enabled
+                else None
+            ),
+            # auth_callback=db.authenticate_player if settings.require_login else None,
+        )
+        blocks.show_api = False
+        gr.mount_gradio_app(app, blocks, path="/play/{username}:{password}")
+        if blocks.enable_queue:
+            # mount_gradio_app starts the queue from a startup event handler, which
+            # Starlette won't run because we're already inside the lifespan
+            blocks.startup_events()
+
+    with timer.phase("admin"):
+        # admin site
+        admin = Admin(
+            app=app,
+            engine=db.engine,
+            archive=archive,
+            authentication_backend=AdminAuth(
+                repository=db,
+                secret_key=settings.secret_key,
+            ),
+            templates_dir=str(Path(__file__).parent / "templates" / "sqladmin"),
+        )
+        admin.add_view(UserAdmin)
+        admin.add_view(GameSessionAdmin)
+        admin.add_view(TurnAdmin)
+        admin.add_view(TurnLogAdmin)
+        admin.add_view(DbFileView)
+        admin.add_view(HfDatasetView)
+        admin.add_view(SearchView)
+        admin.add_view(StageLatencyView)
+        admin.add_view(BackfillView)
+        admin.add_view(JobsView)
+
+    logger.info("startup: %s", timer.report())
 
     yield
 
+    backfills.stop(timeout=5)
+    if archiver is not None:
+        archiver.stop(timeout=5)
+
 
 async def homepage(request):
     return templates.TemplateResponse(
@@ -86,5 +187,6 @@ app = Starlette(
     lifespan=lifespan,
     routes=[
         Route("/", homepage),
+        Mount("/api/{username}:{password}", routes=api.routes),
     ],
 )
@@ -4,6 +4,7 @@ from sqladmin.authentication import AuthenticationBackend
 from starlette.requests import Request
 from starlette.responses import RedirectResponse
 
+from .jobs import run_sync
 from .repository import Repository
 
 
@@ -18,11 +19,9 @@ class AdminAuth(AuthenticationBackend):
     async def login(self, request: Request) -> bool:
         form = await request.form()
         username, password = cast(str, form["username"]), cast(str, form["password"])
-        admin = self.db.get_admin_by_username(username)
+        admin = await run_sync(self.db.authenticated_admin, username, password)
         if not admin:
             return False
-        if not admin.password == password:
-            return False
 
         request.session.update({"adminuser": username})
         return True
@@ -34,7 +33,7 @@ class AdminAuth(AuthenticationBackend):
     async def authenticate(self, request: Request) -> RedirectResponse | None:
         try:
             username = cast(str, request.session["adminuser"])
-            admin = self.db.get_admin_by_username(username)
+            admin = await run_sync(self.db.authenticated_admin, username)
         except KeyError:
             admin = None
         if not admin:
@@ -18,8 +18,60 @@ class Settings(BaseSettings):
     log_level: str = "INFO"
 
     openai_model: str = "gpt-3.5-turbo"
+    # per-chain overrides of `openai_model`
+    pick_subject_model: str | None = None
+    validate_model: str | None = None
+    answer_model: str | None = None
+    deciding_model: str | None = None
     simple_subject_picker: bool = True
     verbose_langchain: bool = False
+    # show the answer as soon as it is generated, before the rest of the turn
+    stream_answers: bool = False
+    # accept/reject obvious yes/no questions without asking the LLM
+    rule_based_validation: bool = False
+    # answer this many of the most common questions in advance for each game
+    prewarm_questions: int = 0
+    # seconds allowed for LLM calls per turn before answering "I don't know"
+    # (also enables retries and optional hedging, unset to disable)
+    turn_budget: float | None = None
+    llm_call_timeout: float = 15.0
+    llm_max_attempts: int = 3
+    hedge_requests: bool = False
+    # collect prompts from concurrent games for this long and send them as a
+    # single request (only for non-chat models, 0 to disable)
+    batch_window_ms: float = 0
+
+    # Gradio queue (enabled regardless if `stream_answers` is set)
+    queue_enabled: bool = False
+    queue_concurrency: int = 4
+    queue_max_size: int | None = 64
+    # max concurrent new games / turns, unset for no limit beyond the queue
+    start_game_concurrency: int | None = None
+    turn_concurrency: int | None = None
+    # seconds to wait for one of the above before replying "server busy"
+    admission_timeout: float = 1.0
+
+    # games kept in memory, idle ones are evicted and reloaded from the db
+    max_active_games: int = 1000
+    active_game_ttl: float | None = 30 * 60
+
+    # data migrations, run in the background in batches after startup
+    backfill_enabled: bool = True
+    backfill_batch_size: int = 1000
+    # fraction of the time spent running batches (the rest is left for the app)
+    backfill_duty_cycle: float = 0.25
+
+    # set to move turn logs older than this many days out of the db into
+    # compressed monthly files in `turnlog_archive_dir` (default: next to the
+    # db), checked every `turnlog_archive_interval` seconds. NB: the archived
+    # logs are deleted from the db, so are no longer in the admin's TurnLog
+    # views or the db download (back up the archive dir too)
+    turnlog_retention_days: int | None = None
+    turnlog_archive_dir: str | None = None
+    turnlog_archive_interval: float = 6 * 60 * 60
+
+    # seconds to cache users' credentials, for admin and player auth (0 to disable)
+    auth_cache_ttl: float = 60
 
     admin_password: str
     # will be used to sign cookies, logins will be invalidated on each restart
@@ -27,6 +79,17 @@ class Settings(BaseSettings):
     secret_key: str = Field(default_factory=secrets.token_urlsafe)
     # require_login: bool = True
 
+    # threads for the admin site's db queries (separate from the games')
+    admin_db_workers: int = 4
+    # rows of a to-many relation shown on a details page (e.g. a user's games),
+    # with a link to the rest
+    admin_detail_relation_limit: int = 20
+
+    # db snapshots for download from the admin site (default: in the temp dir),
+    # reused for up to `snapshot_max_age` seconds
+    snapshot_dir: str | None = None
+    snapshot_max_age: float = 300
+
     # only needed if pushing played games data to HF dataset from admin site
     hf_repo_id: str = "twenty-questions-bot"
     hf_api_token: str = "dummy"
@@ -0,0 +1,110 @@
+"""
+Keeping blocking admin work off the event loop (which also serves the games).
+
+- `run_sync` runs short, blocking calls (db queries) on a small thread pool of
+  their own, so a busy admin can't use up the threads the games need either.
+- `JobRunner` runs long operations (e.g. pushing the dataset to HF) in the
+  background, one at a time, and keeps their status for the admin jobs page.
+"""
+import asyncio
+import itertools
+import logging
+import threading
+from collections import OrderedDict
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from datetime import datetime
+from enum import StrEnum
+from functools import partial
+from typing import Any, TypeVar
+
+from .config import settings
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+_admin_executor = ThreadPoolExecutor(
+    max_workers=settings.admin_db_workers, thread_name_prefix="admin-db"
+)
+
+
+async def run_sync(func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_admin_executor, partial(func, *args, **kwargs))
+
+
+class JobStatus(StrEnum):
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
+
+@dataclass
+class Job:
+    id: int
+    name: str
+    status: JobStatus = JobStatus.PENDING
+    created_at: datetime = field(default_factory=datetime.now)
+    started_at: datetime | None = None
+    finished_at: datetime | None = None
+    # short description of the outcome (or the error)
+    result: str | None = None
+
+    @property
+    def active(self) -> bool:
+        return self.status in (JobStatus.PENDING, JobStatus.RUNNING)
+
+
+class JobRunner:
+    """
+    Runs jobs one at a time in a background thread, remembering the last
+    `keep` of them (in memory, so they are forgotten on restart).
+    """
+
+    def __init__(self, keep: int = 50):
+        self.keep = keep
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="job")
+        self._jobs: OrderedDict[int, Job] = OrderedDict()
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def submit(self, name: str, func: Callable[[], str | None]) -> Job:
+        """
+        `func` may return a short description of the outcome, for the status page.
+        """
+        job = Job(id=next(self._ids), name=name)
+        with self._lock:
+            self._jobs[job.id] = job
+            while len(self._jobs) > self.keep:
+                oldest = next(iter(self._jobs.values()))
+                if oldest.active:
+                    break
+                self._jobs.popitem(last=False)
+        self._executor.submit(self._run, job, func)
+        return job
+
+    def _run(self, job: Job, func: Callable[[], str | None]) -> None:
+        job.status = JobStatus.RUNNING
+        job.started_at = datetime.now()
+        try:
+            job.result = func()
+            job.status = JobStatus.DONE
+        except Exception as e:
+            logger.exception("Job %s (%d) failed", job.name, job.id)
+            job.result = f"{type(e).__name__}: {e}"
+            job.status = JobStatus.FAILED
+        finally:
+            job.finished_at = datetime.now()
+
+    def get(self, job_id: int) -> Job | None:
+        return self._jobs.get(job_id)
+
+    def recent(self) -> list[Job]:
+        with self._lock:
+            return list(reversed(self._jobs.values()))
+
+
+jobs = JobRunner()
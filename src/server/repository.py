@@ -10,9 +10,9 @@ logger = logging.getLogger(__name__)
 
 
 class Repository(BaseRepository):
-    def init_db(self, drop=False):
+    def init_db(self, drop=False, create_tables=True):
         # TODO: this could be an alembic migration now
-        super().init_db(drop=drop)
+        super().init_db(drop=drop, create_tables=create_tables)
         with Session(self.engine) as session:
             session.exec(
                 insert(User)
@@ -0,0 +1,220 @@
+"""
+Consistent, compressed snapshots of the SQLite db, for downloading from the
+admin site.
+
+Rather than sending the live db file (which may be torn mid-write, and in WAL
+mode is missing whatever is still in the `-wal` file) we take a copy through
+SQLite itself, gzip it, and serve that with Range support so that large
+downloads can be resumed.
+
+(if `turnlog_retention_days` is set, the logs of older turns are no longer in
+the db but in the archive files, see `twentyqs.archive`, which aren't included)
+"""
+import gzip
+import re
+import shutil
+import sqlite3
+import tempfile
+import threading
+from collections.abc import Iterator
+from dataclasses import dataclass
+from datetime import datetime
+from pathlib import Path
+
+from starlette.requests import Request
+from starlette.responses import Response, StreamingResponse
+
+CHUNK_SIZE = 256 * 1024
+
+_RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+@dataclass(frozen=True)
+class Snapshot:
+    path: Path
+    created_at: datetime
+    size: int
+
+    @property
+    def name(self) -> str:
+        return self.path.name
+
+    @property
+    def etag(self) -> str:
+        return f'"{self.path.stem}-{self.size}"'
+
+
+def copy_db(db_path: str, dest: Path, pages: int = 1024, sleep: float = 0.01) -> None:
+    """
+    Take a consistent copy of the db.
+
+    In WAL mode `VACUUM INTO` reads from a single snapshot without blocking
+    writers. Otherwise a read would block writers for the whole copy, so we use
+    the online backup API, which copies `pages` at a time and lets writers in
+    between steps (restarting if the db was changed).
+    """
+    src = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    try:
+        (journal_mode,) = src.execute("PRAGMA journal_mode").fetchone()
+        if journal_mode.lower() == "wal":
+            src.execute("VACUUM INTO ?", (str(dest),))
+            return
+        dst = sqlite3.connect(dest)
+        try:
+            src.backup(dst, pages=pages, sleep=sleep)
+        finally:
+            dst.close()
+    finally:
+        src.close()
+
+
+class SnapshotStore:
+    """
+    Keeps the most recent few snapshots in `directory`, taking a new one at
+    most every `max_age` seconds (concurrent requests share it).
+    """
+
+    def __init__(
+        self,
+        db_path: str,
+        directory: str | None = None,
+        max_age: float = 300,
+        keep: int = 2,
+    ):
+        self.db_path = db_path
+        self.directory = Path(
+            directory or Path(tempfile.gettempdir()) / "twentyqs-snapshots"
+        )
+        self.max_age = max_age
+        self.keep = keep
+        self._lock = threading.Lock()
+
+    def _snapshots(self) -> list[Snapshot]:
+        if not self.directory.exists():
+            return []
+        snapshots = []
+        for path in self.directory.glob("*.db.gz"):
+            stat = path.stat()
+            snapshots.append(
+                Snapshot(
+                    path=path,
+                    created_at=datetime.fromtimestamp(stat.st_mtime),
+                    size=stat.st_size,
+                )
+            )
+        return sorted(snapshots, key=lambda s: s.created_at, reverse=True)
+
+    def get(self, name: str) -> Snapshot | None:
+        for snapshot in self._snapshots():
+            if snapshot.name == name:
+                return snapshot
+        return None
+
+    def latest(self) -> Snapshot:
+        """
+        The latest snapshot, taking a new one if it's older than `max_age`.
+        (blocking, call from a thread)
+        """
+        with self._lock:
+            snapshots = self._snapshots()
+            if snapshots:
+                age = (datetime.now() - snapshots[0].created_at).total_seconds()
+                if age < self.max_age:
+                    return snapshots[0]
+            snapshot = self._create()
+            for old in self._snapshots()[self.keep :]:
+                old.path.unlink(missing_ok=True)
+            return snapshot
+
+    def _create(self) -> Snapshot:
+        self.directory.mkdir(parents=True, exist_ok=True)
+        stem = f"{Path(self.db_path).stem}-{datetime.now():%Y%m%dT%H%M%S}"
+        path = self.directory / f"{stem}.db.gz"
+        with tempfile.TemporaryDirectory(dir=self.directory) as tmp:
+            copy = Path(tmp) / f"{stem}.db"
+            copy_db(self.db_path, copy)
+            compressed = Path(tmp) / path.name
+            with open(copy, "rb") as f_in, gzip.open(compressed, "wb") as f_out:
+                shutil.copyfileobj(f_in, f_out, CHUNK_SIZE)
+            # (so that a partial file is never served)
+            compressed.replace(path)
+        stat = path.stat()
+        return Snapshot(
+            path=path,
+            created_at=datetime.fromtimestamp(stat.st_mtime),
+            size=stat.st_size,
+        )
+
+
+def parse_range(header: str, size: int) -> tuple[int, int] | None:
+    """
+    (start, end) inclusive of a single `bytes=` range, or `None` if not
+    satisfiable. Raises `ValueError` if malformed (or multiple ranges), in
+    which case the whole file should be sent.
+    """
+    match = _RANGE_RE.match(header.strip())
+    if not match:
+        raise ValueError(header)
+    first, last = match.groups()
+    if not first and not last:
+        raise ValueError(header)
+    if not first:
+        # suffix range, i.e. the last N bytes
+        length = int(last)
+        if length == 0:
+            return None
+        return max(size - length, 0), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        return None
+    return start, end
+
+
+def read_file(path: Path, start: int, end: int) -> Iterator[bytes]:
+    with open(path, "rb") as f:
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = f.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+def snapshot_response(request: Request, snapshot: Snapshot) -> Response:
+    """
+    Stream the snapshot, or the part of it asked for by a `Range` header (if
+    the `If-Range` validator, when given, still matches).
+    """
+    headers = {
+        "Accept-Ranges": "bytes",
+        "ETag": snapshot.etag,
+        "Content-Disposition": f'attachment; filename="{snapshot.name}"',
+    }
+    start, end = 0, snapshot.size - 1
+    status_code = 200
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if range_header and (if_range is None or if_range == snapshot.etag):
+        try:
+            byte_range = parse_range(range_header, snapshot.size)
+        except ValueError:
+            pass
+        else:
+            if byte_range is None:
+                return Response(
+                    status_code=416,
+                    headers={"Content-Range": f"bytes */{snapshot.size}", **headers},
+                )
+            start, end = byte_range
+            status_code = 206
+            headers["Content-Range"] = f"bytes {start}-{end}/{snapshot.size}"
+    headers["Content-Length"] = str(end - start + 1)
+    return StreamingResponse(
+        read_file(snapshot.path, start, end),
+        status_code=status_code,
+        media_type="application/gzip",
+        headers=headers,
+    )
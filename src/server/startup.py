@@ -0,0 +1,81 @@
+"""
+Startup helpers: deciding whether the db needs migrating, and timing each phase.
+
+The alembic head revision is written to `migrations/HEAD` at build time (by
+`bin/write_db_head.py`, see the Dockerfile). If the revision stored in the db
+matches it we can skip importing alembic and running `create_all` entirely.
+Without the file (e.g. in dev) we always take the slow path.
+"""
+import logging
+import sqlite3
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+HEAD_FILE = Path(__file__).parents[1] / "migrations" / "HEAD"
+
+
+def baked_head_revision(path: Path = HEAD_FILE) -> str | None:
+    try:
+        return path.read_text().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def stored_revision(db_path: str) -> str | None:
+    """
+    The revision in the db's `alembic_version` table, if any.
+
+    (plain sqlite3, read-only, so a missing db isn't created here)
+    """
+    try:
+        conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    except sqlite3.OperationalError:
+        return None
+    try:
+        row = conn.execute("SELECT version_num FROM alembic_version").fetchone()
+    except sqlite3.OperationalError:
+        return None
+    finally:
+        conn.close()
+    return row[0] if row else None
+
+
+def db_is_current(db_path: str, head: str | None) -> bool:
+    return head is not None and stored_revision(db_path) == head
+
+
+def upgrade_db(alembic_config: str) -> None:
+    # (alembic is slow to import, so only when needed)
+    from alembic.config import Config
+    from alembic import command
+
+    alembic_cfg = Config(alembic_config)
+    alembic_cfg.attributes["configure_logger"] = False
+    command.upgrade(alembic_cfg, "head")
+
+
+class PhaseTimer:
+    """
+    Records how long each phase of startup took, for logging.
+    """
+
+    def __init__(self) -> None:
+        self.start = time.perf_counter()
+        self.phases: list[tuple[str, float]] = []
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.perf_counter() - start))
+
+    def report(self) -> str:
+        total = time.perf_counter() - self.start
+        phases = ", ".join(f"{name}: {secs * 1000:.0f}ms" for name, secs in self.phases)
+        return f"{phases} (total: {total * 1000:.0f}ms)"
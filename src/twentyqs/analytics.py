@@ -0,0 +1,222 @@
+"""
+Latency of each stage of a turn, from the timestamps recorded in the `TurnLog`s.
+
+The turns are summarised incrementally into `StageLatency` rows per day, stage
+and model (with a histogram, for percentiles), so the admin page doesn't have
+to scan the logs.
+"""
+import logging
+from bisect import bisect_left
+from collections.abc import Mapping
+from datetime import date, datetime, timedelta
+from enum import StrEnum
+
+from twentyqs.repository import Repository, StageLatency, Turn
+from twentyqs.types import Answer, JsonT, LogKey
+
+logger = logging.getLogger(__name__)
+
+WATERMARK = "stage_latency"
+
+# upper bounds of the histogram buckets, the last bucket is everything above
+BUCKETS_MS = (
+    50,
+    100,
+    200,
+    300,
+    500,
+    750,
+    1000,
+    1500,
+    2000,
+    3000,
+    5000,
+    7500,
+    10000,
+    20000,
+    30000,
+    60000,
+)
+
+# labels for stages which didn't call an LLM, or where we don't know which
+RULES = "(rules)"
+PREWARMED = "(prewarmed)"
+UNKNOWN = "(unknown)"
+NO_MODEL = "-"
+
+
+class Stage(StrEnum):
+    # (values match `types.Route`, to find the model in the game's llm_stats)
+    VALIDATE = "validate"
+    ANSWER = "answer"
+    DECIDING = "deciding"
+    # time spent outside of the stages, i.e. mostly the db
+    DB = "db"
+
+
+def add_sample(summary: StageLatency, ms: float) -> None:
+    if not summary.histogram:
+        summary.histogram = [0] * (len(BUCKETS_MS) + 1)
+    summary.count += 1
+    summary.total_ms += ms
+    summary.max_ms = max(summary.max_ms, ms)
+    summary.histogram[bisect_left(BUCKETS_MS, ms)] += 1
+
+
+def mean_ms(summary: StageLatency) -> float | None:
+    return summary.total_ms / summary.count if summary.count else None
+
+
+def percentile_ms(summary: StageLatency, q: float) -> float | None:
+    """
+    Approximate `q` (0-1) percentile, i.e. the upper bound of its bucket.
+    """
+    if not summary.count:
+        return None
+    rank = q * summary.count
+    seen = 0
+    for i, count in enumerate(summary.histogram):
+        seen += count
+        if seen >= rank and count:
+            bound = BUCKETS_MS[i] if i < len(BUCKETS_MS) else summary.max_ms
+            return min(bound, summary.max_ms)
+    return summary.max_ms
+
+
+def _timestamp(value: JsonT | datetime) -> datetime | None:
+    if isinstance(value, datetime):
+        return value
+    if isinstance(value, str):
+        return datetime.fromisoformat(value)
+    return None
+
+
+def _ms(start: datetime, end: datetime) -> float:
+    # (prewarmed answers were generated before the turn began)
+    return max((end - start).total_seconds() * 1000, 0.0)
+
+
+def route_models(llm_stats: Mapping[str, JsonT] | None) -> dict[str, str]:
+    """
+    The model used for each route in a game, from its `llm_stats`.
+    """
+    routes = (llm_stats or {}).get("routes")
+    if not isinstance(routes, Mapping):
+        return {}
+    models = {}
+    for route, stats in routes.items():
+        model_name = stats.get("model_name") if isinstance(stats, Mapping) else None
+        if isinstance(model_name, str):
+            models[route] = model_name
+    return models
+
+
+def stage_latencies(
+    turn: Turn, models: Mapping[str, str]
+) -> list[tuple[Stage, str, float]]:
+    """
+    (stage, model, milliseconds) for each stage of a finished turn.
+    """
+    values = {log.key: log.value for log in turn.logs}
+    begin = values.get(LogKey.BEGIN_TURN)
+    validate = values.get(LogKey.VALIDATE_QUESTION)
+    if not begin or not validate:
+        return []
+    begin_ts = _timestamp(begin.get("timestamp"))
+    validate_ts = _timestamp(validate.get("timestamp"))
+    if begin_ts is None or validate_ts is None:
+        return []
+
+    samples = [
+        (
+            Stage.VALIDATE,
+            RULES
+            if validate.get("rule_based")
+            else models.get(Stage.VALIDATE, UNKNOWN),
+            _ms(begin_ts, validate_ts),
+        )
+    ]
+    end_ts = validate_ts
+
+    answer = values.get(LogKey.ANSWER_QUESTION)
+    answer_ts = _timestamp(answer.get("timestamp")) if answer else None
+    if answer and answer_ts:
+        samples.append(
+            (
+                Stage.ANSWER,
+                PREWARMED
+                if answer.get("prewarmed")
+                else models.get(Stage.ANSWER, UNKNOWN),
+                _ms(validate_ts, answer_ts),
+            )
+        )
+        end_ts = max(end_ts, answer_ts)
+
+        end_game = values.get(LogKey.IS_DECIDING_QUESTION)
+        end_game_ts = _timestamp(end_game.get("timestamp")) if end_game else None
+        if end_game_ts:
+            # (the LLM is only asked when the answer was yes)
+            if answer.get("answer") == Answer.YES:
+                samples.append(
+                    (
+                        Stage.DECIDING,
+                        models.get(Stage.DECIDING, UNKNOWN),
+                        _ms(max(validate_ts, answer_ts), end_game_ts),
+                    )
+                )
+            end_ts = max(end_ts, end_game_ts)
+
+    if turn.finished_at:
+        total = _ms(turn.started_at, turn.finished_at)
+        samples.append((Stage.DB, NO_MODEL, max(total - _ms(begin_ts, end_ts), 0.0)))
+    return samples
+
+
+def refresh_stage_latency(
+    repository: Repository,
+    batch_size: int = 500,
+    settle: timedelta = timedelta(minutes=5),
+) -> int:
+    """
+    Add the turns played since the last refresh to the `StageLatency` summaries.
+
+    Only turns started more than `settle` ago are summarised, by then any turn
+    not finished has been abandoned (and is skipped). The refresh stops at the
+    first turn which isn't, so that it's summarised by a later refresh.
+
+    Returns the number of turns processed.
+    """
+    processed = 0
+    while True:
+        last_id = repository.get_watermark(WATERMARK)
+        turns = repository.get_turns_after(
+            after_id=last_id,
+            started_before=datetime.now() - settle,
+            limit=batch_size,
+        )
+        if not turns:
+            break
+
+        summaries: dict[tuple[date, str, str], StageLatency] = {}
+        for turn, llm_stats in turns:
+            if turn.finished_at is None:
+                continue
+            models = route_models(llm_stats)
+            for stage, model, ms in stage_latencies(turn, models):
+                key = (turn.started_at.date(), stage.value, model)
+                if key not in summaries:
+                    summaries[key] = StageLatency(day=key[0], stage=key[1], model=model)
+                add_sample(summaries[key], ms)
+
+        to_id = turns[-1][0].id
+        assert to_id is not None
+        if not repository.add_stage_latency(
+            list(summaries.values()), WATERMARK, from_id=last_id, to_id=to_id
+        ):
+            logger.info("refresh_stage_latency: refreshed concurrently, stopping")
+            break
+        processed += len(turns)
+
+    if processed:
+        logger.info("refresh_stage_latency: summarised %d turns", processed)
+    return processed
@@ -0,0 +1,276 @@
+"""
+Retention for the `TurnLog`s, which are most of the db.
+
+Once a turn is older than the retention period its logs are moved out of the
+db into compressed archive files, one per month (of the turns' `started_at`),
+of gzipped JSON lines. The turns themselves stay in the db, and the reviews
+(`Repository.review_game(s)`) read the logs of archived turns back from the
+archive.
+
+A run first appends the logs to the month files (each written to a temp file
+and renamed over the original, so never left half written), then deletes them
+from the db in batches, moving the `turnlog_archive` watermark on (the last
+turn id archived) in the same transaction. If interrupted in between, the
+turns are archived again by the next run, and the duplicate logs are skipped
+on reading.
+
+The logs are also read by the stage latency summaries and the backfills, so
+the summaries are brought up to date first, and nothing is archived while a
+backfill is unfinished.
+"""
+import gzip
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from collections import defaultdict
+from collections.abc import Iterator, Mapping
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import IO, Any
+
+from twentyqs import analytics
+from twentyqs.backfill import BACKFILLS
+from twentyqs.repository import Repository, TurnLog
+from twentyqs.serde import deserialize, serialize
+from twentyqs.types import JsonT
+
+logger = logging.getLogger(__name__)
+
+WATERMARK = "turnlog_archive"
+
+
+def month_of(ts: datetime) -> str:
+    return f"{ts:%Y-%m}"
+
+
+def log_record(log: TurnLog) -> dict[str, JsonT]:
+    return {
+        "id": log.id,
+        "turn_id": log.turn_id,
+        "timestamp": log.timestamp,  # type: ignore
+        "key": log.key,
+        "value": log.value,
+    }
+
+
+class TurnLogArchive:
+    """
+    The month files, `turnlog-YYYY-MM.jsonl.gz` in `directory`.
+    """
+
+    def __init__(self, directory: str | Path):
+        self.directory = Path(directory)
+
+    def path(self, month: str) -> Path:
+        return self.directory / f"turnlog-{month}.jsonl.gz"
+
+    def months(self) -> list[str]:
+        if not self.directory.exists():
+            return []
+        return sorted(
+            path.name.removeprefix("turnlog-").removesuffix(".jsonl.gz")
+            for path in self.directory.glob("turnlog-*.jsonl.gz")
+        )
+
+    def read(self, month: str) -> Iterator[dict[str, Any]]:
+        path = self.path(month)
+        if not path.exists():
+            return
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            for line in f:
+                yield deserialize(line)
+
+    def get_logs(self, turns: Mapping[int, datetime]) -> dict[int, list[dict]]:
+        """
+        The archived logs of `turns` (their `started_at` by id, to find the
+        month), by turn id, in log id order.
+
+        (scans the whole month file, so best asked for many turns at once)
+        """
+        months: dict[str, set[int]] = defaultdict(set)
+        for turn_id, started_at in turns.items():
+            months[month_of(started_at)].add(turn_id)
+        found: dict[int, dict[int, dict]] = defaultdict(dict)
+        for month, turn_ids in months.items():
+            for record in self.read(month):
+                if record["turn_id"] in turn_ids:
+                    # (by id, as an interrupted run can archive a log twice)
+                    found[record["turn_id"]][record["id"]] = record
+        return {
+            turn_id: [logs[log_id] for log_id in sorted(logs)]
+            for turn_id, logs in found.items()
+        }
+
+    @contextmanager
+    def writer(self) -> Iterator["ArchiveWriter"]:
+        """
+        Appends to the month files when the block exits (and not at all if it
+        raises).
+        """
+        writer = ArchiveWriter(self)
+        try:
+            yield writer
+        except BaseException:
+            writer.discard()
+            raise
+        writer.commit()
+
+
+class ArchiveWriter:
+    """
+    Each month file written to is copied to a temp file, the new logs added to
+    it as another gzip member (gzip files can be concatenated) and, on
+    `commit`, renamed over the original.
+    """
+
+    def __init__(self, archive: TurnLogArchive):
+        self.archive = archive
+        self._files: dict[str, tuple[IO[bytes], gzip.GzipFile]] = {}
+        self.written = 0
+
+    def write(self, month: str, record: dict[str, JsonT]) -> None:
+        if month not in self._files:
+            self._files[month] = self._open(month)
+        _, gz = self._files[month]
+        gz.write(serialize(record).encode("utf-8") + b"\n")
+        self.written += 1
+
+    def _open(self, month: str) -> tuple[IO[bytes], gzip.GzipFile]:
+        self.archive.directory.mkdir(parents=True, exist_ok=True)
+        tmp = tempfile.NamedTemporaryFile(
+            dir=self.archive.directory, suffix=".tmp", delete=False
+        )
+        path = self.archive.path(month)
+        if path.exists():
+            with open(path, "rb") as f:
+                shutil.copyfileobj(f, tmp)
+        return tmp, gzip.GzipFile(fileobj=tmp, mode="wb")
+
+    def commit(self) -> None:
+        for month, (tmp, gz) in self._files.items():
+            gz.close()
+            tmp.flush()
+            os.fsync(tmp.fileno())
+            tmp.close()
+            os.replace(tmp.name, self.archive.path(month))
+        self._files.clear()
+
+    def discard(self) -> None:
+        for tmp, gz in self._files.values():
+            gz.close()
+            tmp.close()
+            os.unlink(tmp.name)
+        self._files.clear()
+
+
+class TurnLogArchiver:
+    """
+    Archives the logs of the turns started more than `retention` ago, every
+    `interval` seconds, in a background thread.
+
+    Each run archives up to `max_turns` (deleting them from the db
+    `batch_size` at a time), and is followed straight away by another while
+    there's a backlog.
+    """
+
+    def __init__(
+        self,
+        repository: Repository,
+        archive: TurnLogArchive,
+        retention: timedelta = timedelta(days=90),
+        interval: float = 6 * 60 * 60,
+        batch_size: int = 500,
+        max_turns: int = 50_000,
+    ):
+        if retention < timedelta(days=1):
+            raise ValueError("retention must be at least a day")
+        self.repository = repository
+        self.archive = archive
+        self.retention = retention
+        self.interval = interval
+        self.batch_size = batch_size
+        self.max_turns = max_turns
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self.run, name="archiver", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float | None = None) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def run(self) -> None:
+        while not self._stop.is_set():
+            try:
+                archived = self.run_once()
+            except Exception:
+                logger.exception("Archiving turn logs failed")
+                archived = 0
+            if archived < self.max_turns:
+                self._stop.wait(self.interval)
+
+    def backfills_pending(self) -> bool:
+        finished = {
+            progress.name
+            for progress in self.repository.get_backfill_progress()
+            if progress.finished_at
+        }
+        return any(backfill.name not in finished for backfill in BACKFILLS)
+
+    def run_once(self) -> int:
+        """
+        Returns the number of turns archived.
+        """
+        if self.backfills_pending():
+            logger.info("Archiving turn logs: waiting for the backfills to finish")
+            return 0
+        # (they're summarised from the logs)
+        analytics.refresh_stage_latency(self.repository)
+
+        started_before = datetime.now() - self.retention
+        last_id = self.repository.get_watermark(WATERMARK)
+        batches: list[tuple[int, int, list[int]]] = []
+        with self.archive.writer() as writer:
+            from_id = last_id
+            archived = 0
+            while archived < self.max_turns and not self._stop.is_set():
+                turns = self.repository.get_turns_after(
+                    after_id=from_id,
+                    started_before=started_before,
+                    limit=min(self.batch_size, self.max_turns - archived),
+                )
+                if not turns:
+                    break
+                turn_ids = []
+                for turn, _ in turns:
+                    assert turn.id is not None
+                    for log in turn.logs:
+                        writer.write(month_of(turn.started_at), log_record(log))
+                    turn_ids.append(turn.id)
+                batches.append((from_id, turn_ids[-1], turn_ids))
+                from_id = turn_ids[-1]
+                archived += len(turn_ids)
+        if not batches:
+            return 0
+
+        archived = 0
+        for from_id, to_id, turn_ids in batches:
+            if not self.repository.delete_archived_turn_logs(
+                turn_ids, WATERMARK, from_id=from_id, to_id=to_id
+            ):
+                logger.info("Archiving turn logs: archived concurrently, stopping")
+                break
+            archived += len(turn_ids)
+        logger.info(
+            "Archived the logs of %d turns (%d logs, up to turn id %d)",
+            archived,
+            writer.written,
+            batches[-1][1],
+        )
+        return archived
@@ -0,0 +1,178 @@
+"""
+Data backfills, run in the background in small batches after a schema change.
+
+Migrations should only change the schema (cheap, so fine at boot) and leave
+filling in the data to a `Backfill` registered in `BACKFILLS`. Each batch
+updates the rows in an id range and checkpoints its progress in the same
+transaction, so the db is never locked for long and a restart resumes where
+it left off. Between batches the runner sleeps, to keep to its duty cycle.
+
+Backfill statements must be idempotent (e.g. only touch rows still missing the
+new data), since they also run over databases migrated before the backfill
+existed, and in case the checkpoint is lost.
+"""
+import logging
+import threading
+import time
+from dataclasses import dataclass
+
+from twentyqs.repository import BackfillProgress, Repository
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class Backfill:
+    name: str
+    # the table whose `id`s the batches range over
+    table: str
+    # SQL to update the rows with :start < id <= :end
+    statement: str
+
+
+BACKFILLS = [
+    # (for migration ccb8d5e9d843)
+    Backfill(
+        name="turn_questions_asked",
+        table="turn",
+        statement="""
+        UPDATE turn
+        SET
+            questions_asked = log.questions_asked,
+            questions_remaining = log.questions_remaining
+        FROM (
+            SELECT
+                turn_id,
+                json_extract("value", '$.questions_asked') AS questions_asked,
+                json_extract("value", '$.questions_remaining') AS questions_remaining
+            FROM turnlog
+            WHERE key = 'BEGIN_TURN' AND turn_id > :start AND turn_id <= :end
+        ) AS log
+        WHERE
+            turn.id = log.turn_id
+            AND turn.questions_asked IS NULL
+            -- (only older logs have the values)
+            AND log.questions_asked IS NOT NULL
+        """,
+    ),
+    # (for migration 7f3d9e21c6b0, see `repository.TURN_SEARCH_DDL`)
+    Backfill(
+        name="turn_search",
+        table="turn",
+        statement="""
+        INSERT INTO turn_search (rowid, question, subject, reason)
+        SELECT
+            turn.id,
+            turn.question,
+            gamesession.subject,
+            (
+                SELECT json_extract(turnlog.value, '$.reason')
+                FROM turnlog
+                WHERE turnlog.turn_id = turn.id AND turnlog.key = 'VALIDATE_QUESTION'
+                ORDER BY turnlog.id DESC
+                LIMIT 1
+            )
+        FROM turn
+        JOIN gamesession ON gamesession.id = turn.gamesession_id
+        WHERE
+            turn.id > :start AND turn.id <= :end
+            -- (turns created since the migration are indexed by the triggers)
+            AND turn.id NOT IN (
+                SELECT rowid FROM turn_search WHERE rowid > :start AND rowid <= :end
+            )
+        """,
+    ),
+]
+
+
+def percent_done(progress: BackfillProgress) -> float:
+    if progress.finished_at or not progress.max_id:
+        return 100.0
+    return min(progress.last_id / progress.max_id * 100, 100.0)
+
+
+class BackfillRunner:
+    """
+    Runs the pending backfills one after another, in a background thread.
+
+    `duty_cycle` is the fraction of the time spent running batches, e.g. at
+    0.25 a batch which took 50ms is followed by a 150ms pause.
+    """
+
+    def __init__(
+        self,
+        repository: Repository,
+        backfills: list[Backfill] = BACKFILLS,
+        batch_size: int = 1000,
+        duty_cycle: float = 0.25,
+        report_every: float = 30.0,
+    ):
+        if not 0 < duty_cycle <= 1:
+            raise ValueError("duty_cycle must be in (0, 1]")
+        self.repository = repository
+        self.backfills = backfills
+        self.batch_size = batch_size
+        self.duty_cycle = duty_cycle
+        self.report_every = report_every
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self.run, name="backfill", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float | None = None) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def run(self) -> None:
+        for backfill in self.backfills:
+            if self._stop.is_set():
+                return
+            try:
+                self.run_backfill(backfill)
+            except Exception:
+                # (retried from the checkpoint on the next restart)
+                logger.exception("Backfill %s failed", backfill.name)
+
+    def run_backfill(self, backfill: Backfill) -> None:
+        progress: BackfillProgress | None = self.repository.start_backfill(
+            backfill.name, backfill.table
+        )
+        if progress is None or progress.finished_at:
+            return
+        logger.info(
+            "Backfill %s: starting from id %d of %d",
+            backfill.name,
+            progress.last_id,
+            progress.max_id,
+        )
+        last_report = time.monotonic()
+        while not self._stop.is_set():
+            start = progress.last_id
+            end = min(start + self.batch_size, progress.max_id)
+            began = time.monotonic()
+            progress = self.repository.run_backfill_batch(
+                backfill.name, backfill.statement, start, end
+            )
+            elapsed = time.monotonic() - began
+            if progress is None:
+                logger.info("Backfill %s: running elsewhere, stopping", backfill.name)
+                return
+            if progress.finished_at:
+                logger.info(
+                    "Backfill %s: finished, %d rows updated",
+                    backfill.name,
+                    progress.rows_updated,
+                )
+                return
+            if time.monotonic() - last_report >= self.report_every:
+                logger.info(
+                    "Backfill %s: %.1f%% done, %d rows updated",
+                    backfill.name,
+                    percent_done(progress),
+                    progress.rows_updated,
+                )
+                last_report = time.monotonic()
+            self._stop.wait(elapsed * (1 - self.duty_cycle) / self.duty_cycle)
@@ -0,0 +1,127 @@
+import logging
+import time
+from collections.abc import Hashable
+from concurrent.futures import Future
+from contextlib import nullcontext
+from dataclasses import dataclass, field
+from threading import Lock
+
+from langchain.schema import BaseLanguageModel, LLMResult, PromptValue
+
+from twentyqs.llms import (
+    Route,
+    current_route,
+    llm_key,
+    supports_batching,
+    using_route,
+)
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class _PendingPrompt:
+    prompt: PromptValue
+    route: Route | None
+    future: Future[LLMResult] = field(default_factory=Future)
+
+
+class MicroBatcher:
+    """
+    Collects single-prompt LLM calls made concurrently (e.g. from different
+    games) over a short `window` and sends them as one multi-prompt `generate`
+    request, then hands each caller back its own result.
+
+    Prompts are batched per LLM, stop sequence and `Route`, so the usage of a
+    batch (only reported for the request as a whole) can be put down to its
+    route by `RouteStatsHandler`. LLMs which can't take many prompts per
+    request (see `supports_batching`) are called directly.
+
+    The first caller into an empty batch waits out the window and then sends
+    it, unless it fills up to `max_batch_size` first, in which case the caller
+    that filled it sends it immediately.
+    """
+
+    window: float
+    max_batch_size: int
+
+    def __init__(self, window: float = 0.005, max_batch_size: int = 20):
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self._lock = Lock()
+        self._batches: dict[Hashable, list[_PendingPrompt]] = {}
+        self.requests = 0
+        self.prompts = 0
+
+    def generate(
+        self,
+        llm: BaseLanguageModel,
+        prompt: PromptValue,
+        stop: list[str] | None = None,
+    ) -> LLMResult:
+        if not supports_batching(llm):
+            return llm.generate_prompt([prompt], stop)
+
+        route = current_route()
+        key = (llm_key(llm), tuple(stop) if stop else None, route)
+        pending = _PendingPrompt(prompt=prompt, route=route)
+        to_send = None
+        with self._lock:
+            batch = self._batches.get(key)
+            leader = batch is None
+            if batch is None:
+                batch = self._batches[key] = []
+            batch.append(pending)
+            if len(batch) >= self.max_batch_size:
+                to_send = self._pop(key, batch)
+
+        if to_send is None and leader:
+            time.sleep(self.window)
+            with self._lock:
+                to_send = self._pop(key, batch)
+        if to_send:
+            self._send(llm, stop, to_send)
+        return pending.future.result()
+
+    def _pop(
+        self, key: Hashable, batch: list[_PendingPrompt]
+    ) -> list[_PendingPrompt] | None:
+        # (must hold the lock) may have been sent already when it filled up
+        if self._batches.get(key) is batch:
+            del self._batches[key]
+            return batch
+        return None
+
+    def _send(
+        self,
+        llm: BaseLanguageModel,
+        stop: list[str] | None,
+        batch: list[_PendingPrompt],
+    ) -> None:
+        logger.debug("MicroBatcher._send: %d prompts", len(batch))
+        # (all the same, see `generate`)
+        route = batch[0].route
+        with self._lock:
+            self.requests += 1
+            self.prompts += len(batch)
+        try:
+            with using_route(route) if route else nullcontext():
+                result = llm.generate_prompt([p.prompt for p in batch], stop)
+        except BaseException as e:
+            for pending in batch:
+                pending.future.set_exception(e)
+            return
+        for pending, generations in zip(batch, result.generations):
+            pending.future.set_result(
+                LLMResult(generations=[generations], llm_output=result.llm_output)
+            )
+
+    def get_stats(self) -> dict[str, int | float | None]:
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "prompts": self.prompts,
+                "avg_batch_size": (
+                    self.prompts / self.requests if self.requests else None
+                ),
+            }
@@ -1,16 +1,26 @@
 import logging
 import random
 import warnings
+from collections.abc import Callable, Iterator
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import replace
 from datetime import datetime
-from typing import cast
+from itertools import count
+from queue import Empty, Queue
+from threading import Lock
+from typing import TypeVar, cast
 
 from langchain import OpenAI
 from langchain.schema import BaseLanguageModel
 
+from twentyqs.batching import MicroBatcher
 from twentyqs.chains.answer_question import (
     AnswerQuestionChain,
     Answer,
+    AnswerQuestionOutputParser,
     ParsedT as AnswerParsedT,
+    parse_streamed_answer,
 )
 from twentyqs.chains.deciding_question import (
     IsDecidingQuestionChain,
@@ -28,6 +38,21 @@ from twentyqs.chains.pick_subject import (
     PLACE_CATEGORIES,
     SIMPLE_CATEGORY,
 )
+from twentyqs.llms import (
+    LLMRouter,
+    Route,
+    generate_many,
+    using_route,
+    with_current_stats,
+)
+from twentyqs.resilience import (
+    DeadlineExceeded,
+    ResilientInvoker,
+    TRANSIENT_ERRORS,
+    TurnBudget,
+)
+from twentyqs.rules import classify_question, normalize_question
+from twentyqs.streaming import TokenCallbackT, token_sink
 from twentyqs.types import (
     TurnBegin,
     TurnSummaryT,
@@ -41,6 +66,43 @@ from twentyqs.types import (
 
 logger = logging.getLogger(__name__)
 
+_prewarm_executor = ThreadPoolExecutor(thread_name_prefix="prewarm")
+
+PrewarmedT = Future[dict[str, TurnAnswer]]
+
+# pre-generated answers by subject, shared by all games (an `AnswerBot` only
+# lives for a single request)
+_prewarmed: OrderedDict[str, PrewarmedT] = OrderedDict()
+_prewarmed_lock = Lock()
+PREWARMED_MAX_SUBJECTS = 256
+
+
+def _store_prewarmed(subject: str, prewarmed: PrewarmedT) -> None:
+    with _prewarmed_lock:
+        _prewarmed[subject] = prewarmed
+        _prewarmed.move_to_end(subject)
+        while len(_prewarmed) > PREWARMED_MAX_SUBJECTS:
+            _prewarmed.popitem(last=False)
+
+
+def _get_prewarmed(subject: str) -> PrewarmedT | None:
+    with _prewarmed_lock:
+        return _prewarmed.get(subject)
+
+
+def _discard_prewarmed(subject: str, prewarmed: PrewarmedT) -> None:
+    with _prewarmed_lock:
+        if _prewarmed.get(subject) is prewarmed:
+            del _prewarmed[subject]
+
+
+T = TypeVar("T")
+
+# errors we recover from when a turn budget is in use
+FALLBACK_ERRORS: tuple[type[Exception], ...] = (DeadlineExceeded, *TRANSIENT_ERRORS)
+# ...plus unparseable answers
+ANSWER_FALLBACK_ERRORS: tuple[type[Exception], ...] = (ValueError, *FALLBACK_ERRORS)
+
 
 class AnswerBot:
     """
@@ -48,8 +110,13 @@ class AnswerBot:
     """
 
     llm: BaseLanguageModel
+    router: LLMRouter
+    stream_answers: bool
+    rule_based_validation: bool
+    prewarm_questions: list[str]
+    resilience: ResilientInvoker | None
 
-    _subject: str
+    _subject: str | None = None
     category: str
     history: list[str]
 
@@ -68,22 +135,59 @@ class AnswerBot:
         category: str = SIMPLE_CATEGORY,
         history: list[str] | None = None,
         langchain_verbose: bool = False,
+        router: LLMRouter | None = None,
+        stream_answers: bool = False,
+        rule_based_validation: bool = False,
+        prewarm_questions: list[str] | None = None,
+        resilience: ResilientInvoker | None = None,
+        batcher: MicroBatcher | None = None,
     ):
+        """
+        `router` if given picks the LLM for each chain, instead of using `llm`
+        for all of them (e.g. a cheaper model for validation, or so that only
+        the answers are streamed).
+        `stream_answers` enables `iter_turn` to return answers as soon as they
+        are generated, this requires an LLM created with `streaming=True`.
+        `rule_based_validation` accepts/rejects obvious questions locally (see
+        `twentyqs.rules`) and only asks the LLM to validate the ambiguous ones.
+        `prewarm_questions` will be answered in the background as soon as a
+        subject is picked, so that turns asking them can answer immediately.
+        `resilience` if given applies a time budget, retries and hedging to the
+        LLM calls in each turn, falling back to "I don't know" rather than
+        failing the turn.
+        `batcher` if given batches the per-turn LLM prompts with those from
+        other concurrent games (shared between `AnswerBot` instances).
+        """
         self.llm = llm
+        self.router = router or LLMRouter(default=llm)
+        self.stream_answers = stream_answers
+        self.rule_based_validation = rule_based_validation
+        self.prewarm_questions = prewarm_questions or []
+        self.resilience = resilience
+        if stream_answers:
+            token_sink.attach(self.router.get(Route.ANSWER))
 
         self.history = history or []
         self.simple_subject_picker = simple_subject_picker
         self.category = category
 
-        self.pick_subject_chain = PickSubjectChain(llm=llm, verbose=langchain_verbose)
+        self.pick_subject_chain = PickSubjectChain(
+            llm=self.router.get(Route.PICK_SUBJECT), verbose=langchain_verbose
+        )
         self.is_yes_no_question_chain = IsYesNoQuestionChain(
-            llm=llm, verbose=langchain_verbose
+            llm=self.router.get(Route.VALIDATE),
+            verbose=langchain_verbose,
+            batcher=batcher,
         )
         self.answer_question_chain = AnswerQuestionChain(
-            llm=llm, verbose=langchain_verbose
+            llm=self.router.get(Route.ANSWER),
+            verbose=langchain_verbose,
+            batcher=batcher,
         )
         self.deciding_question_chain = IsDecidingQuestionChain(
-            llm=llm, verbose=langchain_verbose
+            llm=self.router.get(Route.DECIDING),
+            verbose=langchain_verbose,
+            batcher=batcher,
         )
 
     @classmethod
@@ -110,17 +214,91 @@ class AnswerBot:
     def subject(self) -> str:
         if self._subject is None:
             self.set_subject()
-        return self._subject
+        return cast(str, self._subject)
 
     def set_subject(self) -> None:
-        self._subject = self.pick_subject()
+        self._subject = subject = self.pick_subject()
         # TODO: history should be per-category prompt? could narrow it a bit
-        self.history.append(self._subject)
+        self.history.append(subject)
+        if self.prewarm_questions:
+            questions = list(self.prewarm_questions)
+            # generate in background while the player reads the intro
+            _store_prewarmed(
+                subject,
+                _prewarm_executor.submit(
+                    with_current_stats(lambda: self.prewarm_answers(subject, questions))
+                ),
+            )
+
+    def resume(self, subject: str) -> None:
+        """
+        Continue a game already in progress.
+        """
+        self._subject = subject
+
+    def prewarm_answers(
+        self, subject: str, questions: list[str]
+    ) -> dict[str, TurnAnswer]:
+        """
+        Answer `questions` about `subject` ahead of time, in a single batch.
+
+        Returns answers keyed by normalized question.
+        """
+        today = datetime.now().strftime("%d %B %Y")
+        with using_route(Route.ANSWER):
+            texts = generate_many(
+                self.answer_question_chain,
+                [
+                    {"today": today, "subject": subject, "question": question}
+                    for question in questions
+                ],
+            )
+        parser = cast(
+            AnswerQuestionOutputParser, self.answer_question_chain.prompt.output_parser
+        )
+        answers = {}
+        for question, text in zip(questions, texts):
+            answer, justification = parser.parse(text)
+            if not isinstance(answer, Answer):
+                continue
+            answers[normalize_question(question)] = TurnAnswer(
+                answer=answer,
+                justification=justification,
+                prewarmed=True,
+            )
+        logger.info(
+            "AnswerBot.prewarm_answers: %d answers for %s", len(answers), subject
+        )
+        return answers
+
+    def get_prewarmed_answer(self, question: str) -> TurnAnswer | None:
+        """
+        Return the pre-generated answer for `question`, if there is one ready.
+        """
+        prewarmed = _get_prewarmed(self.subject)
+        if prewarmed is None or not prewarmed.done():
+            return None
+        if prewarmed.exception():
+            logger.warning(
+                "AnswerBot.get_prewarmed_answer: prewarm failed: %r",
+                prewarmed.exception(),
+            )
+            _discard_prewarmed(self.subject, prewarmed)
+            return None
+        answer = prewarmed.result().get(normalize_question(question))
+        if answer is None:
+            return None
+        # timestamp should reflect when the turn was answered
+        return replace(answer, timestamp=datetime.now())
 
     def pick_subject(self) -> str:
         """
         Pick a subject for the game.
         """
+        with using_route(Route.PICK_SUBJECT):
+            return self._pick_subject()
+
+    def _pick_subject(self) -> str:
         if self.simple_subject_picker:
             candidates = cast(
                 PickSubjectParsedT,
@@ -149,41 +327,68 @@ class AnswerBot:
             )
         return random.choice(candidates)
 
-    def process_turn(self, question: str) -> TurnSummaryT:
-        """
-        Play a turn of the game.
-        """
-        turn_begin = TurnBegin(
-            question=question,
-        )
+    def _invoke(
+        self, route: Route, fn: Callable[[], T], budget: TurnBudget | None
+    ) -> T:
+        @with_current_stats
+        def routed() -> T:
+            with using_route(route):
+                return fn()
 
-        # validate question
-        is_valid, reason = cast(
-            IsYesNoParsedT,
-            self.is_yes_no_question_chain.predict_and_parse(
-                subject=self.subject,
-                question=question,
-            ),
-        )
-        turn_validate = TurnValidate(
+        if self.resilience is None or budget is None:
+            return routed()
+        return self.resilience.call(route, routed, budget)
+
+    def _start_turn_budget(self) -> TurnBudget | None:
+        if self.resilience is None:
+            return None
+        return self.resilience.start_turn()
+
+    def validate_question(
+        self, question: str, budget: TurnBudget | None = None
+    ) -> TurnValidate:
+        if self.rule_based_validation:
+            result = classify_question(question)
+            if result is not None:
+                is_valid, reason = result
+                return TurnValidate(
+                    is_valid=is_valid,
+                    reason=reason,
+                    rule_based=True,
+                )
+
+        try:
+            is_valid, reason = cast(
+                IsYesNoParsedT,
+                self._invoke(
+                    Route.VALIDATE,
+                    lambda: self.is_yes_no_question_chain.predict_and_parse(
+                        subject=self.subject,
+                        question=question,
+                    ),
+                    budget,
+                ),
+            )
+        except FALLBACK_ERRORS as e:
+            if budget is None:
+                raise
+            # benefit of the doubt, better than losing the turn
+            logger.warning("AnswerBot.validate_question: falling back: %r", e)
+            is_valid, reason = True, None
+        return TurnValidate(
             is_valid=is_valid,
             reason=reason,
         )
-        if not is_valid:
-            return InvalidQuestionSummary(
-                begin=turn_begin,
-                validate=turn_validate,
-            )
 
-        # answer question
-        answer, justification = cast(
-            AnswerParsedT,
-            self.answer_question_chain.predict_and_parse(
-                today=datetime.now().strftime("%d %B %Y"),
-                subject=self.subject,
-                question=question,
-            ),
-        )
+    def _answer_inputs(self, question: str) -> dict[str, str]:
+        return {
+            "today": datetime.now().strftime("%d %B %Y"),
+            "subject": self.subject,
+            "question": question,
+        }
+
+    def _to_turn_answer(self, parsed: AnswerParsedT) -> TurnAnswer:
+        answer, justification = parsed
         # TODO: log these failures
         # should parser behave differently?
         if answer is None:
@@ -191,30 +396,233 @@ class AnswerBot:
         if not isinstance(answer, Answer):
             warnings.warn(f"Unexpected answer: {answer}")
 
-        turn_answer = TurnAnswer(
+        return TurnAnswer(
             answer=answer,
             justification=justification,
         )
 
-        # check if user guessed the subject
-        if answer is Answer.YES:
-            is_deciding_question = cast(
-                DecidingParsedT,
-                self.deciding_question_chain.predict_and_parse(
-                    subject=self.subject,
-                    question=question,
+    def _fallback_answer(self, error: Exception) -> TurnAnswer:
+        logger.warning("AnswerBot: falling back to %r: %r", Answer.DONT_KNOW, error)
+        return TurnAnswer(
+            answer=Answer.DONT_KNOW,
+            justification=f"(no answer from LLM: {error!r})",
+        )
+
+    def answer_question(
+        self, question: str, budget: TurnBudget | None = None
+    ) -> TurnAnswer:
+        prewarmed = self.get_prewarmed_answer(question)
+        if prewarmed:
+            return prewarmed
+        try:
+            return self._invoke(
+                Route.ANSWER,
+                lambda: self._to_turn_answer(
+                    cast(
+                        AnswerParsedT,
+                        self.answer_question_chain.predict_and_parse(
+                            **self._answer_inputs(question)
+                        ),
+                    )
                 ),
+                budget,
+            )
+        except ANSWER_FALLBACK_ERRORS as e:
+            if budget is None:
+                raise
+            return self._fallback_answer(e)
+
+    def _predict_answer_streaming(self, question: str, on_token: TokenCallbackT) -> str:
+        with using_route(Route.ANSWER), token_sink.capture(on_token):
+            return self.answer_question_chain.predict(**self._answer_inputs(question))
+
+    def stream_answer(
+        self, question: str, budget: TurnBudget | None = None
+    ) -> Iterator[TurnAnswer]:
+        """
+        Yields a provisional `TurnAnswer` (without justification) as soon as the
+        `Answer:` line has been streamed from the LLM, followed by the final one.
+
+        If the LLM is not streaming tokens (or the answer was pre-generated) we
+        just get the final `TurnAnswer`.
+
+        Streamed calls are retried but never hedged, as we can only stream from
+        one request at a time.
+        """
+        prewarmed = self.get_prewarmed_answer(question)
+        if prewarmed:
+            yield prewarmed
+            return
+
+        # (attempt, token) where a retried attempt starts the stream again, and
+        # `None` when done
+        tokens: Queue[tuple[int, str | None] | None] = Queue()
+        attempts = count(1)
+
+        def predict() -> str:
+            # (an attempt which timed out may still be streaming, its tokens
+            # are dropped rather than mixed in with the retry's)
+            attempt = next(attempts)
+            tokens.put((attempt, None))
+            return self._predict_answer_streaming(
+                question, lambda token: tokens.put((attempt, token))
+            )
+
+        def invoke() -> str:
+            if self.resilience is None or budget is None:
+                return predict()
+            return self.resilience.call(
+                Route.ANSWER, with_current_stats(predict), budget, hedge=False
             )
+
+        executor = ThreadPoolExecutor(max_workers=1)
+        try:
+            future = executor.submit(with_current_stats(invoke))
+            future.add_done_callback(lambda _: tokens.put(None))
+            partial = ""
+            provisional: Answer | None = None
+            current = 0
+            while True:
+                try:
+                    item = tokens.get(
+                        timeout=budget.remaining() if budget is not None else None
+                    )
+                except Empty:
+                    break
+                if item is None:
+                    break
+                attempt, token = item
+                if token is None:
+                    if attempt > current:
+                        current = attempt
+                        partial = ""
+                    continue
+                if attempt != current:
+                    continue
+                partial += token
+                answer = parse_streamed_answer(partial)
+                if isinstance(answer, Answer):
+                    provisional = answer
+                    yield TurnAnswer(answer=answer, justification=None)
+                    break
+            try:
+                text = future.result(
+                    timeout=budget.remaining() if budget is not None else None
+                )
+                parser = cast(
+                    AnswerQuestionOutputParser,
+                    self.answer_question_chain.prompt.output_parser,
+                )
+                turn_answer = self._to_turn_answer(parser.parse(text))
+            # (includes the TimeoutError from `future.result`)
+            except ANSWER_FALLBACK_ERRORS as e:
+                if provisional is not None:
+                    # (the player has already seen the answer, so we stick to
+                    # it and just go without the justification)
+                    logger.warning("AnswerBot: no justification for answer: %r", e)
+                    turn_answer = TurnAnswer(answer=provisional, justification=None)
+                elif budget is None:
+                    raise
+                else:
+                    turn_answer = self._fallback_answer(e)
+            if provisional is not None and turn_answer.answer is not provisional:
+                # (from a retried attempt, which can disagree with the answer
+                # already shown: keep that, the justification isn't for it)
+                turn_answer = TurnAnswer(answer=provisional, justification=None)
+        finally:
+            # don't wait for an abandoned call to finish
+            executor.shutdown(wait=False)
+        yield turn_answer
+
+    def is_deciding_question(
+        self, question: str, answer: TurnAnswer, budget: TurnBudget | None = None
+    ) -> TurnEndGame:
+        """
+        Check if user guessed the subject.
+        """
+        if answer.answer is Answer.YES:
+            try:
+                is_deciding_question = cast(
+                    DecidingParsedT,
+                    self._invoke(
+                        Route.DECIDING,
+                        lambda: self.deciding_question_chain.predict_and_parse(
+                            subject=self.subject,
+                            question=question,
+                        ),
+                        budget,
+                    ),
+                )
+            except FALLBACK_ERRORS as e:
+                if budget is None:
+                    raise
+                logger.warning("AnswerBot.is_deciding_question: falling back: %r", e)
+                is_deciding_question = False
         else:
             is_deciding_question = False
 
-        turn_end_game = TurnEndGame(
+        return TurnEndGame(
             is_deciding_q=is_deciding_question,
         )
 
+    def process_turn(self, question: str) -> TurnSummaryT:
+        """
+        Play a turn of the game.
+        """
+        turn_begin = TurnBegin(
+            question=question,
+        )
+        budget = self._start_turn_budget()
+
+        turn_validate = self.validate_question(question, budget)
+        if not turn_validate.is_valid:
+            return InvalidQuestionSummary(
+                begin=turn_begin,
+                validate=turn_validate,
+            )
+
+        turn_answer = self.answer_question(question, budget)
+        turn_end_game = self.is_deciding_question(question, turn_answer, budget)
+
         return ValidQuestionSummary(
             begin=turn_begin,
             validate=turn_validate,
             answer=turn_answer,
             end_game=turn_end_game,
         )
+
+    def iter_turn(self, question: str) -> Iterator[TurnAnswer | TurnSummaryT]:
+        """
+        Play a turn of the game, streaming the answer.
+
+        Yields a provisional `TurnAnswer` as soon as the answer is known, i.e.
+        before the justification has finished generating and before the
+        deciding-question check. The last item is always the turn summary.
+        """
+        turn_begin = TurnBegin(
+            question=question,
+        )
+        budget = self._start_turn_budget()
+
+        turn_validate = self.validate_question(question, budget)
+        if not turn_validate.is_valid:
+            yield InvalidQuestionSummary(
+                begin=turn_begin,
+                validate=turn_validate,
+            )
+            return
+
+        yielded_answer = False
+        for turn_answer in self.stream_answer(question, budget):
+            if not yielded_answer:
+                yield turn_answer
+                yielded_answer = True
+
+        turn_end_game = self.is_deciding_question(question, turn_answer, budget)
+
+        yield ValidQuestionSummary(
+            begin=turn_begin,
+            validate=turn_validate,
+            answer=turn_answer,
+            end_game=turn_end_game,
+        )
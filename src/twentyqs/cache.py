@@ -0,0 +1,105 @@
+import time
+from collections import OrderedDict
+from collections.abc import Hashable
+from dataclasses import dataclass
+from threading import Lock
+from typing import Generic, TypeVar
+
+from twentyqs.types import JsonT
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+@dataclass
+class _Entry(Generic[V]):
+    value: V
+    last_used: float
+    created: float
+
+
+class IdleCache(Generic[K, V]):
+    """
+    In-memory map bounded by size (least recently used are evicted first) and
+    by idle time: entries not used for `idle_ttl` seconds are evicted. With
+    `ttl`, entries also expire that long after being put, however often used.
+
+    Expired entries are evicted lazily, as the cache is used.
+    """
+
+    max_size: int
+    idle_ttl: float | None
+    ttl: float | None
+
+    def __init__(
+        self, max_size: int, idle_ttl: float | None = None, ttl: float | None = None
+    ):
+        self.max_size = max_size
+        self.idle_ttl = idle_ttl
+        self.ttl = ttl
+        self._entries: OrderedDict[K, _Entry[V]] = OrderedDict()
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _evict_idle(self, now: float) -> None:
+        # (must hold the lock) entries are in least recently used order
+        if self.idle_ttl is None:
+            return
+        while self._entries:
+            key, entry = next(iter(self._entries.items()))
+            if now - entry.last_used < self.idle_ttl:
+                break
+            del self._entries[key]
+            self.evictions += 1
+
+    def get(self, key: K) -> V | None:
+        now = time.monotonic()
+        with self._lock:
+            self._evict_idle(now)
+            entry = self._entries.get(key)
+            if entry is not None and self.ttl is not None:
+                if now - entry.created >= self.ttl:
+                    del self._entries[key]
+                    self.evictions += 1
+                    entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            entry.last_used = now
+            self._entries.move_to_end(key)
+            return entry.value
+
+    def put(self, key: K, value: V) -> None:
+        now = time.monotonic()
+        with self._lock:
+            self._evict_idle(now)
+            self._entries[key] = _Entry(value=value, last_used=now, created=now)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key: K) -> V | None:
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            return entry.value if entry else None
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def get_stats(self) -> dict[str, JsonT]:
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
@@ -1,13 +1,17 @@
 import logging
 import re
 
-from langchain import PromptTemplate, LLMChain
+from langchain import PromptTemplate
 from langchain.schema import BaseOutputParser
 
+from twentyqs.chains.base import CoalescingLLMChain
 from twentyqs.types import Answer
 
 logger = logging.getLogger(__name__)
 
+# NOTE: everything before the suffix is static, so that it is a prefix shared
+# by all games (for provider-side prompt caching), keep variables in the suffix
+
 # possibly there should be an "unanswerable" response too
 prefix = """You are a chatbot playing a question answering game with a human.
 
@@ -25,8 +29,6 @@ For example: "the Eiffel Tower" would be categorized as a mineral, as it is a no
 Another example: If the target is "The Great Barrier Reef". The Great Barrier Reef is predominantly made up of living organisms, primarily coral polyps, which are animals. However, the reef also contains some mineral structures and sedimentary deposits. So, it could be considered as a combination of animal, mineral, and possibly vegetable (in the form of algae) elements.
 So if asked "Is it animal?" it would be correct to answer "Yes", if asked "Is it mineral?" it would be correct to answer "Yes", and if asked "Is it vegetable?" it would be correct to answer "No".
 
-Today's date is: {today}
-
 Now we are ready to play the game.
 
 Use the following format:
@@ -35,61 +37,89 @@ Use the following format:
 examples = [
     """Subject: Albert Einstein
 Question: is it alive?
-Thought: Albert Einstein died in 1955. Albert Einstein is not alive.
-Answer: No""",
+Answer: No
+Thought: Albert Einstein died in 1955. Albert Einstein is not alive.""",
     """Subject: Albert Einstein
 Question: is it animal?
-Thought: Albert Einstein was alive but was not a vegetable.
-Answer: Yes""",
+Answer: Yes
+Thought: Albert Einstein was alive but was not a vegetable.""",
     """Subject: Albert Einstein
 Question: is it yellow?
-Thought: Albert Einstein does not have a specific colour. His skin was predominantly 'flesh' colour.
-Answer: No""",
+Answer: No
+Thought: Albert Einstein does not have a specific colour. His skin was predominantly 'flesh' colour.""",
     """Subject: The Brooklyn Bridge
 Question: is it mineral?
-Thought: It is a non-living object that is made from metal and other materials that were extracted from the earth.
-Answer: Yes""",
+Answer: Yes
+Thought: It is a non-living object that is made from metal and other materials that were extracted from the earth.""",
     """Subject: Venus
 Question: is it visible?
-Thought: Venus is visible in the sky at night, but not during the day.
-Answer: Sometimes""",
+Answer: Sometimes
+Thought: Venus is visible in the sky at night, but not during the day.""",
     """Subject: God
 Question: does it exist?
-Thought: The answer is unknowable.
-Answer: I don't know""",
+Answer: I don't know
+Thought: The answer is unknowable.""",
 ]
 
-splitter_re = re.compile(r"(Thought|Answer)\:\s*(?P<value>.*)")
+splitter_re = re.compile(r"(?P<key>Thought|Answer)\:\s*(?P<value>.*)")
 
 AnswerT = Answer | str | None
 ParsedT = tuple[AnswerT, str | None]
 
 
-def _get_matched_value(unparsed: str) -> str | None:
-    match = splitter_re.match(unparsed)
-    if match:
-        return match.groupdict()["value"] or None
-    return None
+def _get_matched_values(unparsed: str) -> dict[str, str | None]:
+    """
+    (the first value of each key, and only up to the start of another example,
+    in case the LLM carries on past its own answer)
+    """
+    values: dict[str, str | None] = {}
+    for line in unparsed.splitlines():
+        line = line.strip()
+        if values and line.startswith(("Subject:", "Question:")):
+            break
+        match = splitter_re.match(line)
+        if match:
+            values.setdefault(match.group("key"), match.group("value") or None)
+    return values
+
+
+def _to_answer(value: str | None) -> AnswerT:
+    if value:
+        for a in Answer:
+            if value.startswith(a.value):
+                return a
+    return value
+
+
+def parse_streamed_answer(partial: str) -> AnswerT:
+    """
+    Parse the answer from a partially streamed LLM response.
+
+    The prompt asks for the `Answer:` line before the justification, so we can
+    return the answer as soon as that line is complete (i.e. followed by a
+    newline) without waiting for the rest of the response.
+    """
+    if "\n" not in partial.lstrip():
+        return None
+    complete, _ = partial.lstrip().rsplit("\n", 1)
+    return _to_answer(_get_matched_values(complete).get("Answer"))
 
 
 class AnswerQuestionOutputParser(BaseOutputParser[ParsedT]):
     def parse(self, text: str) -> ParsedT:
         logger.debug("AnswerQuestionOutputParser.parse: %s", text)
-        thought, answer = text.rsplit("\n", 2)
-        thought_ = _get_matched_value(thought)
-        answer_: AnswerT = _get_matched_value(answer)
-        if answer_:
-            for a in Answer:
-                if answer_.startswith(a.value):
-                    answer_ = a
-                    break
-        return answer_, thought_
-
-
-class AnswerQuestionChain(LLMChain):
+        values = _get_matched_values(text)
+        return _to_answer(values.get("Answer")), values.get("Thought")
+
+
+class AnswerQuestionChain(CoalescingLLMChain):
     prompt = PromptTemplate.from_examples(
         examples=examples,
-        suffix=("Subject: {subject}\n" "Question: {question}\n"),
+        suffix=(
+            "Today's date is: {today}\n\n"
+            "Subject: {subject}\n"
+            "Question: {question}\n"
+        ),
         prefix=prefix,
         input_variables=["today", "subject", "question"],
         output_parser=AnswerQuestionOutputParser(),
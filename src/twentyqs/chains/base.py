@@ -0,0 +1,54 @@
+from collections.abc import Hashable
+from typing import Any
+
+from langchain import LLMChain
+from langchain.schema import LLMResult, PromptValue
+
+from twentyqs.batching import MicroBatcher
+from twentyqs.llms import llm_key
+from twentyqs.singleflight import llm_calls
+
+
+class CoalescingLLMChain(LLMChain):
+    """
+    LLMChain where concurrent calls with an identical (model, prompt, params)
+    share a single upstream request, e.g. when several games ask the same
+    popular question about the same subject at the same time.
+
+    See `twentyqs.singleflight`.
+
+    If given a `batcher`, single-prompt calls are sent via it, so that they can
+    be batched with calls from other games (see `twentyqs.batching`).
+    """
+
+    batcher: MicroBatcher | None = None
+
+    def _flight_key(
+        self, prompts: list[PromptValue], stop: list[str] | None
+    ) -> Hashable:
+        return (
+            llm_key(self.llm),
+            tuple(prompt.to_string() for prompt in prompts),
+            tuple(stop) if stop else None,
+        )
+
+    def _generate_prompts(
+        self, prompts: list[PromptValue], stop: list[str] | None
+    ) -> LLMResult:
+        if self.batcher is not None and len(prompts) == 1:
+            return self.batcher.generate(self.llm, prompts[0], stop)
+        return self.llm.generate_prompt(prompts, stop)
+
+    def generate(self, input_list: list[dict[str, Any]]) -> LLMResult:
+        prompts, stop = self.prep_prompts(input_list)
+        return llm_calls.do(
+            self._flight_key(prompts, stop),
+            lambda: self._generate_prompts(prompts, stop),
+        )
+
+    async def agenerate(self, input_list: list[dict[str, Any]]) -> LLMResult:
+        prompts, stop = await self.aprep_prompts(input_list)
+        return await llm_calls.ado(
+            self._flight_key(prompts, stop),
+            lambda: self.llm.agenerate_prompt(prompts, stop),
+        )
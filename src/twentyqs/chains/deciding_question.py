@@ -1,23 +1,29 @@
 import logging
 
-from langchain import PromptTemplate, LLMChain
+from langchain import PromptTemplate
 from langchain.schema import BaseOutputParser
 
+from twentyqs.chains.base import CoalescingLLMChain
+
 logger = logging.getLogger(__name__)
 
 # TODO:
 # maybe add a "reason" field too for logging
 
+# NOTE: the variables come last so that all the static text is a prefix shared
+# by all games (for provider-side prompt caching)
 template = """In a game of 20 Questions...
 
 The oracle knows the secret subject.
 
+After the oracle's answer below, does the player now know the identity of the secret subject? (Answer only yes or no)
+
 The secret subject is: {subject}
 
 The player asked: {question}
 The oracle answered: Yes
 
-Does the player now know the identity of the secret subject? (Answer only yes or no)
+Does the player now know?
 """
 
 ParsedT = bool
@@ -29,7 +35,7 @@ class IsDecidingQuestionOutputParser(BaseOutputParser[ParsedT]):
         return text.strip().lower().startswith("yes")
 
 
-class IsDecidingQuestionChain(LLMChain):
+class IsDecidingQuestionChain(CoalescingLLMChain):
     prompt = PromptTemplate(
         template=template,
         input_variables=["subject", "question"],
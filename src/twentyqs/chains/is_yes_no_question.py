@@ -1,9 +1,11 @@
 import logging
 import re
 
-from langchain import PromptTemplate, LLMChain
+from langchain import PromptTemplate
 from langchain.schema import BaseOutputParser
 
+from twentyqs.chains.base import CoalescingLLMChain
+
 logger = logging.getLogger(__name__)
 
 # TODO:
@@ -87,7 +89,7 @@ class IsYesNoOutputParser(BaseOutputParser[ParsedT]):
         return is_yes_no, reason_
 
 
-class IsYesNoQuestionChain(LLMChain):
+class IsYesNoQuestionChain(CoalescingLLMChain):
     prompt = PromptTemplate.from_examples(
         examples=examples,
         suffix="""Subject: {subject}
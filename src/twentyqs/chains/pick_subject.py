@@ -1,9 +1,11 @@
 import logging
 import re
 
-from langchain import PromptTemplate, LLMChain
+from langchain import PromptTemplate
 from langchain.schema import BaseOutputParser
 
+from twentyqs.chains.base import CoalescingLLMChain
+
 logger = logging.getLogger(__name__)
 
 
@@ -15,16 +17,20 @@ logger = logging.getLogger(__name__)
 #   e.g. with SIMPLE_CATEGORY once it has picked one 'place' it will tend to pick
 #   more 'places' after that
 # - ...to be seen whether the themed category prompts totally overcome that
+# NOTE: the variables come last so that all the static text is a prefix shared
+# by all users (for provider-side prompt caching)
 template = """You are an AI about to play a game of "20 Questions" with a human.
 
 Before we start the game we need to prepare a list of possible subjects. The subjects should all be well-known to most people.
 
-The following subjects have already been used and should not appear in your answer:
-{seen}
+The subjects that have already been used are listed below, they should not appear in your answer. Do not use a variation on a subject that has already been used.
 
-Do not use a variation on a subject that has already been used.
+Remember, each item in the list should be unique with no repeats.
+
+Already used:
+{seen}
 
-Begin! Remember, each item in the list should be unique with no repeats. 
+Begin!
 
 {num} {category}:
 """
@@ -64,7 +70,7 @@ class NumberedListParser(BaseOutputParser[ParsedT]):
         return splitter_re.findall(text)
 
 
-class PickSubjectChain(LLMChain):
+class PickSubjectChain(CoalescingLLMChain):
     """
     NOTE:
     The LLM will tend to pick much the same items each time. So we need to keep
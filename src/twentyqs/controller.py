@@ -1,14 +1,32 @@
+import hashlib
 import logging
-from collections.abc import Callable
+import threading
+import time
+from collections.abc import Callable, Iterator
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from contextlib import contextmanager, nullcontext
 from dataclasses import asdict, dataclass
-from typing import Protocol
+from datetime import datetime
+from typing import ContextManager, Protocol, cast
 
 from twentyqs.brain import AnswerBot
-from twentyqs.repository import Repository, User, GameSession, Turn
+from twentyqs.cache import IdleCache
+from twentyqs.prewarm import CommonQuestions
+from twentyqs.repository import (
+    NotFound,
+    Repository,
+    User,
+    Turn,
+    TurnInProgress,
+    TurnRequest,
+)
+from twentyqs.rules import normalize_question
 from twentyqs.types import (
     LogKey,
     JsonT,
+    TurnAnswer,
     TurnEndGame,
+    GameState,
     TurnSummaryT,
     InvalidQuestionSummary,
     UserMeta,
@@ -36,6 +54,7 @@ StatsContextManagerFactory = Callable[..., StatsContextManager]
 
 @dataclass(frozen=True)
 class GameBegun:
+    game_id: int
     max_questions: int
 
 
@@ -69,37 +88,113 @@ class LostGame:
 
 TurnOutcome = InvalidQuestion | ContinueGame | WonGame | LostGame
 
+OUTCOME_TYPES: dict[type, str] = {
+    InvalidQuestion: "invalid",
+    ContinueGame: "continue",
+    WonGame: "won",
+    LostGame: "lost",
+}
+_OUTCOME_CLASSES = {name: cls for cls, name in OUTCOME_TYPES.items()}
+
+
+def outcome_to_json(outcome: TurnOutcome) -> dict[str, JsonT]:
+    return {"outcome": OUTCOME_TYPES[type(outcome)], **asdict(outcome)}
+
+
+def outcome_from_json(data: dict[str, JsonT]) -> TurnOutcome:
+    values = dict(data)
+    cls = _OUTCOME_CLASSES[cast(str, values.pop("outcome"))]
+    return cls(**values)
+
+
+def question_hash(question: str) -> str:
+    return hashlib.sha256(normalize_question(question).encode()).hexdigest()
+
+
+@dataclass(frozen=True)
+class AnswerPreview:
+    answer: str
+
+
+TurnUpdate = AnswerPreview | TurnOutcome
+
 
 class AuthError(Exception):
     pass
 
 
+class GameFinished(Exception):
+    pass
+
+
 class GameController:
-    answerer: AnswerBot
+    """
+    Holds no per-game state between requests: everything is stored in the
+    repository and each turn rehydrates the game from there. So games can be
+    served by any process (or machine) and survive a restart.
+
+    The `AnswerBot` for recently active games is kept in `active_games`, idle
+    games are evicted and rebuilt from the db if the player comes back.
+
+    Turn submissions are idempotent: a repeat of a turn (same client `turn_key`,
+    or same question as the last one) gets the stored outcome, see
+    `Repository.claim_turn_request`. Only one turn of a game is played at a
+    time, another turn submitted meanwhile raises `TurnInProgress`.
+    """
+
+    answerer_factory: Callable[[], AnswerBot]
+    active_games: IdleCache[int, AnswerBot]
     require_auth: bool
     stats_context_factory: StatsContextManagerFactory | None
-    _stats_context_mgr: StatsContextManager | None = None
-    game_stats_context: StatsContext | None = None
-    user: User
-    session: GameSession | None = None
+    common_questions: CommonQuestions | None
     max_questions: int
-    _q_count: int = 0
+    pending_turn_timeout: float
+    remote_turn_timeout: float
+    repeat_window: float
 
     def __init__(
         self,
         repository: Repository,
-        answerer: AnswerBot,
+        answerer_factory: Callable[[], AnswerBot],
         require_auth: bool = True,
         max_questions: int = 20,
         stats_context_factory: StatsContextManagerFactory | None = None,
+        common_questions: CommonQuestions | None = None,
+        max_active_games: int = 1000,
+        active_game_ttl: float | None = 30 * 60,
+        pending_turn_timeout: float = 60,
+        remote_turn_timeout: float = 10,
+        repeat_window: float = 10,
     ):
+        """
+        `answerer_factory` returns a new `AnswerBot` for a game.
+        `common_questions` if given will be answered ahead of time for each game.
+        `max_active_games` and `active_game_ttl` (seconds idle) bound the games
+        kept in memory.
+        `pending_turn_timeout` (seconds) is how long a repeated submission waits
+        for the original to complete, or `remote_turn_timeout` if it's being
+        played by another process (as we have to poll the db for it).
+        `repeat_window` (seconds) is how soon the same question without a
+        `turn_key` counts as a repeat of the last turn, rather than asked again.
+        """
         self.db = repository
-        self.answerer = answerer
+        self.answerer_factory = answerer_factory
         self.require_auth = require_auth
         self.max_questions = max_questions
         self.stats_context_factory = stats_context_factory
-
-    def set_user(self, username: str, password: str | None) -> None:
+        self.common_questions = common_questions
+        self.active_games = IdleCache(max_active_games, idle_ttl=active_game_ttl)
+        self.pending_turn_timeout = pending_turn_timeout
+        self.remote_turn_timeout = remote_turn_timeout
+        self.repeat_window = repeat_window
+        # outcomes of the turns being played by this process, by request id,
+        # for repeated submissions to wait on
+        self._pending: dict[int, Future[TurnOutcome | None]] = {}
+        self._pending_lock = threading.Lock()
+        # (lock, number of users) by game id, see `_game_lock`
+        self._game_locks: dict[int, tuple[threading.Lock, int]] = {}
+
+    def authenticate(self, username: str, password: str | None) -> User:
         if self.require_auth:
             if password is None:
                 raise AuthError("Authentication required")
@@ -108,62 +203,230 @@ class GameController:
                 raise AuthError("Invalid username/passcode")
         else:
             user = self.db.get_or_create_user(username)
-        self.user = user
+        return user
 
-    def get_user_meta(self) -> UserMeta:
-        if not self.user:
-            raise RuntimeError("GameController: No user set")
+    def get_user_meta(self, username: str) -> UserMeta:
+        user = self.db.get_by_username(username)
+        if not user:
+            raise RuntimeError(f"GameController: No such user: {username}")
 
         return UserMeta(
-            username=self.user.username,
-            name=self.user.name,
-            stats=self.db.get_user_stats(self.user.username),
+            username=user.username,
+            name=user.name,
+            stats=self.db.get_user_stats(user.username),
         )
 
-    @property
-    def questions_asked(self) -> int:
-        """
-        Valid questions asked so far.
-        """
-        return self._q_count
+    def _stats_context(self) -> StatsContextManager | ContextManager[None]:
+        if self.stats_context_factory:
+            return self.stats_context_factory()
+        return nullcontext()
 
-    @property
-    def questions_remaining(self) -> int:
-        return self.max_questions - self._q_count
+    def _add_stats(self, game_id: int, stats: StatsContext | None) -> None:
+        if stats is not None:
+            self.db.add_llm_stats(game_id, stats.get_stats())
 
-    def start_game(self) -> GameBegun:
+    def start_game(self, username: str) -> GameBegun:
         """
         Start a new game.
         """
-        if not self.user:
-            raise RuntimeError("GameController: No user set")
-
-        subject_history = self.db.get_user_subject_history(self.user.username)
-        self.answerer.history = subject_history
-
-        if self.stats_context_factory:
-            self._stats_context_mgr = mgr = self.stats_context_factory()
-            self.game_stats_context = mgr.__enter__()
-
-        self.answerer.set_subject()
-        self._q_count = 0
-        self.session = self.db.start_game(user=self.user, subject=self.answerer.subject)
+        user = self.db.get_by_username(username)
+        if not user:
+            raise RuntimeError(f"GameController: No such user: {username}")
+
+        answerer = self.answerer_factory()
+        answerer.history = self.db.get_user_subject_history(username)
+        if self.common_questions:
+            answerer.prewarm_questions = self.common_questions.get()
+
+        with self._stats_context() as stats:
+            answerer.set_subject()
+        # only needed to pick the subject, don't keep it in memory for the game
+        answerer.history = []
+        game = self.db.start_game(user=user, subject=answerer.subject)
+        assert game.id is not None
+        self._add_stats(game.id, stats)
+        self.active_games.put(game.id, answerer)
         return GameBegun(
+            game_id=game.id,
             max_questions=self.max_questions,
         )
 
-    def finish_game(self, user_won: bool) -> None:
+    def get_game(self, game_id: int) -> GameState:
+        return self.db.get_game_state(game_id)
+
+    def _get_answerer(self, state: GameState) -> AnswerBot:
+        if state.finished:
+            self.active_games.pop(state.game_id)
+            raise GameFinished(state.game_id)
+        answerer = self.active_games.get(state.game_id)
+        if answerer is None:
+            answerer = self.answerer_factory()
+            answerer.resume(state.subject)
+            self.active_games.put(state.game_id, answerer)
+        return answerer
+
+    @contextmanager
+    def _game_lock(self, game_id: int) -> Iterator[None]:
+        """
+        Serialise use of a game's answerer in this process. (across processes
+        the in-progress `TurnRequest` does, but a stale one can be taken over
+        while its turn is still being played)
+        """
+        with self._pending_lock:
+            lock, users = self._game_locks.get(game_id, (threading.Lock(), 0))
+            self._game_locks[game_id] = (lock, users + 1)
+        try:
+            with lock:
+                yield
+        finally:
+            with self._pending_lock:
+                lock, users = self._game_locks[game_id]
+                if users == 1:
+                    del self._game_locks[game_id]
+                else:
+                    self._game_locks[game_id] = (lock, users - 1)
+
+    def _wait_for_outcome(self, request: TurnRequest) -> TurnOutcome | None:
         """
-        Finish the current game.
+        Wait for the outcome of an earlier submission of the turn, or `None`
+        if it failed.
         """
-        assert self.session
-        if self._stats_context_mgr:
-            self._stats_context_mgr.__exit__(None, None, None)
-            llm_stats = None
-            if self.game_stats_context:
-                llm_stats = self.game_stats_context.get_stats()
-                logger.info("GameController.finish_game: LLM stats: %s", llm_stats)
-        self.db.finish_game(self.session.id, user_won, llm_stats)
+        if request.outcome is not None:
+            return outcome_from_json(request.outcome)
+        assert request.id is not None
+        with self._pending_lock:
+            pending = self._pending.get(request.id)
+        if pending is not None:
+            try:
+                return pending.result(timeout=self.pending_turn_timeout)
+            except FutureTimeoutError:
+                raise TurnInProgress(request.gamesession_id)
+
+        # (being played by another process, so poll the db for it)
+        deadline = time.monotonic() + self.remote_turn_timeout
+        interval = 0.05
+        while request.outcome is None:
+            if time.monotonic() > deadline:
+                raise TurnInProgress(request.gamesession_id)
+            time.sleep(interval)
+            interval = min(interval * 2, 1.0)
+            try:
+                request = self.db.get_turn_request(request.id)
+            except NotFound:
+                return None
+        return outcome_from_json(request.outcome)
+
+    def _submit_turn(
+        self, game_id: int, question: str, turn_key: str | None
+    ) -> tuple[GameState, TurnRequest, TurnOutcome | None]:
+        """
+        Returns the stored outcome if the turn is a repeat, otherwise it has
+        been recorded as in progress and should be played.
+
+        Raises `TurnInProgress` if another turn of the game is being played.
+        """
+        q_hash = question_hash(question)
+        while True:
+            # (state is always read from the db, in case another process has
+            # served a turn since we did)
+            state = self.get_game(game_id)
+            request, is_new = self.db.claim_turn_request(
+                game_id,
+                request_key=(
+                    f"id:{turn_key}"
+                    if turn_key
+                    else f"q:{q_hash}:{state.questions_asked}"
+                ),
+                question_hash=q_hash,
+                match_latest_within=self.repeat_window if turn_key is None else None,
+                stale_after=self.pending_turn_timeout,
+            )
+            if is_new:
+                assert request.id is not None
+                with self._pending_lock:
+                    self._pending.setdefault(request.id, Future())
+                try:
+                    # (a turn may have completed since we read it)
+                    state = self.get_game(game_id)
+                except BaseException:
+                    self._release_request(request)
+                    raise
+                return state, request, None
+            logger.info("GameController: repeated turn for game %s", game_id)
+            outcome = self._wait_for_outcome(request)
+            if outcome is not None:
+                return state, request, outcome
+
+    def _complete_request(self, request: TurnRequest, turn: Turn, outcome: TurnOutcome):
+        assert request.id is not None
+        try:
+            self.db.complete_turn_request(request.id, turn.id, outcome_to_json(outcome))
+        except NotFound:
+            # (replaced by another turn as stale, the outcome stands regardless)
+            logger.warning("GameController: turn request %s was replaced", request.id)
+        finally:
+            self._resolve_pending(request.id, outcome)
+
+    def _release_request(self, request: TurnRequest):
+        assert request.id is not None
+        try:
+            self.db.release_turn_request(request.id)
+        finally:
+            self._resolve_pending(request.id, None)
+
+    def _resolve_pending(self, request_id: int, outcome: TurnOutcome | None) -> None:
+        with self._pending_lock:
+            pending = self._pending.pop(request_id, None)
+        if pending is not None:
+            pending.set_result(outcome)
+
+    def replay_game(self, game_id: int) -> list[tuple[str, TurnOutcome]]:
+        """
+        The (question, outcome) of each turn played so far, from the db.
+        """
+        state = self.get_game(game_id)
+        turns: list[tuple[str, TurnOutcome]] = []
+        # (counted as we go rather than read from `valid_q_n`, which is NULL
+        # for legacy turns the backfill hasn't reached yet)
+        valid_q_n = 0
+        for review in self.db.review_game(game_id):
+            outcome: TurnOutcome
+            if review.is_valid:
+                valid_q_n += 1
+            questions_asked = valid_q_n
+            questions_remaining = self.max_questions - questions_asked
+            if not review.is_valid:
+                outcome = InvalidQuestion(
+                    question=review.question, reason=review.is_valid_reason or ""
+                )
+            elif review.is_deciding_q:
+                outcome = WonGame(
+                    questions_asked=questions_asked,
+                    questions_remaining=questions_remaining,
+                    answer=review.answer or "",
+                )
+            elif questions_remaining == 0:
+                outcome = LostGame(
+                    questions_asked=questions_asked,
+                    questions_remaining=questions_remaining,
+                    answer=review.answer or "",
+                    subject=state.subject,
+                )
+            else:
+                outcome = ContinueGame(
+                    questions_asked=questions_asked,
+                    questions_remaining=questions_remaining,
+                    answer=review.answer or "",
+                )
+            turns.append((review.question, outcome))
+        return turns
+
+    def finish_game(self, game_id: int, user_won: bool) -> None:
+        """
+        Finish the game.
+        """
+        self.db.finish_game(game_id, user_won)
+        self.active_games.pop(game_id)
 
     def log_turn(self, turn: Turn, summary: TurnSummaryT) -> None:
         """
@@ -198,19 +461,87 @@ class GameController:
             )
         self.db.store_turn_logs(logs=logs)
 
-    def take_turn(self, question: str) -> TurnOutcome:
+    def _start_turn(
+        self, state: GameState, question: str, started_at: datetime | None = None
+    ) -> Turn:
+        return self.db.start_turn(
+            game_id=state.game_id,
+            question=question,
+            questions_asked=state.questions_asked,
+            questions_remaining=self.max_questions - state.questions_asked,
+            started_at=started_at,
+        )
+
+    def take_turn(
+        self, game_id: int, question: str, turn_key: str | None = None
+    ) -> TurnOutcome:
         """
         Take a turn in a game.
+
+        `turn_key` identifies the turn for the client, if repeated the stored
+        outcome is returned. (otherwise repeats are detected by the question)
         """
-        assert self.session
-        turn = self.db.start_turn(
-            game=self.session,
-            question=question,
-            questions_asked=self.questions_asked,
-            questions_remaining=self.questions_remaining,
-        )
+        state, request, outcome = self._submit_turn(game_id, question, turn_key)
+        if outcome is not None:
+            return outcome
+
+        try:
+            with self._game_lock(game_id):
+                answerer = self._get_answerer(state)
+                turn = self._start_turn(state, question)
+                with self._stats_context() as stats:
+                    summary = answerer.process_turn(question)
+                self._add_stats(game_id, stats)
+                outcome = self.complete_turn(state=state, turn=turn, summary=summary)
+        except BaseException:
+            self._release_request(request)
+            raise
+        self._complete_request(request, turn, outcome)
+        return outcome
+
+    def take_turn_streaming(
+        self, game_id: int, question: str, turn_key: str | None = None
+    ) -> Iterator[TurnUpdate]:
+        """
+        Take a turn in a game, yielding an `AnswerPreview` as soon as the
+        answer is known.
 
-        summary = self.answerer.process_turn(question)
+        The deciding-question check and all db writes happen after the preview
+        has been yielded, the last item is always the `TurnOutcome`.
+        """
+        state, request, outcome = self._submit_turn(game_id, question, turn_key)
+        if outcome is not None:
+            yield outcome
+            return
+
+        try:
+            with self._game_lock(game_id):
+                answerer = self._get_answerer(state)
+                started_at = datetime.now()
+                summary: TurnSummaryT | None = None
+                with self._stats_context() as stats:
+                    for event in answerer.iter_turn(question):
+                        if isinstance(event, TurnAnswer):
+                            yield AnswerPreview(answer=event.answer)
+                        else:
+                            summary = event
+                assert summary
+
+                turn = self._start_turn(state, question, started_at=started_at)
+                self._add_stats(game_id, stats)
+                outcome = self.complete_turn(state=state, turn=turn, summary=summary)
+        except BaseException:
+            self._release_request(request)
+            raise
+        self._complete_request(request, turn, outcome)
+        yield outcome
+
+    def complete_turn(
+        self, state: GameState, turn: Turn, summary: TurnSummaryT
+    ) -> TurnOutcome:
+        """
+        Store the result of a turn and update the game state.
+        """
         self.log_turn(turn=turn, summary=summary)
         if isinstance(summary, ValidQuestionSummary):
             self.db.finish_turn(turn.id, answer=summary.answer.answer)
@@ -218,35 +549,35 @@ class GameController:
             self.db.finish_turn(turn.id)
 
         outcome: TurnOutcome
+        questions_asked = state.questions_asked + 1
+        questions_remaining = self.max_questions - questions_asked
         match summary:
             case InvalidQuestionSummary(begin, validate):
                 outcome = InvalidQuestion(
                     question=begin.question, reason=validate.reason or ""
                 )
             case ValidQuestionSummary(_, _, answer, TurnEndGame(False, _)):
-                self._q_count += 1
-                if self.questions_remaining == 0:
+                if questions_remaining == 0:
                     outcome = LostGame(
-                        questions_asked=self.questions_asked,
-                        questions_remaining=self.questions_remaining,
+                        questions_asked=questions_asked,
+                        questions_remaining=questions_remaining,
                         answer=answer.answer,
-                        subject=self.session.subject,
+                        subject=state.subject,
                     )
-                    self.finish_game(False)
+                    self.finish_game(state.game_id, False)
                 else:
                     outcome = ContinueGame(
-                        questions_asked=self.questions_asked,
-                        questions_remaining=self.questions_remaining,
+                        questions_asked=questions_asked,
+                        questions_remaining=questions_remaining,
                         answer=answer.answer,
                     )
             case ValidQuestionSummary(_, _, answer, TurnEndGame(True, _)):
-                self._q_count += 1
                 outcome = WonGame(
-                    questions_asked=self.questions_asked,
-                    questions_remaining=self.questions_remaining,
+                    questions_asked=questions_asked,
+                    questions_remaining=questions_remaining,
                     answer=answer.answer,
                 )
-                self.finish_game(True)
+                self.finish_game(state.game_id, True)
             case _:
                 raise ValueError(f"Unexpected turn result: {summary!r}")
 
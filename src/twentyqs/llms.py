@@ -0,0 +1,381 @@
+import asyncio
+import logging
+import threading
+import time
+from collections import deque
+from collections.abc import Callable, Hashable, Iterator, Mapping
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+from typing import Any, TypeVar
+
+from langchain import LLMChain, OpenAI
+from langchain.callbacks import get_callback_manager
+from langchain.callbacks.base import BaseCallbackHandler
+from langchain.callbacks.openai_info import get_openai_model_cost_per_1k_tokens
+from langchain.llms import OpenAIChat
+from langchain.schema import BaseLanguageModel, LLMResult
+
+from twentyqs.types import JsonT, Route
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class LLMRouter:
+    """
+    Picks the LLM to use for each chain.
+
+    e.g. validating questions and checking for the deciding question are simple
+    classification tasks that a smaller, faster model can do.
+    """
+
+    default: BaseLanguageModel
+    routes: dict[Route, BaseLanguageModel]
+
+    def __init__(
+        self,
+        default: BaseLanguageModel,
+        routes: Mapping[Route, BaseLanguageModel] | None = None,
+    ):
+        self.default = default
+        self.routes = dict(routes or {})
+
+    def get(self, route: Route) -> BaseLanguageModel:
+        return self.routes.get(route, self.default)
+
+    @classmethod
+    def using_openai(
+        cls,
+        default_model: str,
+        models: Mapping[Route, str | None] | None = None,
+        streaming_routes: tuple[Route, ...] = (),
+        **llm_kwargs,
+    ) -> "LLMRouter":
+        """
+        `models` overrides the model name for some routes, LLMs are shared
+        between routes with the same settings.
+        """
+        llms: dict[tuple[str, bool], BaseLanguageModel] = {}
+
+        def get_llm(model_name: str, streaming: bool) -> BaseLanguageModel:
+            key = (model_name, streaming)
+            if key not in llms:
+                llms[key] = OpenAI(
+                    temperature=0,
+                    model_name=model_name,
+                    streaming=streaming,
+                    **llm_kwargs,
+                )
+            return llms[key]
+
+        models = models or {}
+        return cls(
+            default=get_llm(default_model, False),
+            routes={
+                route: get_llm(
+                    models.get(route) or default_model, route in streaming_routes
+                )
+                for route in Route
+            },
+        )
+
+
+_local = threading.local()
+
+
+@contextmanager
+def using_route(route: Route) -> Iterator[None]:
+    """
+    Label LLM calls made in the current thread, for `RouteStatsHandler`.
+    """
+    previous = getattr(_local, "route", None)
+    _local.route = route
+    try:
+        yield
+    finally:
+        _local.route = previous
+
+
+def current_route() -> Route | None:
+    return getattr(_local, "route", None)
+
+
+class NullCallbackHandler(BaseCallbackHandler):
+    """
+    Callback handler that ignores everything, override the events you need.
+    """
+
+    def on_llm_start(self, *args: Any, **kwargs: Any) -> None:
+        pass
+
+    def on_llm_new_token(self, *args: Any, **kwargs: Any) -> None:
+        pass
+
+    def on_llm_end(self, *args: Any, **kwargs: Any) -> None:
+        pass
+
+    def on_llm_error(self, *args: Any, **kwargs: Any) -> None:
+        pass
+
+    def on_chain_start(self, *args: Any, **kwargs: Any) -> None:
+        pass
+
+    def on_chain_end(self, *args: Any, **kwargs: Any) -> None:
+        pass
+
+    def on_chain_error(self, *args: Any, **kwargs: Any) -> None:
+        pass
+
+    def on_tool_start(self, *args: Any, **kwargs: Any) -> None:
+        pass
+
+    def on_tool_end(self, *args: Any, **kwargs: Any) -> None:
+        pass
+
+    def on_tool_error(self, *args: Any, **kwargs: Any) -> None:
+        pass
+
+    def on_text(self, *args: Any, **kwargs: Any) -> None:
+        pass
+
+    def on_agent_action(self, *args: Any, **kwargs: Any) -> None:
+        pass
+
+    def on_agent_finish(self, *args: Any, **kwargs: Any) -> None:
+        pass
+
+
+@dataclass
+class RouteStats:
+    model_name: str | None = None
+    requests: int = 0
+    errors: int = 0
+    total_latency: float = 0.0
+    prompt_tokens: int = 0
+    # prompt tokens served from the provider's prompt cache (only reported by
+    # the chat completions API)
+    cached_prompt_tokens: int = 0
+    completion_tokens: int = 0
+    total_cost: float = 0.0
+
+    @property
+    def avg_latency(self) -> float | None:
+        if not self.requests:
+            return None
+        return self.total_latency / self.requests
+
+    @property
+    def uncached_prompt_tokens(self) -> int:
+        return self.prompt_tokens - self.cached_prompt_tokens
+
+    def as_json(self) -> dict[str, JsonT]:
+        return asdict(self) | {
+            "avg_latency": self.avg_latency,
+            "uncached_prompt_tokens": self.uncached_prompt_tokens,
+        }
+
+
+def _cost(model_name: str, prompt_tokens: int, completion_tokens: int) -> float:
+    try:
+        return (
+            get_openai_model_cost_per_1k_tokens(model_name) * prompt_tokens
+            + get_openai_model_cost_per_1k_tokens(model_name, is_completion=True)
+            * completion_tokens
+        ) / 1000
+    except ValueError:
+        # not an OpenAI model (or one langchain doesn't know the price of)
+        return 0.0
+
+
+class RouteStatsHandler(NullCallbackHandler):
+    """
+    Collects latency, token usage and cost of LLM calls per `Route`.
+    """
+
+    def __init__(self) -> None:
+        self.stats: dict[str, RouteStats] = {}
+        self._lock = threading.Lock()
+        self._starts = threading.local()
+
+    @property
+    def always_verbose(self) -> bool:
+        return True
+
+    def _pending(self) -> deque[float]:
+        if not hasattr(self._starts, "pending"):
+            self._starts.pending = deque()
+        return self._starts.pending
+
+    def _route_stats(self) -> RouteStats:
+        key = str(current_route() or "other")
+        return self.stats.setdefault(key, RouteStats())
+
+    def on_llm_start(self, *args: Any, **kwargs: Any) -> None:
+        self._pending().append(time.monotonic())
+
+    def on_llm_end(self, response: LLMResult, **kwargs: Any) -> None:
+        pending = self._pending()
+        latency = time.monotonic() - pending.popleft() if pending else 0.0
+        llm_output = response.llm_output or {}
+        token_usage = llm_output.get("token_usage", {})
+        model_name = llm_output.get("model_name")
+        prompt_tokens = token_usage.get("prompt_tokens", 0)
+        completion_tokens = token_usage.get("completion_tokens", 0)
+        prompt_details = token_usage.get("prompt_tokens_details") or {}
+        cached_prompt_tokens = prompt_details.get("cached_tokens", 0)
+        with self._lock:
+            stats = self._route_stats()
+            stats.requests += 1
+            stats.total_latency += latency
+            stats.prompt_tokens += prompt_tokens
+            stats.cached_prompt_tokens += cached_prompt_tokens
+            stats.completion_tokens += completion_tokens
+            if model_name:
+                stats.model_name = model_name
+                stats.total_cost += _cost(model_name, prompt_tokens, completion_tokens)
+
+    def on_llm_error(self, *args: Any, **kwargs: Any) -> None:
+        pending = self._pending()
+        if pending:
+            pending.popleft()
+        with self._lock:
+            self._route_stats().errors += 1
+
+    def get_stats(self) -> dict[str, JsonT]:
+        with self._lock:
+            return {route: stats.as_json() for route, stats in self.stats.items()}
+
+
+class _StatsDispatcher(NullCallbackHandler):
+    """
+    Added once to langchain's global callback manager (which all our LLMs use),
+    passes the LLM events on to the `collecting_stats` handlers of the thread.
+    """
+
+    @property
+    def always_verbose(self) -> bool:
+        return True
+
+    def on_llm_start(self, *args: Any, **kwargs: Any) -> None:
+        for handler in current_stats_handlers():
+            handler.on_llm_start(*args, **kwargs)
+
+    def on_llm_end(self, *args: Any, **kwargs: Any) -> None:
+        for handler in current_stats_handlers():
+            handler.on_llm_end(*args, **kwargs)
+
+    def on_llm_error(self, *args: Any, **kwargs: Any) -> None:
+        for handler in current_stats_handlers():
+            handler.on_llm_error(*args, **kwargs)
+
+
+_dispatcher: _StatsDispatcher | None = None
+_dispatcher_lock = threading.Lock()
+
+
+def _add_dispatcher() -> None:
+    global _dispatcher
+    with _dispatcher_lock:
+        if _dispatcher is None:
+            _dispatcher = _StatsDispatcher()
+            get_callback_manager().add_handler(_dispatcher)
+
+
+def current_stats_handlers() -> tuple[BaseCallbackHandler, ...]:
+    return getattr(_local, "stats_handlers", ())
+
+
+@contextmanager
+def _using_stats_handlers(handlers: tuple[BaseCallbackHandler, ...]) -> Iterator[None]:
+    previous = current_stats_handlers()
+    _local.stats_handlers = handlers
+    try:
+        yield
+    finally:
+        _local.stats_handlers = previous
+
+
+@contextmanager
+def collecting_stats(*handlers: BaseCallbackHandler) -> Iterator[None]:
+    """
+    Send the LLM events of the calls made in the current thread to `handlers`.
+
+    Unlike adding them to langchain's global callback manager, they don't see
+    the calls of concurrent games, and are always removed again. Calls made in
+    other threads on our behalf are counted via `with_current_stats`.
+    (a micro-batch, see `MicroBatcher`, is counted by the thread sending it)
+    """
+    _add_dispatcher()
+    with _using_stats_handlers((*current_stats_handlers(), *handlers)):
+        yield
+
+
+def with_current_stats(fn: Callable[[], T]) -> Callable[[], T]:
+    """
+    Wrap `fn` to be run in another thread, counted by the current thread's
+    `collecting_stats` handlers.
+    """
+    handlers = current_stats_handlers()
+
+    def wrapped() -> T:
+        with _using_stats_handlers(handlers):
+            return fn()
+
+    return wrapped
+
+
+@contextmanager
+def get_route_stats_callback() -> Iterator[RouteStatsHandler]:
+    """
+    Like langchain's `get_openai_callback` but broken down by `Route`, and only
+    for the calls of the current thread (see `collecting_stats`).
+    """
+    handler = RouteStatsHandler()
+    with collecting_stats(handler):
+        yield handler
+
+
+def llm_key(llm: BaseLanguageModel) -> Hashable:
+    """
+    Identifies LLMs with the same settings (pydantic copies the LLM into each
+    chain, so they can't be compared by identity).
+    """
+    params = getattr(llm, "_identifying_params", None)
+    if params is None:
+        return type(llm).__name__, id(llm)
+    return type(llm).__name__, repr(sorted(params.items()))
+
+
+def supports_batching(llm: BaseLanguageModel) -> bool:
+    """
+    Whether the LLM can handle many prompts in a single `generate` call.
+
+    (langchain's OpenAIChat wrapper only accepts a single prompt, and OpenAI
+    completions can't be streamed for multiple prompts)
+    """
+    if isinstance(llm, OpenAIChat):
+        return False
+    return not getattr(llm, "streaming", False)
+
+
+async def _agenerate_each(
+    chain: LLMChain, input_list: list[dict[str, Any]]
+) -> list[str]:
+    results = await asyncio.gather(
+        *(chain.agenerate([inputs]) for inputs in input_list)
+    )
+    return [result.generations[0][0].text for result in results]
+
+
+def generate_many(chain: LLMChain, input_list: list[dict[str, Any]]) -> list[str]:
+    """
+    Get the raw LLM output for each of `input_list`, in a single request if the
+    LLM supports batching, otherwise as concurrent requests.
+    """
+    if not input_list:
+        return []
+    if supports_batching(chain.llm):
+        result = chain.generate(input_list)
+        return [generations[0].text for generations in result.generations]
+    return asyncio.run(_agenerate_each(chain, input_list))
@@ -0,0 +1,46 @@
+import logging
+from datetime import datetime, timedelta
+from threading import Lock
+
+from twentyqs.repository import Repository
+
+logger = logging.getLogger(__name__)
+
+
+class CommonQuestions:
+    """
+    The most commonly asked questions from the game history.
+
+    Answers to these are pre-generated for each new subject (see
+    `AnswerBot.prewarm_answers`). The list is mined from the db lazily and
+    cached for `max_age`, it doesn't need to be very fresh.
+    """
+
+    repository: Repository
+    limit: int
+    max_age: timedelta
+
+    _questions: list[str]
+    _mined_at: datetime | None = None
+
+    def __init__(
+        self,
+        repository: Repository,
+        limit: int,
+        max_age: timedelta = timedelta(hours=1),
+    ):
+        self.repository = repository
+        self.limit = limit
+        self.max_age = max_age
+        self._questions = []
+        self._lock = Lock()
+
+    def get(self) -> list[str]:
+        with self._lock:
+            if self._mined_at is None or datetime.now() - self._mined_at > self.max_age:
+                self._questions = self.repository.get_common_questions(self.limit)
+                self._mined_at = datetime.now()
+                logger.info(
+                    "CommonQuestions.get: mined %d questions", len(self._questions)
+                )
+            return self._questions
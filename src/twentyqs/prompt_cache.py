@@ -0,0 +1,65 @@
+"""
+Checks that the chain prompts are friendly to prefix-based caching.
+
+Provider-side prompt caching (and KV-cache reuse on a local backend) can only
+reuse the leading part of the prompt that is identical between requests, which
+ends at the first template variable. So all the static text (instructions and
+few-shot examples) should come before the first variable, leaving only short
+labels like "Subject: " after it.
+"""
+import os
+from dataclasses import dataclass
+
+from langchain.prompts.base import BasePromptTemplate
+
+from twentyqs.chains.answer_question import AnswerQuestionChain
+from twentyqs.chains.deciding_question import IsDecidingQuestionChain
+from twentyqs.chains.is_yes_no_question import IsYesNoQuestionChain
+from twentyqs.chains.pick_subject import PickSubjectChain
+from twentyqs.llms import Route
+
+# max static chars allowed after the first variable
+MAX_STATIC_TAIL = 100
+
+PROMPTS: dict[Route, BasePromptTemplate] = {
+    Route.PICK_SUBJECT: PickSubjectChain.__fields__["prompt"].default,
+    Route.VALIDATE: IsYesNoQuestionChain.__fields__["prompt"].default,
+    Route.ANSWER: AnswerQuestionChain.__fields__["prompt"].default,
+    Route.DECIDING: IsDecidingQuestionChain.__fields__["prompt"].default,
+}
+
+
+@dataclass(frozen=True)
+class PrefixReport:
+    route: Route
+    # all of the static text in the prompt
+    static_chars: int
+    # the static text before the first variable, i.e. the cacheable part
+    prefix_chars: int
+
+    @property
+    def tail_chars(self) -> int:
+        return self.static_chars - self.prefix_chars
+
+    @property
+    def ok(self) -> bool:
+        return self.tail_chars <= MAX_STATIC_TAIL
+
+
+def _render(prompt: BasePromptTemplate, marker: str) -> str:
+    return prompt.format(**{var: marker for var in prompt.input_variables})
+
+
+def check_prefix(route: Route, prompt: BasePromptTemplate) -> PrefixReport:
+    static = _render(prompt, "")
+    # the renderings differ from the first char of the first variable
+    prefix = os.path.commonprefix([_render(prompt, "\x00"), _render(prompt, "\x01")])
+    return PrefixReport(
+        route=route,
+        static_chars=len(static),
+        prefix_chars=len(prefix),
+    )
+
+
+def check_prefixes() -> list[PrefixReport]:
+    return [check_prefix(route, prompt) for route, prompt in PROMPTS.items()]
@@ -1,13 +1,23 @@
 import random
+import sqlite3
 import string
+import sys
+import time
 import warnings
+from collections import Counter
+from collections.abc import Mapping
 from functools import wraps
-from datetime import datetime
-from typing import Sequence, Optional, List
+from datetime import date, datetime
+from itertools import zip_longest
+from typing import TYPE_CHECKING, Any, Sequence, Optional, List
+from weakref import WeakSet
 
+from sqlalchemy import Index, UniqueConstraint, event, text
 from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError, OperationalError
 from sqlalchemy.ext.asyncio import AsyncEngine
-from sqlalchemy.orm import aliased
+from sqlalchemy.orm import aliased, selectinload
+from sqlalchemy.orm.attributes import get_history
 from sqlalchemy_get_or_create import get_or_create
 from sqlmodel import (
     Field,
@@ -22,14 +32,37 @@ from sqlmodel import (
     and_,
 )
 
+from twentyqs.cache import IdleCache
+from twentyqs.rules import normalize_question
 from twentyqs.serde import serialize, deserialize
-from twentyqs.types import JsonT, LogKey, ServerStats, TurnReview, UserStats
+from twentyqs.types import (
+    GameState,
+    JsonT,
+    LogKey,
+    ServerStats,
+    TurnReview,
+    TurnSearchResult,
+    UserStats,
+)
+
+if TYPE_CHECKING:
+    from twentyqs.archive import TurnLogArchive
 
 
 class NotFound(Exception):
     pass
 
 
+class TurnInProgress(Exception):
+    """
+    Another turn of the game is still being played.
+    """
+
+
+class _WatermarkMoved(Exception):
+    pass
+
+
 def get_code(length=8) -> str:
     return "".join(random.choices(string.ascii_letters + string.digits, k=length))
 
@@ -84,6 +117,241 @@ class TurnLog(SQLModel, table=True):
     value: dict = Field(default_factory=dict, sa_column=Column(JSON))
 
 
+class TurnRequest(SQLModel, table=True):
+    """
+    Submissions of a turn, so that a repeated submission (double-click, network
+    retry) gets the stored outcome rather than playing the turn again.
+
+    Only one request per game can be in progress (have no outcome) at a time,
+    so the turns of a game are played one after the other.
+    """
+
+    __table_args__ = (
+        UniqueConstraint(
+            "gamesession_id", "request_key", name="turnrequest_gamesession_id_key"
+        ),
+        Index(
+            "turnrequest_in_progress",
+            "gamesession_id",
+            unique=True,
+            sqlite_where=text("outcome IS NULL"),
+        ),
+    )
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    gamesession_id: int = Field(foreign_key="gamesession.id", index=True)
+    # the client's turn id, or derived from the question and game state
+    request_key: str
+    question_hash: str
+    created_at: datetime = Field(default_factory=datetime.now)
+    turn_id: Optional[int] = Field(default=None, foreign_key="turn.id")
+    # `None` until the turn is complete
+    outcome: dict | None = Field(
+        default=None, sa_column=Column(JSON(none_as_null=True))
+    )
+
+
+class StageLatency(SQLModel, table=True):
+    """
+    Latency of a stage of the turns, summarised per day and model.
+    (see `twentyqs.analytics`)
+    """
+
+    __table_args__ = (
+        UniqueConstraint("day", "stage", "model", name="stagelatency_day_stage_model"),
+    )
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    day: date = Field(index=True)
+    stage: str
+    model: str
+    count: int = 0
+    total_ms: float = 0
+    max_ms: float = 0
+    # counts per bucket of `analytics.BUCKETS_MS`
+    histogram: list[int] = Field(default_factory=list, sa_column=Column(JSON))
+
+
+class Watermark(SQLModel, table=True):
+    """
+    The last row id processed by an incremental job.
+    """
+
+    name: str = Field(primary_key=True)
+    last_id: int = 0
+
+
+class CachedUserStats(SQLModel, table=True):
+    """
+    `UserStats` as of the user's last game started or finished, so that they
+    aren't recomputed from all the user's games every time (see `get_user_stats`).
+    """
+
+    user_id: int = Field(foreign_key="user.id", primary_key=True)
+    stats: dict = Field(default_factory=dict, sa_column=Column(JSON))
+    computed_at: datetime = Field(default_factory=datetime.now)
+
+
+class BackfillProgress(SQLModel, table=True):
+    """
+    Checkpoint of a data backfill, which runs in batches of row ids up to the
+    `max_id` of its table when it started (see `twentyqs.backfill`).
+    """
+
+    name: str = Field(primary_key=True)
+    last_id: int = 0
+    max_id: int = 0
+    rows_updated: int = 0
+    started_at: datetime = Field(default_factory=datetime.now)
+    updated_at: datetime = Field(default_factory=datetime.now)
+    finished_at: Optional[datetime]
+
+
+def merge_llm_stats(
+    totals: Mapping[str, JsonT], stats: Mapping[str, JsonT]
+) -> dict[str, JsonT]:
+    """
+    Add up (nested) LLM stats, e.g. from `get_openai_callback` or `RouteStats`.
+    Non-numeric values are taken from `stats`.
+    """
+    merged = dict(totals)
+    for key, value in stats.items():
+        current = merged.get(key)
+        if isinstance(value, Mapping) and isinstance(current, Mapping):
+            merged[key] = merge_llm_stats(current, value)
+        elif (
+            isinstance(value, int | float)
+            and isinstance(current, int | float)
+            and not isinstance(value, bool)
+        ):
+            merged[key] = current + value
+        else:
+            merged[key] = value
+    # (averages can't be added up)
+    requests, total_latency = merged.get("requests"), merged.get("total_latency")
+    if (
+        "avg_latency" in merged
+        and isinstance(requests, int)
+        and requests
+        and isinstance(total_latency, int | float)
+    ):
+        merged["avg_latency"] = total_latency / requests
+    return merged
+
+
+# Full-text index of the turns: their question, the game's subject and the
+# validation reason, one row per turn with `rowid` = `turn.id`. Kept in sync by
+# triggers, so it also covers writes made outside the repository (the admin,
+# backfills). The reason is copied in when logged, so it stays searchable once
+# the logs are archived. Existing turns are indexed by the `turn_search`
+# backfill. (not a model, so created here rather than by `create_all`)
+TURN_SEARCH_DDL = [
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS turn_search
+    USING fts5(question, subject, reason, tokenize = 'porter unicode61')
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS turn_search_turn_insert AFTER INSERT ON turn
+    BEGIN
+        INSERT INTO turn_search (rowid, question, subject)
+        SELECT new.id, new.question, subject FROM gamesession
+        WHERE id = new.gamesession_id;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS turn_search_turn_update
+    AFTER UPDATE OF question ON turn
+    BEGIN
+        UPDATE turn_search SET question = new.question WHERE rowid = new.id;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS turn_search_turn_delete AFTER DELETE ON turn
+    BEGIN
+        DELETE FROM turn_search WHERE rowid = old.id;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS turn_search_gamesession_update
+    AFTER UPDATE OF subject ON gamesession
+    BEGIN
+        UPDATE turn_search SET subject = new.subject
+        WHERE rowid IN (SELECT id FROM turn WHERE gamesession_id = new.id);
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS turn_search_turnlog_insert AFTER INSERT ON turnlog
+    WHEN new.key = '{LogKey.VALIDATE_QUESTION.value}'
+    BEGIN
+        UPDATE turn_search SET reason = json_extract(new.value, '$.reason')
+        WHERE rowid = new.turn_id;
+    END
+    """,
+]
+
+TURN_SEARCH_DROP = [
+    "DROP TRIGGER IF EXISTS turn_search_turn_insert",
+    "DROP TRIGGER IF EXISTS turn_search_turn_update",
+    "DROP TRIGGER IF EXISTS turn_search_turn_delete",
+    "DROP TRIGGER IF EXISTS turn_search_gamesession_update",
+    "DROP TRIGGER IF EXISTS turn_search_turnlog_insert",
+    "DROP TABLE IF EXISTS turn_search",
+]
+
+# wrapped around the matched terms in `TurnSearchResult`s
+HIGHLIGHT_START = "\x02"
+HIGHLIGHT_END = "\x03"
+
+TURN_SEARCH_Q = text(
+    """
+    SELECT
+        turn.id AS turn_id,
+        turn.gamesession_id,
+        turn.started_at,
+        turn.answer,
+        highlight(turn_search, 0, :hl_start, :hl_end) AS question,
+        highlight(turn_search, 1, :hl_start, :hl_end) AS subject,
+        highlight(turn_search, 2, :hl_start, :hl_end) AS reason
+    FROM turn_search
+    JOIN turn ON turn.id = turn_search.rowid
+    WHERE turn_search MATCH :query
+    ORDER BY rank
+    LIMIT :limit OFFSET :offset
+    """
+)
+
+
+def check_search_query(query: str) -> None:
+    """
+    Raises `ValueError` if `query` isn't valid FTS5 syntax for `turn_search`.
+
+    (checked against an empty in-memory copy of the table, so that errors in
+    the query can be told apart from errors in the db)
+    """
+    conn = sqlite3.connect(":memory:")
+    try:
+        conn.execute(TURN_SEARCH_DDL[0])
+        conn.execute(
+            "SELECT rowid FROM turn_search WHERE turn_search MATCH ?", (query,)
+        )
+    except sqlite3.OperationalError as e:
+        raise ValueError(str(e)) from e
+    finally:
+        conn.close()
+
+
+@event.listens_for(SQLModel.metadata, "after_create")
+def _create_turn_search(target, connection, **kwargs) -> None:
+    for statement in TURN_SEARCH_DDL:
+        connection.exec_driver_sql(statement)
+
+
+@event.listens_for(SQLModel.metadata, "before_drop")
+def _drop_turn_search(target, connection, **kwargs) -> None:
+    for statement in TURN_SEARCH_DROP:
+        connection.exec_driver_sql(statement)
+
+
 def with_session(f):
     """
     Will use the session passed in if given, or create a new one if none is passed.
@@ -99,6 +367,39 @@ def with_session(f):
     return wrapper
 
 
+def retry_if_locked(f, attempts: int = 5, delay: float = 0.01):
+    """
+    Retry a write which fails straight away as "database is locked".
+
+    SQLite only waits for the write lock (up to the busy timeout) if the
+    transaction hasn't read yet, but the FTS5 `turn_search` triggers read the
+    index config first, so writes which fire them fail at once while another
+    connection is writing.
+    (only when the method makes its own session, see `with_session`)
+    """
+
+    @wraps(f)
+    def wrapper(self, *args, **kwargs):
+        own_session = not (
+            "session" in kwargs or (args and isinstance(args[0], Session))
+        )
+        wait = delay
+        for attempt in range(attempts):
+            try:
+                return f(self, *args, **kwargs)
+            except OperationalError as e:
+                if (
+                    not own_session
+                    or attempt == attempts - 1
+                    or "database is locked" not in str(e)
+                ):
+                    raise
+            time.sleep(wait)
+            wait *= 2
+
+    return wrapper
+
+
 _validate_alias = aliased(TurnLog)
 _answer_alias = aliased(TurnLog)
 _deciding_alias = aliased(TurnLog)
@@ -108,6 +409,7 @@ TURN_REVIEW_Q = (
         GameSession.id.label("gamesession_id"),  # type: ignore
         Turn.questions_asked.label("valid_q_n"),  # type: ignore
         Turn.id.label("turn_id"),  # type: ignore
+        Turn.started_at,
         GameSession.subject,
         Turn.question,
         func.json_extract(_validate_alias.value, "$.is_valid").label("is_valid"),
@@ -145,12 +447,62 @@ TURN_REVIEW_Q = (
 # https://docs.sqlalchemy.org/en/20/orm/nonstandard_mappings.html#mapping-a-class-against-arbitrary-subqueries
 
 
+# (the user caches of all the repositories, see `_invalidate_cached_user`)
+_user_caches: "WeakSet[IdleCache[str, User]]" = WeakSet()
+
+
+@event.listens_for(User, "after_update")
+@event.listens_for(User, "after_delete")
+def _invalidate_cached_user(mapper, connection, target: User) -> None:
+    """
+    Forget a user edited through the ORM (e.g. in the admin), in any repository.
+    """
+    usernames = {target.username, *get_history(target, "username").deleted}
+    for cache in list(_user_caches):
+        for username in usernames:
+            cache.pop(username)
+
+
+@event.listens_for(GameSession, "after_update")
+@event.listens_for(GameSession, "after_delete")
+@event.listens_for(User, "after_delete")
+def _invalidate_cached_user_stats(mapper, connection, target) -> None:
+    """
+    Forget the stats of a user whose games were edited through the ORM (e.g.
+    deleted in the admin). The repository's own writes do this explicitly.
+    """
+    user_id = target.id if isinstance(target, User) else target.user_id
+    connection.execute(
+        CachedUserStats.__table__.delete().where(  # type: ignore
+            CachedUserStats.__table__.c.user_id == user_id  # type: ignore
+        )
+    )
+
+
 class Repository:
     engine: Engine | AsyncEngine
+    # users recently authenticated, so that logged-in admins and players don't
+    # cost a query per request
+    users: IdleCache[str, User]
 
     def __init__(
-        self, db_path: str | None = None, engine: Engine | AsyncEngine | None = None
+        self,
+        db_path: str | None = None,
+        engine: Engine | AsyncEngine | None = None,
+        auth_cache_ttl: float = 60,
+        auth_cache_size: int = 1000,
+        archive: "TurnLogArchive | None" = None,
     ):
+        """
+        Users are cached for up to `auth_cache_ttl` seconds (0 to disable), and
+        forgotten straight away when edited through the ORM.
+
+        `archive` is where the reviews find the logs of archived turns.
+        """
+        self.archive = archive
+        self.users = IdleCache(auth_cache_size, ttl=auth_cache_ttl)
+        if auth_cache_ttl:
+            _user_caches.add(self.users)
         if not db_path and not engine:
             raise ValueError("Either db_path or engine must be given")
         if engine:
@@ -167,10 +519,13 @@ class Repository:
     def __del__(self):
         self.engine.dispose()
 
-    def init_db(self, drop=False):
+    def init_db(self, drop=False, create_tables=True):
         if drop:
             SQLModel.metadata.drop_all(self.engine)
-        SQLModel.metadata.create_all(self.engine)
+        if create_tables:
+            # (reflects the db to find missing tables, which is slow-ish, so
+            # skipped at startup when we know the db is already migrated)
+            SQLModel.metadata.create_all(self.engine)
 
     @with_session
     def get_or_create_user(self, session: Session, username: str) -> User:
@@ -197,6 +552,29 @@ class Repository:
             )
         ).one_or_none()
 
+    def _get_user_cached(self, session: Session, username: str) -> User | None:
+        user = self.users.get(username) if self.users.ttl else None
+        if user is None:
+            user = self.get_by_username(session, username)
+            if user is not None and self.users.ttl:
+                self.users.put(username, user)
+        return user
+
+    @with_session
+    def authenticated_admin(
+        self, session: Session, username: str, password: str | None = None
+    ) -> User | None:
+        """
+        The admin user, if `password` is right (or if not given, i.e. they
+        logged in already). Cached, see `__init__`.
+        """
+        user = self._get_user_cached(session, username)
+        if not user or not user.is_admin:
+            return None
+        if password is not None and user.password != password:
+            return None
+        return user
+
     @with_session
     def authenticate_player(
         self, session: Session, username: str, password: str
@@ -212,7 +590,10 @@ class Repository:
     def authenticated_player(
         self, session: Session, username: str, password: str
     ) -> User | None:
-        user = self.get_by_username(session, username)
+        """
+        Cached, see `__init__`.
+        """
+        user = self._get_user_cached(session, username)
         if not user:
             return None
         if not user.password == password:
@@ -242,6 +623,8 @@ class Repository:
         with session.begin_nested():
             game = GameSession(user=user, subject=subject)
             session.add(game)
+            session.flush()
+            self._invalidate_user_stats(session, game.user_id)
         return game
 
     @with_session
@@ -254,42 +637,98 @@ class Repository:
     ) -> None:
         """
         Finish a game.
+
+        `llm_stats` if given replaces those recorded so far (see `add_llm_stats`).
         """
+        values: dict[Any, Any] = {
+            GameSession.finished_at: datetime.now(),
+            GameSession.user_won: user_won,
+        }
+        if llm_stats is not None:
+            values[GameSession.llm_stats] = llm_stats
         with session.begin_nested():
             updated = (
                 session.query(GameSession)
                 .filter(GameSession.id == game_id)
-                .update(
-                    {
-                        GameSession.finished_at: datetime.now(),
-                        GameSession.user_won: user_won,
-                        GameSession.llm_stats: llm_stats,
-                    }
-                )
+                .update(values)
+            )
+            self._invalidate_user_stats(
+                session,
+                select(GameSession.user_id)
+                .where(GameSession.id == game_id)
+                .scalar_subquery(),
             )
         if not updated:
             raise NotFound(GameSession, game_id)
         if updated > 1:
             warnings.warn(f"Updated {updated} rows for GameSession id:{game_id}")
 
+    @with_session
+    def add_llm_stats(
+        self, session: Session, game_id: int, llm_stats: dict[str, JsonT]
+    ) -> None:
+        """
+        Add the LLM stats for a single request to the totals for the game.
+        """
+        with session.begin_nested():
+            game = session.get(GameSession, game_id)
+            if game is None:
+                raise NotFound(GameSession, game_id)
+            game.llm_stats = merge_llm_stats(game.llm_stats or {}, llm_stats)
+            session.add(game)
+
+    @with_session
+    def get_game_state(self, session: Session, game_id: int) -> GameState:
+        """
+        Return the current state of a game, to resume it.
+        """
+        query = (
+            select(  # type: ignore
+                GameSession.id,
+                User.username,
+                GameSession.subject,
+                GameSession.finished_at,
+                # only valid questions are answered
+                func.count(Turn.answer),
+            )
+            .join(User, User.id == GameSession.user_id)
+            .outerjoin(Turn, Turn.gamesession_id == GameSession.id)
+            .filter(GameSession.id == game_id)
+            .group_by(GameSession.id)
+        )
+        row = session.exec(query).one_or_none()
+        if row is None:
+            raise NotFound(GameSession, game_id)
+        game_id, username, subject, finished_at, questions_asked = row
+        return GameState(
+            game_id=game_id,
+            username=username,
+            subject=subject,
+            questions_asked=questions_asked,
+            finished=finished_at is not None,
+        )
+
+    @retry_if_locked
     @with_session
     def start_turn(
         self,
         session: Session,
-        game: GameSession,
+        game_id: int,
         question: str,
         questions_asked: int,
         questions_remaining: int,
+        started_at: datetime | None = None,
     ) -> Turn:
         """
         Start a new turn for a game.
         """
         with session.begin_nested():
             turn = Turn(
-                gamesession=game,
+                gamesession_id=game_id,
                 question=question,
                 questions_asked=questions_asked,
                 questions_remaining=questions_remaining,
+                started_at=started_at or datetime.now(),
             )
             session.add(turn)
         return turn
@@ -317,6 +756,160 @@ class Repository:
         if updated > 1:
             warnings.warn(f"Updated {updated} rows for Turn id:{turn_id}")
 
+    @with_session
+    def claim_turn_request(
+        self,
+        session: Session,
+        game_id: int,
+        request_key: str,
+        question_hash: str,
+        match_latest_within: float | None = None,
+        stale_after: float | None = None,
+    ) -> tuple[TurnRequest, bool]:
+        """
+        Record a turn submission, unless it repeats an earlier one.
+
+        Returns the request and whether it is new, i.e. the caller should play
+        the turn and `complete_turn_request` it.
+
+        `match_latest_within` (seconds) also treats it as a repeat if the latest
+        request for the game has the same `question_hash` and is still in
+        progress or its turn finished less than this long ago (a retry arriving after the
+        turn has completed and moved the game state on). Asking the same
+        question again later is a new turn.
+        `stale_after` (seconds) a request which still has no outcome after this
+        long is assumed abandoned: a repeat of it is handed over to the caller,
+        any other request replaces it.
+
+        Raises `TurnInProgress` if another turn of the game is in progress.
+        """
+        existing = session.exec(
+            select(TurnRequest).where(
+                TurnRequest.gamesession_id == game_id,
+                TurnRequest.request_key == request_key,
+            )
+        ).one_or_none()
+        if existing is None and match_latest_within is not None:
+            latest = session.exec(
+                select(TurnRequest)
+                .where(TurnRequest.gamesession_id == game_id)
+                .order_by(TurnRequest.id.desc())  # type: ignore
+                .limit(1)
+            ).first()
+            if (
+                latest is not None
+                and latest.question_hash == question_hash
+                and (
+                    latest.outcome is None
+                    or self._completed_within(session, latest, match_latest_within)
+                )
+            ):
+                existing = latest
+
+        if existing is None:
+            in_progress = session.exec(
+                select(TurnRequest).where(
+                    TurnRequest.gamesession_id == game_id,
+                    TurnRequest.outcome.is_(None),  # type: ignore
+                )
+            ).first()
+            if in_progress is not None and (
+                # (submitted concurrently since we looked above)
+                in_progress.request_key == request_key
+                or (
+                    match_latest_within is not None
+                    and in_progress.question_hash == question_hash
+                )
+            ):
+                existing = in_progress
+            elif in_progress is not None:
+                if not self._is_stale(in_progress, stale_after):
+                    raise TurnInProgress(game_id)
+                with session.begin_nested():
+                    session.delete(in_progress)
+
+        if existing is None:
+            request = TurnRequest(
+                gamesession_id=game_id,
+                request_key=request_key,
+                question_hash=question_hash,
+            )
+            try:
+                with session.begin_nested():
+                    session.add(request)
+            except IntegrityError:
+                # a concurrent submission (of this or another turn) got in first
+                # (end the transaction, so as not to hold the write lock)
+                session.rollback()
+                return self.claim_turn_request(
+                    session,
+                    game_id,
+                    request_key,
+                    question_hash,
+                    match_latest_within=match_latest_within,
+                    stale_after=stale_after,
+                )
+            return request, True
+
+        if existing.outcome is None and self._is_stale(existing, stale_after):
+            with session.begin_nested():
+                existing.created_at = datetime.now()
+                session.add(existing)
+            return existing, True
+        return existing, False
+
+    def _is_stale(self, request: TurnRequest, stale_after: float | None) -> bool:
+        return (
+            stale_after is not None
+            and (datetime.now() - request.created_at).total_seconds() > stale_after
+        )
+
+    def _completed_within(
+        self, session: Session, request: TurnRequest, seconds: float
+    ) -> bool:
+        turn = session.get(Turn, request.turn_id) if request.turn_id else None
+        completed_at = (turn and turn.finished_at) or request.created_at
+        return (datetime.now() - completed_at).total_seconds() < seconds
+
+    @with_session
+    def get_turn_request(self, session: Session, request_id: int) -> TurnRequest:
+        request = session.get(TurnRequest, request_id)
+        if request is None:
+            raise NotFound(TurnRequest, request_id)
+        return request
+
+    @with_session
+    def complete_turn_request(
+        self,
+        session: Session,
+        request_id: int,
+        turn_id: int | None,
+        outcome: dict[str, JsonT],
+    ) -> None:
+        """
+        Store the outcome of a turn, for repeats of the request.
+        """
+        with session.begin_nested():
+            updated = (
+                session.query(TurnRequest)
+                .filter(TurnRequest.id == request_id)
+                .update({TurnRequest.turn_id: turn_id, TurnRequest.outcome: outcome})
+            )
+        if not updated:
+            raise NotFound(TurnRequest, request_id)
+
+    @with_session
+    def release_turn_request(self, session: Session, request_id: int) -> None:
+        """
+        Forget a request whose turn failed, so it can be submitted again.
+        """
+        with session.begin_nested():
+            session.query(TurnRequest).filter(
+                TurnRequest.id == request_id,
+                TurnRequest.outcome.is_(None),  # type: ignore
+            ).delete()
+
+    @retry_if_locked
     @with_session
     def store_turn_logs(
         self, session: Session, logs: Sequence[dict[str, JsonT]]
@@ -329,11 +922,312 @@ class Repository:
         with session.begin_nested():
             session.bulk_insert_mappings(TurnLog, logs)
 
+    @with_session
+    def get_watermark(self, session: Session, name: str) -> int:
+        watermark = session.get(Watermark, name)
+        return watermark.last_id if watermark else 0
+
+    @with_session
+    def get_turns_after(
+        self, session: Session, after_id: int, started_before: datetime, limit: int
+    ) -> list[tuple[Turn, Mapping | None]]:
+        """
+        Turns (with their logs) after `after_id`, and the `llm_stats` of their
+        game, in id order.
+
+        Stops before the first turn not started before `started_before`, even
+        if later ids were, so a watermark moved to the last turn returned never
+        passes a turn which is still to come.
+        """
+        # (ids don't strictly follow `started_at`)
+        first_too_recent = (
+            select(Turn.id)
+            .where(
+                Turn.id > after_id,  # type: ignore
+                Turn.started_at >= started_before,
+            )
+            .order_by(Turn.id.asc())  # type: ignore
+            .limit(1)
+            .scalar_subquery()
+        )
+        query = (
+            select(Turn, GameSession.llm_stats)
+            .join(GameSession, GameSession.id == Turn.gamesession_id)
+            .where(
+                Turn.id > after_id,  # type: ignore
+                Turn.id < func.coalesce(first_too_recent, sys.maxsize),
+            )
+            .order_by(Turn.id.asc())  # type: ignore
+            .limit(limit)
+            .options(selectinload(Turn.logs))
+        )
+        return [(turn, llm_stats) for turn, llm_stats in session.exec(query).all()]
+
+    @with_session
+    def add_stage_latency(
+        self,
+        session: Session,
+        deltas: Sequence[StageLatency],
+        watermark: str,
+        from_id: int,
+        to_id: int,
+    ) -> bool:
+        """
+        Add to the stage latency summaries and move the watermark on from
+        `from_id` to `to_id`, atomically.
+
+        Returns `False` (and changes nothing) if the watermark is no longer at
+        `from_id`, i.e. another process summarised these turns first.
+        """
+        try:
+            with session.begin_nested():
+                self._move_watermark(session, watermark, from_id, to_id)
+                for delta in deltas:
+                    row = session.exec(
+                        select(StageLatency).where(
+                            StageLatency.day == delta.day,
+                            StageLatency.stage == delta.stage,
+                            StageLatency.model == delta.model,
+                        )
+                    ).one_or_none()
+                    if row is None:
+                        session.add(delta)
+                        continue
+                    row.count += delta.count
+                    row.total_ms += delta.total_ms
+                    row.max_ms = max(row.max_ms, delta.max_ms)
+                    row.histogram = [
+                        a + b
+                        for a, b in zip_longest(
+                            row.histogram, delta.histogram, fillvalue=0
+                        )
+                    ]
+                    session.add(row)
+        except (_WatermarkMoved, IntegrityError):
+            return False
+        return True
+
+    @with_session
+    def delete_archived_turn_logs(
+        self,
+        session: Session,
+        turn_ids: Sequence[int],
+        watermark: str,
+        from_id: int,
+        to_id: int,
+    ) -> bool:
+        """
+        Delete the logs of turns which have been archived (see `twentyqs.archive`)
+        and move the watermark on from `from_id` to `to_id`, atomically.
+
+        Returns `False` (and changes nothing) if the watermark is no longer at
+        `from_id`, i.e. another process archived these turns first.
+        """
+        try:
+            with session.begin_nested():
+                self._move_watermark(session, watermark, from_id, to_id)
+                session.query(TurnLog).filter(
+                    TurnLog.turn_id.in_(turn_ids)  # type: ignore
+                ).delete(synchronize_session=False)
+        except (_WatermarkMoved, IntegrityError):
+            return False
+        return True
+
+    def _move_watermark(
+        self, session: Session, name: str, from_id: int, to_id: int
+    ) -> None:
+        moved = (
+            session.query(Watermark)
+            .filter(Watermark.name == name, Watermark.last_id == from_id)
+            .update({Watermark.last_id: to_id})
+        )
+        if moved:
+            return
+        if from_id == 0 and session.get(Watermark, name) is None:
+            session.add(Watermark(name=name, last_id=to_id))
+            session.flush()
+            return
+        raise _WatermarkMoved(name)
+
+    @with_session
+    def get_backfill_progress(self, session: Session) -> list[BackfillProgress]:
+        return list(session.exec(select(BackfillProgress)).all())
+
+    @with_session
+    def start_backfill(
+        self, session: Session, name: str, table: str
+    ) -> BackfillProgress:
+        """
+        Get the checkpoint of a backfill, or start one over the rows currently
+        in `table` (rows added later are expected to be written complete).
+        """
+        progress = session.get(BackfillProgress, name)
+        if progress is not None:
+            return progress
+        max_id = session.execute(text(f"SELECT max(id) FROM {table}")).scalar()
+        try:
+            with session.begin_nested():
+                progress = BackfillProgress(name=name, max_id=max_id or 0)
+                if not progress.max_id:
+                    progress.finished_at = datetime.now()
+                session.add(progress)
+        except IntegrityError:
+            # (started concurrently by another process)
+            progress = session.get(BackfillProgress, name)
+            assert progress is not None
+            return progress
+        session.refresh(progress)
+        return progress
+
+    @with_session
+    def run_backfill_batch(
+        self, session: Session, name: str, statement: str, start: int, end: int
+    ) -> BackfillProgress | None:
+        """
+        Run a backfill `statement` over the ids `start` < id <= `end` and move its
+        checkpoint on to `end`, atomically.
+
+        Returns `None` (and changes nothing) if the checkpoint is no longer at
+        `start`, i.e. another process ran this batch first.
+        """
+        now = datetime.now()
+        with session.begin_nested():
+            moved = (
+                session.query(BackfillProgress)
+                .filter(
+                    BackfillProgress.name == name,
+                    BackfillProgress.last_id == start,
+                    BackfillProgress.finished_at.is_(None),  # type: ignore
+                )
+                .update({BackfillProgress.last_id: end})
+            )
+            if not moved:
+                return None
+            result = session.execute(text(statement), {"start": start, "end": end})
+            progress = session.get(BackfillProgress, name)
+            assert progress is not None
+            progress.rows_updated += max(result.rowcount, 0)  # type: ignore
+            progress.updated_at = now
+            if end >= progress.max_id:
+                progress.finished_at = now
+            session.add(progress)
+        session.refresh(progress)
+        return progress
+
+    @with_session
+    def get_stage_latency(self, session: Session, since: date) -> list[StageLatency]:
+        query = (
+            select(StageLatency)
+            .where(StageLatency.day >= since)
+            .order_by(
+                StageLatency.day.desc(),  # type: ignore
+                StageLatency.stage,
+                StageLatency.model,
+            )
+        )
+        return list(session.exec(query).all())
+
+    @with_session
+    def get_common_questions(self, session: Session, limit: int) -> list[str]:
+        """
+        Return the `limit` most frequently asked valid questions.
+
+        Questions are grouped after normalizing (case, whitespace, punctuation),
+        the most common original phrasing of each is returned.
+        """
+        text = func.lower(func.trim(Turn.question))
+        query = (
+            select(text, func.count())  # type: ignore
+            .select_from(Turn)
+            .filter(Turn.answer.isnot(None))  # type: ignore
+            .group_by(text)
+            .order_by(func.count().desc())
+            # over-fetch as some of these will be merged by normalization
+            .limit(limit * 5)
+        )
+        counts: Counter[str] = Counter()
+        phrasings: dict[str, str] = {}
+        for question, count in session.exec(query):
+            normalized = normalize_question(question)
+            if not normalized:
+                continue
+            counts[normalized] += count
+            phrasings.setdefault(normalized, question)
+        return [phrasings[normalized] for normalized, _ in counts.most_common(limit)]
+
+    @with_session
+    def get_validation_history(self, session: Session) -> list[tuple[str, bool]]:
+        """
+        Return (question, is_valid) for every question validated by the LLM.
+        """
+        query = (
+            select(  # type: ignore
+                Turn.question,
+                func.json_extract(TurnLog.value, "$.is_valid"),
+            )
+            .join(TurnLog, TurnLog.turn_id == Turn.id)
+            .filter(
+                TurnLog.key == LogKey.VALIDATE_QUESTION.value,
+                Turn.question.isnot(None),  # type: ignore
+                # older logs don't have the `rule_based` key
+                func.coalesce(func.json_extract(TurnLog.value, "$.rule_based"), 0) == 0,
+            )
+        )
+        return [
+            (question, bool(is_valid)) for question, is_valid in session.exec(query)
+        ]
+
+    @with_session
+    def get_prompt_token_usage(self, session: Session) -> dict[str, tuple[int, int]]:
+        """
+        Return (prompt_tokens, cached_prompt_tokens) per route, summed over the
+        `llm_stats` of all finished games.
+        """
+        query = select(GameSession.llm_stats)  # type: ignore
+        usage: dict[str, tuple[int, int]] = {}
+        for llm_stats in session.exec(query):
+            # (JSON null, not SQL NULL, for unfinished games)
+            if not llm_stats:
+                continue
+            for route, stats in (llm_stats.get("routes") or {}).items():
+                prompt_tokens, cached = usage.get(route, (0, 0))
+                usage[route] = (
+                    prompt_tokens + stats.get("prompt_tokens", 0),
+                    # older stats don't have the `cached_prompt_tokens` key
+                    cached + stats.get("cached_prompt_tokens", 0),
+                )
+        return usage
+
+    def _invalidate_user_stats(self, session: Session, user_id: Any) -> None:
+        session.query(CachedUserStats).filter(
+            CachedUserStats.user_id == user_id
+        ).delete(synchronize_session=False)
+
     @with_session
     def get_user_stats(self, session: Session, username: str) -> UserStats:
         """
         Return the number of games played, won and lost for a user.
+
+        Cached until the user next starts or finishes a game.
         """
+        user_id = session.exec(select(User.id).where(User.username == username)).first()
+        if user_id is None:
+            return self._compute_user_stats(session, username)
+        try:
+            # (computed and stored in one transaction, so that a game finished
+            # meanwhile can't leave stale stats in the cache)
+            with session.begin_nested():
+                cached = session.get(CachedUserStats, user_id)
+                if cached is not None:
+                    return UserStats.parse_obj(cached.stats)
+                stats = self._compute_user_stats(session, username)
+                session.add(CachedUserStats(user_id=user_id, stats=stats.dict()))
+        except (IntegrityError, OperationalError):
+            # (cached concurrently, or the db is busy: just don't cache it)
+            return self._compute_user_stats(session, username)
+        return stats
+
+    def _compute_user_stats(self, session: Session, username: str) -> UserStats:
         query = (
             select(GameSession.user_won, func.count())  # type: ignore
             .select_from(GameSession)
@@ -445,8 +1339,52 @@ class Repository:
         ).order_by(
             Turn.id.asc()  # type: ignore
         )
-        result = session.execute(query).fetchall()
-        return [TurnReview.parse_obj(row) for row in result]
+        return self._turn_reviews(session.execute(query).fetchall())
+
+    def _turn_reviews(self, result: Sequence[Any]) -> list[TurnReview]:
+        """
+        (reading the logs of the turns which have been archived from the archive)
+        """
+        rows = [dict(row._mapping) for row in result]
+        archived = {
+            row["turn_id"]: row["started_at"] for row in rows if row["is_valid"] is None
+        }
+        if archived and self.archive is not None:
+            logs = self.archive.get_logs(archived)
+            for row in rows:
+                for log in logs.get(row["turn_id"], []):
+                    value = log["value"]
+                    if log["key"] == LogKey.VALIDATE_QUESTION:
+                        row["is_valid"] = value["is_valid"]
+                        row["is_valid_reason"] = value.get("reason")
+                    elif log["key"] == LogKey.ANSWER_QUESTION:
+                        row["answer"] = value.get("answer")
+                    elif log["key"] == LogKey.IS_DECIDING_QUESTION:
+                        row["is_deciding_q"] = value.get("is_deciding_q")
+        return [TurnReview.parse_obj(row) for row in rows]
+
+    @with_session
+    def search_turns(
+        self, session: Session, query: str, limit: int = 50, offset: int = 0
+    ) -> list[TurnSearchResult]:
+        """
+        Turns matching a full-text search of their question, the game's subject
+        and the validation reason, best matches first.
+
+        `query` is in FTS5 syntax, e.g. `wings`, `"eiffel tower"`, `subject:tower`
+        or `wing* NOT reason:valid` (words are stemmed, so `wing` finds "wings").
+        Raises `ValueError` if it's malformed.
+        """
+        check_search_query(query)
+        params = {
+            "query": query,
+            "limit": limit,
+            "offset": offset,
+            "hl_start": HIGHLIGHT_START,
+            "hl_end": HIGHLIGHT_END,
+        }
+        rows = session.execute(TURN_SEARCH_Q, params).mappings().all()
+        return [TurnSearchResult.parse_obj(row) for row in rows]
 
     @with_session
     def review_games(self, session: Session) -> list[TurnReview]:
@@ -455,5 +1393,4 @@ class Repository:
         ).order_by(
             Turn.id.asc()  # type: ignore
         )
-        result = session.execute(query).fetchall()
-        return [TurnReview.parse_obj(row) for row in result]
+        return self._turn_reviews(session.execute(query).fetchall())
@@ -0,0 +1,229 @@
+import logging
+import random
+import time
+from collections import deque
+from collections.abc import Callable
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Future,
+    ThreadPoolExecutor,
+    wait,
+)
+from dataclasses import dataclass
+from statistics import quantiles
+from threading import Lock
+from typing import TypeVar
+
+import openai.error
+
+from twentyqs.singleflight import bypass_coalescing
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# errors worth retrying, anything else is raised immediately
+TRANSIENT_ERRORS: tuple[type[Exception], ...] = (
+    openai.error.APIError,
+    openai.error.APIConnectionError,
+    openai.error.RateLimitError,
+    openai.error.ServiceUnavailableError,
+    openai.error.Timeout,
+    openai.error.TryAgain,
+    TimeoutError,
+)
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class TurnBudget:
+    """
+    Time budget shared by all the LLM calls in a turn.
+    """
+
+    deadline: float
+
+    def __init__(self, seconds: float):
+        self.deadline = time.monotonic() + seconds
+
+    def remaining(self) -> float:
+        return max(0.0, self.deadline - time.monotonic())
+
+    @property
+    def exhausted(self) -> bool:
+        return self.remaining() == 0.0
+
+
+@dataclass(frozen=True)
+class ResilienceConfig:
+    # total time for all LLM calls in a turn before we give up
+    turn_budget: float = 30.0
+    # max time for a single LLM request (further limited by the turn budget)
+    call_timeout: float = 15.0
+    max_attempts: int = 3
+    # exponential backoff with "full jitter" between retries
+    backoff_base: float = 0.5
+    backoff_max: float = 4.0
+    # fire a duplicate request if the first hasn't returned after the observed
+    # p95 latency (or `hedge_after` until we have enough samples)
+    hedge: bool = False
+    hedge_after: float = 5.0
+    hedge_min_samples: int = 20
+
+
+class LatencyTracker:
+    """
+    Rolling window of recent call latencies.
+    """
+
+    def __init__(self, maxlen: int = 200):
+        self._samples: deque[float] = deque(maxlen=maxlen)
+        self._lock = Lock()
+
+    def add(self, seconds: float) -> None:
+        with self._lock:
+            self._samples.append(seconds)
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+    def p95(self) -> float | None:
+        with self._lock:
+            samples = list(self._samples)
+        if len(samples) < 2:
+            return None
+        return quantiles(samples, n=20)[-1]
+
+
+class ResilientInvoker:
+    """
+    Calls (LLM chains) with per-call deadlines taken from a per-turn budget,
+    retries with jittered backoff on transient errors and optional hedging.
+
+    Calls run on a worker thread so that we can stop waiting for them, but a
+    sync HTTP request can't be cancelled: an abandoned call will finish (or
+    time out) in the background and its result is discarded.
+    """
+
+    config: ResilienceConfig
+
+    def __init__(self, config: ResilienceConfig | None = None, max_workers: int = 16):
+        self.config = config or ResilienceConfig()
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="llm-call"
+        )
+        self._latencies: dict[str, LatencyTracker] = {}
+
+    def start_turn(self) -> TurnBudget:
+        return TurnBudget(self.config.turn_budget)
+
+    def _tracker(self, name: str) -> LatencyTracker:
+        return self._latencies.setdefault(name, LatencyTracker())
+
+    def hedge_delay(self, name: str) -> float:
+        tracker = self._tracker(name)
+        if len(tracker) >= self.config.hedge_min_samples:
+            p95 = tracker.p95()
+            if p95 is not None:
+                return p95
+        return self.config.hedge_after
+
+    def _submit(self, name: str, fn: Callable[[], T], fresh: bool) -> Future[T]:
+        """
+        `fresh`: don't join an identical call already in flight (which is what
+        we'd be retrying or hedging)
+        """
+
+        def timed() -> T:
+            start = time.monotonic()
+            if fresh:
+                with bypass_coalescing():
+                    result = fn()
+            else:
+                result = fn()
+            self._tracker(name).add(time.monotonic() - start)
+            return result
+
+        return self._executor.submit(timed)
+
+    def _attempt(
+        self,
+        name: str,
+        fn: Callable[[], T],
+        timeout: float,
+        hedge: bool,
+        fresh: bool = False,
+    ) -> T:
+        """
+        Make a single (possibly hedged) attempt, the first successful reply wins.
+        """
+        started = time.monotonic()
+        pending = {self._submit(name, fn, fresh)}
+        if hedge:
+            delay = min(self.hedge_delay(name), timeout)
+            done, pending = wait(pending, timeout=delay)
+            if not done:
+                logger.info("ResilientInvoker: hedging %s after %.2fs", name, delay)
+                pending.add(self._submit(name, fn, fresh=True))
+            else:
+                pending = done
+
+        error: BaseException | None = None
+        while pending:
+            remaining = timeout - (time.monotonic() - started)
+            if remaining <= 0:
+                break
+            done, pending = wait(
+                pending, timeout=remaining, return_when=FIRST_COMPLETED
+            )
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+                error = future.exception()
+        if error is not None and not pending:
+            raise error
+        raise TimeoutError(f"{name} did not complete within {timeout:.2f}s")
+
+    def call(
+        self,
+        name: str,
+        fn: Callable[[], T],
+        budget: TurnBudget,
+        hedge: bool | None = None,
+    ) -> T:
+        """
+        Call `fn`, retrying transient errors until `budget` is exhausted.
+
+        Raises `DeadlineExceeded` if the budget ran out, otherwise the error
+        from the last attempt.
+        """
+        hedge = self.config.hedge if hedge is None else hedge
+        for attempt in range(1, self.config.max_attempts + 1):
+            timeout = min(self.config.call_timeout, budget.remaining())
+            if timeout <= 0:
+                raise DeadlineExceeded(name)
+            try:
+                return self._attempt(name, fn, timeout, hedge, fresh=attempt > 1)
+            except TRANSIENT_ERRORS as e:
+                if attempt == self.config.max_attempts:
+                    raise
+                backoff = random.uniform(
+                    0,
+                    min(
+                        self.config.backoff_max,
+                        self.config.backoff_base * 2 ** (attempt - 1),
+                    ),
+                )
+                if backoff >= budget.remaining():
+                    raise DeadlineExceeded(name) from e
+                logger.warning(
+                    "ResilientInvoker: %s attempt %d failed (%r), retrying in %.2fs",
+                    name,
+                    attempt,
+                    e,
+                    backoff,
+                )
+                time.sleep(backoff)
+        raise DeadlineExceeded(name)
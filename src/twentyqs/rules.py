@@ -0,0 +1,202 @@
+"""
+Cheap local rules for questions that obviously are (or are not) yes/no questions.
+
+Anything not matched by a rule still goes to the LLM, so the rules only need
+to be precise, not complete.
+"""
+import re
+from collections.abc import Iterable
+from dataclasses import dataclass
+
+# "Is it...", "Does it...", "Can it..." etc
+YES_NO_OPENERS = (
+    "is",
+    "isn't",
+    "are",
+    "aren't",
+    "was",
+    "wasn't",
+    "were",
+    "does",
+    "doesn't",
+    "do",
+    "did",
+    "can",
+    "could",
+    "will",
+    "would",
+    "should",
+    "has",
+    "have",
+    "had",
+    "may",
+    "might",
+)
+
+# (opener, reason)
+NOT_YES_NO_OPENERS = (
+    ("how many", "Because it requires a numeric answer."),
+    ("how much", "Because it requires a numeric answer."),
+    ("how old", "Because it requires a numeric answer."),
+    ("how", "Because it requires a descriptive answer."),
+    ("what", "Because it requires a descriptive answer."),
+    ("which", "Because it requires choosing from options."),
+    ("who", "Because it requires a name."),
+    ("whose", "Because it requires a name."),
+    ("where", "Because it requires a place."),
+    ("when", "Because it requires a time or date."),
+    ("why", "Because it requires an explanation."),
+)
+
+# a leading subordinate clause, e.g. "when you eat it, is it sweet?"
+# (words which can also open a question only count when followed by a subject)
+SUBORDINATE_OPENERS = (
+    "if",
+    "when",
+    "whenever",
+    "where",
+    "while",
+    "once",
+    "after",
+    "before",
+    "because",
+    "since",
+    "although",
+    "though",
+    "as",
+    "unless",
+)
+SUBJECTS = (
+    "it",
+    "it's",
+    "its",
+    "they",
+    "they're",
+    "you",
+    "you're",
+    "i",
+    "we",
+    "someone",
+    "people",
+    "one",
+    "there",
+)
+
+whitespace_re = re.compile(r"\s+")
+# clauses are split at commas etc, and by dashes between spaces (not "t-shirt")
+clause_sep_re = re.compile(r"\s*(?:[,;:\u2013\u2014]|\s-\s)\s*")
+subordinate_re = re.compile(
+    rf"^(?:{'|'.join(SUBORDINATE_OPENERS)}) (?:{'|'.join(map(re.escape, SUBJECTS))})\b"
+)
+# "is it big and does it fly?" is two questions
+compound_re = re.compile(
+    rf"\b(?:and|but|so) (?:{'|'.join(map(re.escape, YES_NO_OPENERS))}) "
+)
+# "is it big or small?" can't be answered yes/no, but "is it black or white
+# (i.e. monochrome)?" arguably can... leave these to the LLM
+alternatives_re = re.compile(r"\bor\b")
+
+RuleResultT = tuple[bool, str | None]
+
+
+def normalize_question(question: str) -> str:
+    return whitespace_re.sub(" ", question.strip().lower()).rstrip("?!. ")
+
+
+def _starts_with(text: str, opener: str) -> bool:
+    return text == opener or text.startswith(f"{opener} ")
+
+
+def _is_question_opener(clause: str) -> bool:
+    return any(
+        _starts_with(clause, opener)
+        for opener in (*YES_NO_OPENERS, *(opener for opener, _ in NOT_YES_NO_OPENERS))
+    )
+
+
+def classify_question(question: str) -> RuleResultT | None:
+    """
+    Returns (is_valid, reason) if the question is obviously valid or invalid,
+    or `None` if it should be checked by the LLM.
+
+    Only the main clause (the last one) is classified, so that a leading
+    subordinate clause, as in "When you eat it, is it sweet?", doesn't decide
+    it. Anything where an earlier clause may itself be a question is left to
+    the LLM.
+    """
+    text = normalize_question(question)
+    # more than one question, or a question followed by chatter
+    if "?" in text or not text:
+        return None
+    if alternatives_re.search(text) or compound_re.search(text):
+        return None
+    *leading, main = clause_sep_re.split(text)
+    if not main or subordinate_re.match(main):
+        # (e.g. "when you eat it is it sweet", can't tell where the main
+        # clause starts)
+        return None
+    for clause in leading:
+        if _is_question_opener(clause) and not subordinate_re.match(clause):
+            # e.g. "how big is it - bigger than a car?", "is it big, is it red?"
+            return None
+    for opener, reason in NOT_YES_NO_OPENERS:
+        if _starts_with(main, opener):
+            return False, reason
+    for opener in YES_NO_OPENERS:
+        # need something after the opener, e.g. "is it?" is not a question
+        if main.startswith(f"{opener} ") and len(main.split(" ")) > 2:
+            return True, None
+    return None
+
+
+@dataclass(frozen=True)
+class RulesEvaluation:
+    total: int
+    accepted: int
+    accepted_correct: int
+    rejected: int
+    rejected_correct: int
+
+    @property
+    def coverage(self) -> float | None:
+        """Proportion of questions decided without the LLM."""
+        if not self.total:
+            return None
+        return (self.accepted + self.rejected) / self.total
+
+    @property
+    def accept_precision(self) -> float | None:
+        if not self.accepted:
+            return None
+        return self.accepted_correct / self.accepted
+
+    @property
+    def reject_precision(self) -> float | None:
+        if not self.rejected:
+            return None
+        return self.rejected_correct / self.rejected
+
+
+def evaluate_rules(history: Iterable[tuple[str, bool]]) -> RulesEvaluation:
+    """
+    Compare the rules against `(question, is_valid)` verdicts from the LLM.
+    """
+    total = accepted = accepted_correct = rejected = rejected_correct = 0
+    for question, is_valid in history:
+        total += 1
+        result = classify_question(question)
+        if result is None:
+            continue
+        if result[0]:
+            accepted += 1
+            accepted_correct += is_valid
+        else:
+            rejected += 1
+            rejected_correct += not is_valid
+    return RulesEvaluation(
+        total=total,
+        accepted=accepted,
+        accepted_correct=accepted_correct,
+        rejected=rejected,
+        rejected_correct=rejected_correct,
+    )
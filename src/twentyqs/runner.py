@@ -1,18 +1,28 @@
 #!/usr/bin/env python3
 import logging
+from collections.abc import Mapping
 from contextlib import contextmanager
 from dataclasses import dataclass
+from functools import partial
 from typing import Callable
 
 import gradio as gr
-from langchain import OpenAI
-from langchain.callbacks import get_openai_callback
 from langchain.callbacks.openai_info import OpenAICallbackHandler
 
+from twentyqs.batching import MicroBatcher
 from twentyqs.brain import AnswerBot
 from twentyqs.controller import GameController
+from twentyqs.llms import (
+    LLMRouter,
+    Route,
+    RouteStatsHandler,
+    collecting_stats,
+    get_route_stats_callback,
+)
+from twentyqs.prewarm import CommonQuestions
+from twentyqs.resilience import ResilienceConfig, ResilientInvoker
 from twentyqs.repository import Repository
-from twentyqs.ui import ViewModel
+from twentyqs.ui import QueueConfig, ViewModel
 
 
 """
@@ -28,6 +38,7 @@ logger = logging.getLogger(__name__)
 @dataclass(frozen=True)
 class OpenAIStatsContext:
     _callback: OpenAICallbackHandler
+    _route_callback: RouteStatsHandler
 
     def get_stats(self):
         return {
@@ -36,42 +47,106 @@ class OpenAIStatsContext:
             "completion_tokens": self._callback.completion_tokens,
             "successful_requests": self._callback.successful_requests,
             "total_cost": self._callback.total_cost,
+            "routes": self._route_callback.get_stats(),
         }
 
 
 @contextmanager
 def openai_stats_context():
-    with get_openai_callback() as callback:
-        yield OpenAIStatsContext(callback)
+    # (not langchain's `get_openai_callback`, which counts the calls of all the
+    # games being played, and leaves its handler behind if the block raises)
+    callback = OpenAICallbackHandler()
+    with collecting_stats(callback), get_route_stats_callback() as routes:
+        yield OpenAIStatsContext(callback, routes)
 
 
-def get_view(
+def get_controller(
     repository: Repository,
     openai_model: str,
     simple_subject_picker: bool,
     verbose_langchain: bool,
-    username: str | None = None,
-    auth_callback: Callable[[str, str], bool] | None = None,
+    require_auth: bool = True,
     max_questions: int = 20,
-) -> gr.Blocks:
+    stream_answers: bool = False,
+    rule_based_validation: bool = False,
+    prewarm_questions: int = 0,
+    resilience: ResilienceConfig | None = None,
+    route_models: Mapping[Route, str | None] | None = None,
+    batch_window: float = 0,
+    max_active_games: int = 1000,
+    active_game_ttl: float | None = 30 * 60,
+) -> GameController:
     """
-    `username` if provided will bypass auth and just get-or-create that user.
-    `auth_callback` is to enable Gradio's login UI.
+    `stream_answers` makes the answer available as soon as it is generated, see
+    `GameController.take_turn_streaming`. Only the answer chain is streamed, as
+    OpenAI doesn't report token usage for streamed responses.
+    `rule_based_validation` skips the LLM for obviously valid/invalid questions.
+    `prewarm_questions` is the number of most commonly asked questions to answer
+    in advance for each game.
+    `resilience` configures time budget, retries and hedging for LLM calls.
+    `route_models` overrides `openai_model` for some of the chains.
+    `batch_window` (seconds) if set, prompts from concurrent games are collected
+    for this long and sent as a single request. Only applies to LLMs which
+    accept many prompts per request, i.e. not chat models.
+    `max_active_games` and `active_game_ttl` (seconds idle) bound the games
+    kept in memory, evicted games are reloaded from the db.
     """
-    llm = OpenAI(temperature=0, model_name=openai_model)
-    answerer = AnswerBot(
-        llm=llm,
+    llm_kwargs = {}
+    if resilience:
+        # we do our own retrying (langchain's default is 6 attempts with long waits)
+        llm_kwargs["max_retries"] = 1
+    router = LLMRouter.using_openai(
+        default_model=openai_model,
+        models=route_models,
+        streaming_routes=(Route.ANSWER,) if stream_answers else (),
+        **llm_kwargs,
+    )
+    # (shared by all games)
+    answerer_factory = partial(
+        AnswerBot,
+        llm=router.default,
         simple_subject_picker=simple_subject_picker,
         langchain_verbose=verbose_langchain,
+        router=router,
+        stream_answers=stream_answers,
+        rule_based_validation=rule_based_validation,
+        resilience=ResilientInvoker(resilience) if resilience else None,
+        batcher=MicroBatcher(window=batch_window) if batch_window else None,
     )
-    controller = GameController(
+    return GameController(
         repository=repository,
-        answerer=answerer,
-        require_auth=username is None,
+        answerer_factory=answerer_factory,
+        require_auth=require_auth,
         max_questions=max_questions,
         stats_context_factory=openai_stats_context,
+        common_questions=(
+            CommonQuestions(repository, limit=prewarm_questions)
+            if prewarm_questions
+            else None
+        ),
+        max_active_games=max_active_games,
+        active_game_ttl=active_game_ttl,
+    )
+
+
+def get_view(
+    controller: GameController,
+    username: str | None = None,
+    auth_callback: Callable[[str, str], bool] | None = None,
+    stream_answers: bool = False,
+    queue: QueueConfig | None = None,
+) -> gr.Blocks:
+    """
+    `username` if provided will bypass auth and just get-or-create that user
+    (the controller should be built with `require_auth=False`).
+    `auth_callback` is to enable Gradio's login UI.
+    `stream_answers` shows the answer as soon as it is generated (the
+    controller should be built with `stream_answers=True` too).
+    `queue` enables the Gradio queue with concurrency limits and load shedding.
+    """
+    view_model = ViewModel(
+        controller, username=username, stream_answers=stream_answers, queue=queue
     )
-    view_model = ViewModel(controller, username=username)
     return view_model.create_view(auth_callback=auth_callback)
 
 
@@ -84,6 +159,13 @@ def run(
     verbose_langchain: bool,
     log_level: str,
     max_questions: int,
+    stream_answers: bool = False,
+    rule_based_validation: bool = False,
+    prewarm_questions: int = 0,
+    resilience: ResilienceConfig | None = None,
+    route_models: Mapping[Route, str | None] | None = None,
+    batch_window: float = 0,
+    queue: QueueConfig | None = None,
 ):
     """
     Run the Gradio app directly.
@@ -93,12 +175,24 @@ def run(
     repo = Repository(db_path=db_path)
     repo.init_db(drop=clear_db)
 
-    view = get_view(
+    controller = get_controller(
         repository=repo,
         openai_model=openai_model,
         simple_subject_picker=simple_subject_picker,
         verbose_langchain=verbose_langchain,
-        username=username,
+        require_auth=False,
         max_questions=max_questions,
+        stream_answers=stream_answers,
+        rule_based_validation=rule_based_validation,
+        prewarm_questions=prewarm_questions,
+        resilience=resilience,
+        route_models=route_models,
+        batch_window=batch_window,
+    )
+    view = get_view(
+        controller,
+        username=username,
+        stream_answers=stream_answers,
+        queue=queue,
     )
     view.launch(show_api=False)
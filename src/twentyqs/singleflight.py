@@ -0,0 +1,111 @@
+import asyncio
+import logging
+from collections.abc import Awaitable, Callable, Hashable, Iterator
+from concurrent.futures import Future
+from contextlib import contextmanager
+from contextvars import ContextVar
+from threading import Lock
+from typing import Any, TypeVar
+
+from twentyqs.types import JsonT
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+_bypass: ContextVar[bool] = ContextVar("singleflight_bypass", default=False)
+
+
+@contextmanager
+def bypass_coalescing() -> Iterator[None]:
+    """
+    Always make a new call, e.g. for a retry or hedged request where joining
+    the call already in flight would defeat the purpose.
+    """
+    token = _bypass.set(True)
+    try:
+        yield
+    finally:
+        _bypass.reset(token)
+
+
+class SingleFlight:
+    """
+    Coalesces identical concurrent calls: while a call for `key` is in flight,
+    further calls for the same key wait for its result instead of making their
+    own call.
+
+    Works across threads and event loops (and between the two), as the
+    in-flight result is shared as a `concurrent.futures.Future`.
+    """
+
+    def __init__(self) -> None:
+        self._lock = Lock()
+        self._in_flight: dict[Hashable, Future[Any]] = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    def _join(self, key: Hashable) -> tuple[Future[Any], bool]:
+        """
+        Returns the future for `key` and whether we are the leader, i.e. the
+        caller that has to make the call.
+        """
+        with self._lock:
+            self.calls += 1
+            future = self._in_flight.get(key)
+            if future is not None:
+                self.coalesced += 1
+                return future, False
+            future = Future()
+            self._in_flight[key] = future
+            return future, True
+
+    def _land(self, key: Hashable, future: Future[Any]) -> None:
+        with self._lock:
+            if self._in_flight.get(key) is future:
+                del self._in_flight[key]
+
+    def do(self, key: Hashable, fn: Callable[[], T]) -> T:
+        if _bypass.get():
+            return fn()
+        future, leader = self._join(key)
+        if not leader:
+            logger.debug("SingleFlight.do: coalesced %r", key)
+            return future.result()
+        try:
+            result = fn()
+        except BaseException as e:
+            self._land(key, future)
+            future.set_exception(e)
+            raise
+        self._land(key, future)
+        future.set_result(result)
+        return result
+
+    async def ado(self, key: Hashable, fn: Callable[[], Awaitable[T]]) -> T:
+        if _bypass.get():
+            return await fn()
+        future, leader = self._join(key)
+        if not leader:
+            logger.debug("SingleFlight.ado: coalesced %r", key)
+            return await asyncio.wrap_future(future)
+        try:
+            result = await fn()
+        except BaseException as e:
+            self._land(key, future)
+            future.set_exception(e)
+            raise
+        self._land(key, future)
+        future.set_result(result)
+        return result
+
+    def get_stats(self) -> dict[str, JsonT]:
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "coalesced": self.coalesced,
+                "in_flight": len(self._in_flight),
+            }
+
+
+llm_calls = SingleFlight()
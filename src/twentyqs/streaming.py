@@ -0,0 +1,60 @@
+import threading
+import weakref
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+from typing import Any
+
+from langchain.callbacks.base import BaseCallbackManager
+from langchain.schema import BaseLanguageModel
+
+from twentyqs.llms import NullCallbackHandler
+
+TokenCallbackT = Callable[[str], None]
+
+
+class TokenSink(NullCallbackHandler):
+    """
+    Forwards streamed LLM tokens to whoever is capturing them in the current thread.
+
+    Langchain callback managers are shared between concurrent calls (by default
+    there is a single global one) so we can't just add a handler per request.
+    Instead a single sink is attached to the LLM's callback manager and tokens
+    are routed via a thread-local, only while inside `capture()`.
+
+    NOTE: tokens are only emitted if the LLM was created with `streaming=True`.
+    """
+
+    def __init__(self) -> None:
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._managers: weakref.WeakSet[BaseCallbackManager] = weakref.WeakSet()
+
+    @property
+    def always_verbose(self) -> bool:
+        return True
+
+    def attach(self, llm: BaseLanguageModel) -> None:
+        """Add the sink to the LLM's callback manager (idempotent)."""
+        manager = getattr(llm, "callback_manager", None)
+        if manager is None:
+            return
+        with self._lock:
+            if manager not in self._managers:
+                manager.add_handler(self)
+                self._managers.add(manager)
+
+    @contextmanager
+    def capture(self, on_token: TokenCallbackT) -> Iterator[None]:
+        self._local.on_token = on_token
+        try:
+            yield
+        finally:
+            self._local.on_token = None
+
+    def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+        on_token = getattr(self._local, "on_token", None)
+        if on_token is not None:
+            on_token(token)
+
+
+token_sink = TokenSink()
@@ -16,6 +16,18 @@ class Answer(StrEnum):
     DONT_KNOW = "I don't know"
 
 
+class Route(StrEnum):
+    """
+    The chains used by `AnswerBot`, each can be routed to a different LLM.
+    (see `llms.LLMRouter`)
+    """
+
+    PICK_SUBJECT = "pick_subject"
+    VALIDATE = "validate"
+    ANSWER = "answer"
+    DECIDING = "deciding"
+
+
 class LogKey(StrEnum):
     BEGIN_TURN = "BEGIN_TURN"
     VALIDATE_QUESTION = "VALIDATE_QUESTION"
@@ -40,6 +52,8 @@ class TurnValidate:
     is_valid: bool
     reason: str | None
     timestamp: datetime = field(default_factory=datetime.now)
+    # decided by `twentyqs.rules` rather than the LLM
+    rule_based: bool = False
 
 
 @dataclass(frozen=True)
@@ -47,6 +61,8 @@ class TurnAnswer:
     answer: str
     justification: str | None
     timestamp: datetime = field(default_factory=datetime.now)
+    # generated ahead of time by `AnswerBot.prewarm_answers`
+    prewarmed: bool = False
 
 
 @dataclass(frozen=True)
@@ -95,6 +111,21 @@ class ServerStats(BaseModel):
     avg_questions_to_win: float | None
 
 
+class GameState(BaseModel):
+    """
+    Everything needed to resume a game, as stored in the db.
+    """
+
+    class Config:
+        frozen = True
+
+    game_id: int
+    username: str
+    subject: str
+    questions_asked: int  # (valid questions only)
+    finished: bool
+
+
 class UserMeta(BaseModel):
     username: str
     name: str
@@ -103,7 +134,7 @@ class UserMeta(BaseModel):
 
 class TurnReview(BaseModel):
     gamesession_id: int
-    valid_q_n: int
+    valid_q_n: int | None  # (NULL until backfilled, for legacy turns)
     turn_id: int
     subject: str
     question: str
@@ -111,3 +142,18 @@ class TurnReview(BaseModel):
     is_valid_reason: str | None
     answer: str | None
     is_deciding_q: bool | None
+
+
+class TurnSearchResult(BaseModel):
+    """
+    (see `Repository.search_turns`, the matched terms in `question`, `subject`
+    and `reason` are wrapped in `repository.HIGHLIGHT_START`/`HIGHLIGHT_END`)
+    """
+
+    turn_id: int
+    gamesession_id: int
+    started_at: datetime
+    question: str | None
+    subject: str
+    reason: str | None
+    answer: str | None
@@ -1,19 +1,26 @@
+import inspect
 import logging
-from collections.abc import Callable
+from collections import Counter
+from collections.abc import Callable, Iterator, Mapping
+from contextlib import contextmanager
+from dataclasses import dataclass, replace
+from enum import StrEnum
 from functools import wraps
-from threading import Lock
-from typing import ParamSpec, Protocol, TypeVar, cast
+from threading import BoundedSemaphore
+from typing import Any, ParamSpec, Protocol, TypeVar, cast
 
 import gradio as gr
 
 from twentyqs.controller import (
+    AnswerPreview,
     GameController,
     InvalidQuestion,
     ContinueGame,
     WonGame,
     LostGame,
+    TurnOutcome,
 )
-from twentyqs.types import Answer
+from twentyqs.repository import NotFound
 
 logger = logging.getLogger(__name__)
 
@@ -26,34 +33,120 @@ LabelT = dict | str | None
 # (can't use tuple as has to be mutable)
 HistoryT = list[list[str | None]]
 ChatbotT = dict | HistoryT
+ChatDeltaT = dict[str, Any]
 
 T = TypeVar("T")
 P = ParamSpec("P")
 
 LOADED = "loaded"
 
+BUSY_MESSAGE = "😓 Sorry, I'm very busy right now."
 
-class Lockable(Protocol):
-    lock: Lock
+
+class EventType(StrEnum):
+    """
+    The expensive (LLM calling) events, which are subject to admission control.
+    """
+
+    START_GAME = "start_game"
+    TURN = "turn"
+
+
+@dataclass(frozen=True)
+class QueueConfig:
+    # Gradio queue workers, shared by all queued events
+    concurrency_count: int = 4
+    # Gradio rejects events when this many are already waiting for a worker
+    max_size: int | None = 64
+    # max concurrent events of each type (None: only limited by the queue)
+    start_game_concurrency: int | None = None
+    turn_concurrency: int | None = None
+    # seconds an event may wait for a slot before we reply "busy" rather than
+    # leave the player waiting behind everyone else
+    admission_timeout: float = 1.0
+
+    def limits(self) -> dict[EventType, int | None]:
+        return {
+            EventType.START_GAME: self.start_game_concurrency,
+            EventType.TURN: self.turn_concurrency,
+        }
 
 
-def with_lock(f: Callable[P, T]) -> Callable[P, T]:
+class Admission:
     """
-    Decorator (for instance methods) to acquire a lock around the method call.
+    Bounded concurrency per event type, shedding load when no slot frees up
+    within `timeout`.
     """
 
-    @wraps(f)
-    def wrapper(*args: P.args, **kwargs: P.kwargs) -> T:
-        self = cast(Lockable, args[0])
-        self.lock.acquire()
+    def __init__(self, limits: Mapping[EventType, int | None], timeout: float):
+        self._slots = {
+            event: BoundedSemaphore(limit) for event, limit in limits.items() if limit
+        }
+        self.timeout = timeout
+        self.rejected: Counter[EventType] = Counter()
+
+    @contextmanager
+    def slot(self, event: EventType) -> Iterator[bool]:
+        """
+        Yields whether the event was admitted.
+        """
+        semaphore = self._slots.get(event)
+        if semaphore is None:
+            yield True
+            return
+        if not semaphore.acquire(timeout=self.timeout):
+            self.rejected[event] += 1
+            logger.warning("Admission.slot: rejected %s (server busy)", event)
+            yield False
+            return
         try:
-            return f(*args, **kwargs)
-        except Exception as e:
-            raise e
+            yield True
         finally:
-            self.lock.release()
+            semaphore.release()
+
 
-    return wrapper
+class Admitting(Protocol):
+    admission: Admission | None
+
+
+def admitted(
+    event: EventType, on_busy: Callable[..., Any]
+) -> Callable[[Callable[P, T]], Callable[P, T]]:
+    """
+    Decorator (for instance methods) to call `on_busy` instead of the method if
+    the event is not admitted.
+    """
+
+    def decorator(f: Callable[P, T]) -> Callable[P, T]:
+        if inspect.isgeneratorfunction(f):
+
+            @wraps(f)
+            def gen_wrapper(*args: P.args, **kwargs: P.kwargs):
+                self = cast(Admitting, args[0])
+                if self.admission is None:
+                    yield from cast(Iterator, f(*args, **kwargs))
+                    return
+                with self.admission.slot(event) as ok:
+                    if not ok:
+                        yield on_busy(*args, **kwargs)
+                        return
+                    yield from cast(Iterator, f(*args, **kwargs))
+
+            return cast(Callable[P, T], gen_wrapper)
+
+        @wraps(f)
+        def wrapper(*args: P.args, **kwargs: P.kwargs) -> T:
+            self = cast(Admitting, args[0])
+            if self.admission is None:
+                return f(*args, **kwargs)
+            with self.admission.slot(event) as ok:
+                if not ok:
+                    return on_busy(*args, **kwargs)
+                return f(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
 
 
 def append_history(
@@ -87,6 +180,156 @@ def get_bot_msg(history: HistoryT) -> str | None:
     return history[-1][1]
 
 
+@dataclass(frozen=True)
+class ChatDelta:
+    """
+    Update for the client's copy of the chat history: keep the first `keep`
+    rows and replace the rest with `rows`.
+
+    (replacing rather than appending lets us update the last bot message, and
+    makes applying the same delta twice harmless)
+    """
+
+    keep: int
+    rows: HistoryT
+
+    def as_json(self) -> dict[str, Any]:
+        # (same as `gr.Chatbot.postprocess` does for text messages)
+        return {
+            "keep": self.keep,
+            "rows": [
+                [inspect.cleandoc(msg) if msg else msg for msg in row]
+                for row in self.rows
+            ],
+        }
+
+
+class Transcript:
+    """
+    The chat history, kept server-side in a `gr.State` so that only the rows
+    changed by each event are sent to the client, as a `ChatDelta`.
+    """
+
+    rows: HistoryT
+
+    def __init__(self):
+        self.rows = []
+        # index of the first row changed since the last delta
+        self._changed_from = 0
+
+    def _changed(self, index: int) -> None:
+        self._changed_from = max(0, min(self._changed_from, index))
+
+    def reset(self) -> None:
+        self.rows = []
+        self._changed_from = 0
+
+    def append(self, user_message: str | None = None, bot_message: str | None = None):
+        append_history(self.rows, user_message, bot_message)
+        self._changed(len(self.rows) - 1)
+
+    def pop(self) -> None:
+        del self.rows[-1]
+        self._changed(len(self.rows))
+
+    def set_bot_msg(self, bot_message: str):
+        set_bot_msg(self.rows, bot_message)
+        self._changed(len(self.rows) - 1)
+
+    def get_user_msg(self) -> str | None:
+        return get_user_msg(self.rows)
+
+    def delta(self) -> dict[str, Any]:
+        """
+        The rows changed since the previous delta, for the `chat_delta` output.
+        """
+        delta = ChatDelta(
+            keep=self._changed_from,
+            rows=[list(row) for row in self.rows[self._changed_from :]],
+        )
+        self._changed_from = len(self.rows)
+        return delta.as_json()
+
+    def full(self) -> HistoryT:
+        """
+        The whole history, e.g. to resync a client which missed a delta.
+        """
+        self._changed_from = len(self.rows)
+        return self.rows
+
+
+# Applies a `ChatDelta` to the chatbot in the browser. A client which has
+# missed a delta (e.g. after a reconnect) asks for the whole transcript.
+APPLY_DELTA_JS = """
+(delta, history) => {
+    if (!delta) {
+        return history;
+    }
+    history = history || [];
+    if (history.length < delta.keep) {
+        document.getElementById("resync-transcript").click();
+        return history;
+    }
+    return history.slice(0, delta.keep).concat(delta.rows);
+}
+"""
+
+
+def game_begun_message(max_questions: int) -> str:
+    return (
+        "💡Ok, I've picked a subject.\n"
+        f"Now you have {max_questions} questions to work out what it is!"
+    )
+
+
+def show_outcome(transcript: Transcript, outcome: TurnOutcome) -> bool:
+    """
+    Update the transcript for the outcome of a turn.
+
+    Returns whether the game is over.
+    """
+    logger.debug(f"show_outcome outcome: {outcome}")
+    game_over = False
+    match outcome:
+        case InvalidQuestion(_, reason):
+            transcript.set_bot_msg("Invalid question, please try again.")
+            if reason:
+                transcript.append(None, f"({reason})")
+        case ContinueGame(_, questions_remaining, answer):
+            transcript.set_bot_msg(answer)
+            transcript.append(None, f"{questions_remaining} questions remaining")
+        case WonGame(questions_asked, _, answer):
+            transcript.set_bot_msg(answer)
+            transcript.append(
+                None,
+                f"You won!\n\n(You needed {questions_asked} questions to work out the answer)",
+            )
+            transcript.append(None, "Game over")
+            game_over = True
+        case LostGame(_, _, answer, subject):
+            transcript.set_bot_msg(answer)
+            transcript.append(
+                None,
+                f"No questions left, I win!\n\nI was thinking of: {subject}",
+            )
+            transcript.append(None, "Game over")
+            game_over = True
+    return game_over
+
+
+def rebuild_transcript(controller: GameController, game_id: int) -> Transcript:
+    """
+    Rebuild the transcript of a game from the db, e.g. for a client which has
+    reconnected. (the intro messages from before the game began are omitted)
+    """
+    transcript = Transcript()
+    transcript.append(None, game_begun_message(controller.max_questions))
+    for question, outcome in controller.replay_game(game_id):
+        transcript.append(question)
+        show_outcome(transcript, outcome)
+    return transcript
+
+
 def parse_auth(urlpath: str) -> tuple[str, str]:
     segment = urlpath.rstrip("/").rsplit("/", 1)[-1]
     username, password = segment.split(":")
@@ -97,19 +340,79 @@ def games_label(val: int) -> str:
     return "game" if val == 1 else "games"
 
 
+# The current game is remembered in the browser (as `username:game_id`), so that
+# reloading the page, or being served by another process or after a restart,
+# resumes it (see `ViewModel.on_load`).
+GAME_STORAGE_KEY = "twentyqs-game"
+
+READ_GAME_JS = f"""
+(stored) => localStorage.getItem("{GAME_STORAGE_KEY}") || ""
+"""
+
+SAVE_GAME_JS = f"""
+(stored) => {{
+    localStorage.setItem("{GAME_STORAGE_KEY}", stored);
+    return stored;
+}}
+"""
+
+
+@dataclass(frozen=True)
+class PlayerState:
+    """
+    Per browser session state, kept server-side by Gradio in a `gr.State`.
+
+    Only a cache: the game itself is stored in the db (see `GameController`)
+    and its id in the browser, from which this is rebuilt on page load.
+    """
+
+    username: str | None = None
+    game_id: int | None = None
+    first_run: bool = True
+    # rebuilt from the stored game on load, rather than starting a new one
+    resumed: bool = False
+
+
+def parse_stored_game(stored: str | None) -> tuple[str, int] | None:
+    try:
+        username, game_id = (stored or "").rsplit(":", 1)
+        return username, int(game_id)
+    except ValueError:
+        return None
+
+
 class ViewModel:
-    lock: Lock
     controller: GameController
-
-    def __init__(self, controller: GameController, username: str | None = None):
-        self.lock = Lock()
+    admission: Admission | None
+
+    def __init__(
+        self,
+        controller: GameController,
+        username: str | None = None,
+        stream_answers: bool = False,
+        queue: QueueConfig | None = None,
+    ):
+        """
+        `queue` if given enables the Gradio queue, with admission control for
+        the expensive events.
+        """
         self.controller = controller
         self.username = username
-        self.first_run = True
+        self.stream_answers = stream_answers
+        self.queue = queue
+        self.admission = (
+            Admission(queue.limits(), timeout=queue.admission_timeout)
+            if queue
+            else None
+        )
 
-    @with_lock
-    def on_load(self, request: gr.Request) -> LabelT:
-        """Init a new game."""
+    def on_load(
+        self, stored_game: str, request: gr.Request
+    ) -> tuple[LabelT, PlayerState, Transcript]:
+        """
+        Resume the game stored in the browser if it's still in progress, else
+        init a new game.
+        """
         logger.info("ViewModel.on_load")
         if self.username:
             username = self.username
@@ -119,24 +422,47 @@ class ViewModel:
             # is its root url, so the request.url is not the real url
             # ...but we can get the real base url from the referer header
             username, password = parse_auth(request.request.headers["referer"])
-        self.controller.set_user(username, password)
-        return gr.update(value=LOADED, visible=False)
+        user = self.controller.authenticate(username, password)
+        loaded = gr.update(value=LOADED, visible=False)
+
+        stored = parse_stored_game(stored_game)
+        if stored is not None and stored[0] == user.username:
+            try:
+                state = self.controller.get_game(stored[1])
+            except NotFound:
+                state = None
+            if state and state.username == user.username and not state.finished:
+                logger.info("ViewModel.on_load: resuming game %s", state.game_id)
+                return (
+                    loaded,
+                    PlayerState(
+                        user.username,
+                        game_id=state.game_id,
+                        first_run=False,
+                        resumed=True,
+                    ),
+                    rebuild_transcript(self.controller, state.game_id),
+                )
+        return loaded, PlayerState(user.username), Transcript()
 
-    @with_lock
-    def intro(self) -> tuple[TextboxT, ChatbotT]:
+    def intro(
+        self, player: PlayerState, transcript: Transcript
+    ) -> tuple[TextboxT, ChatDeltaT]:
         logger.info("ViewModel.intro")
-        user_meta = self.controller.get_user_meta()
-        history: HistoryT = []
-        if self.first_run:
-            append_history(
-                history,
+        assert player.username
+        if player.resumed:
+            # (the transcript was rebuilt by `on_load`)
+            return gr.update(interactive=True, visible=True), transcript.delta()
+        user_meta = self.controller.get_user_meta(player.username)
+        transcript.reset()
+        if player.first_run:
+            transcript.append(
                 bot_message=(
                     f"👋 Hi {user_meta.name},\n"
                     "Let's play a game: I will think of a subject, you have to guess what it is."
                 ),
             )
-            append_history(
-                history,
+            transcript.append(
                 bot_message=(
                     "I will do my best to answer correctly, but please bear in mind I "
                     "am only an AI language model...\n\n"
@@ -145,93 +471,123 @@ class ViewModel:
                     "- Your questions and my answers are all recorded, so I can be taught to play better in future"
                 ),
             )
-        append_history(
-            history,
+        transcript.append(
             bot_message=(
                 f"You have won **{user_meta.stats.wins}** {games_label(user_meta.stats.wins)} and "
                 f"lost **{user_meta.stats.losses}** {games_label(user_meta.stats.losses)} so far, "
                 "let's see how you do this time 😉"
             ),
         )
-        append_history(
-            history, bot_message="🤖💭 Please be patient while I pick a subject..."
+        transcript.append(bot_message="🤖💭 Please be patient while I pick a subject...")
+        transcript.append()  # empty message to trigger 'loading' animation
+        return None, transcript.delta()
+
+    def resync(self, transcript: Transcript) -> ChatbotT:
+        """Send the whole transcript, to a client which has missed a delta."""
+        logger.info("ViewModel.resync")
+        return transcript.full()
+
+    def _start_game_busy(
+        self, player: PlayerState, transcript: Transcript, *args: Any
+    ) -> tuple[TextboxT, ChatDeltaT, ButtonT, PlayerState, TextboxT]:
+        transcript.set_bot_msg(
+            f'{BUSY_MESSAGE}\nPlease click "New game" to try again shortly.'
+        )
+        return (
+            gr.update(interactive=False, visible=False),
+            transcript.delta(),
+            gr.update(visible=True),
+            player,
+            gr.update(),
         )
-        append_history(history)  # empty message to trigger 'loading' animation
-        return None, history
 
-    @with_lock
+    @admitted(EventType.START_GAME, on_busy=_start_game_busy)
     def start_game(
-        self, history: HistoryT, evt: gr.EventData
-    ) -> tuple[TextboxT, ChatbotT]:
+        self, player: PlayerState, transcript: Transcript, evt: gr.EventData
+    ) -> tuple[TextboxT, ChatDeltaT, ButtonT, PlayerState, TextboxT]:
         logger.info("ViewModel.start_game")
-        begun = self.controller.start_game()
-        del history[-1]
-        set_bot_msg(
-            history,
-            (
-                "💡Ok, I've picked a subject.\n"
-                f"Now you have {begun.max_questions} questions to work out what it is!"
-            ),
+        assert player.username
+        if player.resumed:
+            return (
+                gr.update(),
+                gr.update(),
+                gr.update(),
+                replace(player, resumed=False),
+                gr.update(),
+            )
+        begun = self.controller.start_game(player.username)
+        transcript.pop()
+        transcript.set_bot_msg(game_begun_message(begun.max_questions))
+        return (
+            gr.update(interactive=True, visible=True),
+            transcript.delta(),
+            gr.update(),
+            replace(player, game_id=begun.game_id, first_run=False),
+            f"{player.username}:{begun.game_id}",
         )
-        self.first_run = False
-        return gr.update(interactive=True, visible=True), history
 
-    @with_lock
+    def _turn_busy(
+        self, player: PlayerState, transcript: Transcript
+    ) -> tuple[TextboxT, ChatDeltaT, ButtonT]:
+        transcript.set_bot_msg(f"{BUSY_MESSAGE}\nPlease ask again shortly.")
+        # re-enable the input box
+        return (
+            gr.update(interactive=True, visible=True),
+            transcript.delta(),
+            gr.update(),
+        )
+
+    @admitted(EventType.TURN, on_busy=_turn_busy)
     def after_question_input(
-        self, history: HistoryT
-    ) -> tuple[TextboxT, ChatbotT, ButtonT]:
+        self, player: PlayerState, transcript: Transcript
+    ) -> tuple[TextboxT, ChatDeltaT, ButtonT]:
         """Process a game turn."""
-        question = get_user_msg(history)
+        question = transcript.get_user_msg()
         assert question is not None
-        outcome = self.controller.take_turn(question)
-        logger.debug(f"ViewModel.after_input outcome: {outcome}")
-        enable_new_game = False
-        match outcome:
-            case InvalidQuestion(_, reason):
-                set_bot_msg(history, "Invalid question, please try again.")
-                if reason:
-                    append_history(history, None, f"({reason})")
-            case ContinueGame(_, questions_remaining, Answer(answer)):
-                set_bot_msg(history, answer)
-                append_history(
-                    history, None, f"{questions_remaining} questions remaining"
-                )
-            case WonGame(questions_asked, _, Answer(answer)):
-                set_bot_msg(history, answer)
-                append_history(
-                    history,
-                    None,
-                    f"You won!\n\n(You needed {questions_asked} questions to work out the answer)",
-                )
-                append_history(history, None, "Game over")
-                enable_new_game = True
-            case LostGame(_, _, Answer(answer), subject):
-                set_bot_msg(history, answer)
-                append_history(
-                    history,
-                    None,
-                    f"No questions left, I win!\n\nI was thinking of: {subject}",
-                )
-                append_history(history, None, "Game over")
-                enable_new_game = True
+        assert player.game_id is not None
+        outcome = self.controller.take_turn(player.game_id, question)
+        enable_new_game = show_outcome(transcript, outcome)
 
         # re-enable the input box
         return (
             gr.update(interactive=not enable_new_game, visible=not enable_new_game),
-            history,
+            transcript.delta(),
+            gr.update(visible=enable_new_game),
+        )
+
+    @admitted(EventType.TURN, on_busy=_turn_busy)
+    def after_question_input_streaming(
+        self, player: PlayerState, transcript: Transcript
+    ) -> Iterator[tuple[TextboxT, ChatDeltaT, ButtonT]]:
+        """Process a game turn, showing the answer as soon as it is known."""
+        question = transcript.get_user_msg()
+        assert question is not None
+        assert player.game_id is not None
+        for update in self.controller.take_turn_streaming(player.game_id, question):
+            if isinstance(update, AnswerPreview):
+                transcript.set_bot_msg(update.answer)
+                # input box stays disabled until the turn is complete
+                yield gr.update(), transcript.delta(), gr.update()
+            else:
+                enable_new_game = show_outcome(transcript, update)
+
+        # re-enable the input box
+        yield (
+            gr.update(interactive=not enable_new_game, visible=not enable_new_game),
+            transcript.delta(),
             gr.update(visible=enable_new_game),
         )
 
     def on_question_input(
-        self, user_message: str, history: HistoryT
-    ) -> tuple[TextboxT, ChatbotT]:
+        self, user_message: str, transcript: Transcript
+    ) -> tuple[TextboxT, ChatDeltaT]:
         user_message = user_message.strip()
         # TODO: gradio error handling is meh
         # if not user_message:
         #     raise gr.Error("Please enter a question")
-        append_history(history, user_message)
+        transcript.append(user_message)
         # disable the input box
-        return gr.update(value="", interactive=False), history
+        return gr.update(value="", interactive=False), transcript.delta()
 
     def on_new_game_click(self):
         return gr.update(visible=False)
@@ -265,25 +621,79 @@ class ViewModel:
             # change events, so we use a hidden Textbox as a state substitute
             # TODO: fixed in https://github.com/gradio-app/gradio/pull/4304
             loaded_sentinel = gr.Textbox("", visible=False)
-            loaded_sentinel.change(self.intro, None, [question_input, chatbot]).success(
-                self.start_game, [chatbot], [question_input, chatbot]
+            # `username:game_id` of the current game, mirrored to localStorage
+            stored_game = gr.Textbox("", visible=False)
+            stored_game.change(
+                None, [stored_game], [stored_game], _js=SAVE_GAME_JS, queue=False
+            )
+            player = gr.State(PlayerState())
+            # the chat history is kept server-side, events only send the changed
+            # rows to the browser (see `Transcript`)
+            transcript = gr.State(Transcript())
+            chat_delta = gr.JSON(visible=False)
+            resync = gr.Button(visible=False, elem_id="resync-transcript")
+            chat_delta.change(
+                None, [chat_delta, chatbot], [chatbot], _js=APPLY_DELTA_JS, queue=False
+            )
+            resync.click(self.resync, [transcript], [chatbot], queue=False)
+
+            # the cheap events skip the queue, the expensive ones are subject
+            # to admission control (see `QueueConfig`)
+            loaded_sentinel.change(
+                self.intro,
+                [player, transcript],
+                [question_input, chat_delta],
+                queue=False,
+            ).success(
+                self.start_game,
+                [player, transcript],
+                [question_input, chat_delta, new_game, player, stored_game],
             )
 
-            view.load(self.on_load, None, [loaded_sentinel])
+            # on_load reads the referer from the http request, which queued
+            # events don't have
+            view.load(
+                self.on_load,
+                [stored_game],
+                [loaded_sentinel, player, transcript],
+                _js=READ_GAME_JS,
+                queue=False,
+            )
 
             question_input.submit(
                 self.on_question_input,
-                [question_input, chatbot],
-                [question_input, chatbot],
+                [question_input, transcript],
+                [question_input, chat_delta],
                 queue=False,
             ).success(
-                self.after_question_input,
-                [chatbot],
-                [question_input, chatbot, new_game],
+                self.after_question_input_streaming
+                if self.stream_answers
+                else self.after_question_input,
+                [player, transcript],
+                [question_input, chat_delta, new_game],
+            )
+            new_game.click(
+                self.on_new_game_click, None, [new_game], queue=False
+            ).success(
+                self.intro,
+                [player, transcript],
+                [question_input, chat_delta],
+                queue=False,
+            ).success(
+                self.start_game,
+                [player, transcript],
+                [question_input, chat_delta, new_game, player, stored_game],
+            )
+
+        if self.queue:
+            view.queue(
+                concurrency_count=self.queue.concurrency_count,
+                max_size=self.queue.max_size,
+                api_open=False,
             )
-            new_game.click(self.on_new_game_click, None, [new_game]).success(
-                self.intro, None, [question_input, chatbot]
-            ).success(self.start_game, [chatbot], [question_input, chatbot])
+        elif self.stream_answers:
+            # gradio requires the queue for generator event handlers
+            view.queue()
 
         view.auth = auth_callback
         view.auth_message = None